@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark comparing the validate and construct response decoding paths.
+
+Usage: python benchmarks/bench_response_decoding.py [--items 200] [--repeat 5] [--number 50]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import response_decoding  # noqa: E402
+from netsapiens_api_client import transform_to_netsapiens_recording_urls  # noqa: E402
+from peerlogic_api_client import transform_to_call_transcript  # noqa: E402
+from synthetic import make_call_transcripts_payload, make_json_response, make_recording_urls_payload  # noqa: E402
+
+
+def run(items: int, repeat: int, number: int) -> None:
+    cases = {
+        "recording_urls": (transform_to_netsapiens_recording_urls, make_json_response(make_recording_urls_payload(items))),
+        "call_transcripts": (transform_to_call_transcript, make_json_response(make_call_transcripts_payload(items))),
+    }
+
+    print(f"orjson available: {response_decoding.orjson is not None}. items={items} repeat={repeat} number={number}")
+    print(f"{'case':<20}{'mode':<12}{'best ms/call':>14}{'speedup':>10}")
+    for case_name, (transform, response) in cases.items():
+        baseline = None
+        for mode in (response_decoding.RESPONSE_DECODING_MODE_VALIDATE, response_decoding.RESPONSE_DECODING_MODE_CONSTRUCT):
+            response_decoding.set_response_decoding_mode(mode)
+            best = min(timeit.repeat(lambda: transform(response), repeat=repeat, number=number)) / number * 1000
+            baseline = baseline if baseline else best
+            print(f"{case_name:<20}{mode:<12}{best:>14.3f}{baseline / best:>9.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=200, help="Number of records in each synthetic list response")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=50)
+    args = parser.parse_args()
+
+    run(items=args.items, repeat=args.repeat, number=args.number)
@@ -0,0 +1,65 @@
+"""
+pytest-benchmark suite setup. Run with ./scripts/run-benchmarks.sh, which saves results and compares against the last run.
+"""
+from functools import lru_cache
+import os
+import shutil
+import sys
+from unittest import mock
+
+import pytest
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "src"))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+# must be set before the function's modules are imported
+os.environ.setdefault("PROJECT_ID", "benchmark")
+os.environ.setdefault("BUCKET_OUTPUT_AUDIO_PCM_ENCODED", "benchmark-audio-pcm-encoded")
+os.environ.setdefault("BUCKET_OUTPUT_RAW_EXTRACT", "benchmark-raw-extract")
+os.environ.setdefault("TRACING_EXPORTERS", "")
+
+from fakes import FakeStorageClient  # noqa: E402
+from synthetic import make_mulaw_wav_bytes, make_pcm_wav_bytes, make_speech_raw_extract  # noqa: E402
+
+# local_file_helpers creates a storage client at import, which needs credentials
+mock.patch("google.cloud.storage.Client", FakeStorageClient).start()
+
+import response_decoding  # noqa: E402
+
+requires_ffmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+
+WAV_GENERATORS = {"pcm": make_pcm_wav_bytes, "mulaw": make_mulaw_wav_bytes}
+
+
+@lru_cache(maxsize=None)
+def get_wav_bytes(encoding: str, sample_rate: int, duration_seconds: float) -> bytes:
+    """Generating audio is slower than most of what's measured, so each variant is made once per session."""
+    return WAV_GENERATORS[encoding](duration_seconds, sample_rate=sample_rate, channels=2, seed=0)
+
+
+@lru_cache(maxsize=None)
+def get_raw_extract(word_count: int, channel_count: int):
+    return make_speech_raw_extract(word_count, channel_count=channel_count, seed=0)
+
+
+@pytest.fixture(scope="session")
+def wav_path(tmp_path_factory):
+    """Writes a synthetic WAV for (encoding, sample_rate, duration_seconds) and returns its path."""
+    directory = tmp_path_factory.mktemp("wav")
+
+    def write(encoding: str, sample_rate: int, duration_seconds: float) -> str:
+        path = directory / f"{encoding}-{sample_rate}-{duration_seconds:g}.wav"
+        if not path.exists():
+            path.write_bytes(get_wav_bytes(encoding, sample_rate, duration_seconds))
+        return str(path)
+
+    return write
+
+
+@pytest.fixture(params=[response_decoding.RESPONSE_DECODING_MODE_VALIDATE, response_decoding.RESPONSE_DECODING_MODE_CONSTRUCT])
+def response_decoding_mode(request):
+    previous_mode = response_decoding.response_decoding_mode
+    response_decoding.set_response_decoding_mode(request.param)
+    yield request.param
+    response_decoding.set_response_decoding_mode(previous_mode)
@@ -0,0 +1,175 @@
+"""
+In-memory stand-ins for the Google Cloud clients used by the pipeline, for offline benchmarks.
+
+They implement only what this repository calls, with the same method names and arguments.
+"""
+import base64
+import hashlib
+import io
+import threading
+from typing import (
+    Dict,
+    Iterator,
+    List,
+    Optional,
+)
+
+import google_crc32c
+
+
+class FakeBlob(object):
+    def __init__(self, bucket: "FakeBucket", name: str) -> None:
+        self.bucket = bucket
+        self.name = name
+        self.content_type: Optional[str] = None
+
+    @property
+    def _data(self) -> Optional[bytes]:
+        return self.bucket.objects.get(self.name)
+
+    @property
+    def size(self) -> Optional[int]:
+        data = self._data
+        return len(data) if data is not None else None
+
+    @property
+    def md5_hash(self) -> Optional[str]:
+        data = self._data
+        return base64.b64encode(hashlib.md5(data).digest()).decode("ascii") if data is not None else None
+
+    @property
+    def crc32c(self) -> Optional[str]:
+        data = self._data
+        return base64.b64encode(google_crc32c.Checksum(data).digest()).decode("ascii") if data is not None else None
+
+    def exists(self, *args, **kwargs) -> bool:
+        return self._data is not None
+
+    def reload(self, *args, **kwargs) -> None:
+        pass
+
+    def upload_from_string(self, data, content_type: str = "text/plain", *args, **kwargs) -> None:
+        self.content_type = content_type
+        self.bucket.write(self.name, data.encode("utf-8") if isinstance(data, str) else data, content_type=content_type)
+
+    def upload_from_filename(self, filename: str, content_type: str = None, *args, **kwargs) -> None:
+        with open(filename, "rb") as f:
+            self.upload_from_file(f, content_type=content_type)
+
+    def upload_from_file(self, file_obj, size: int = None, content_type: str = None, *args, **kwargs) -> None:
+        self.content_type = content_type
+        self.bucket.write(self.name, file_obj.read() if size is None else file_obj.read(size), content_type=content_type)
+
+    def download_as_bytes(self, *args, **kwargs) -> bytes:
+        data = self._data
+        if data is None:
+            raise FileNotFoundError(f"gs://{self.bucket.name}/{self.name}")
+        return data
+
+    def open(self, mode: str = "rb", *args, **kwargs):
+        if "r" in mode:
+            return io.BytesIO(self.download_as_bytes()) if "b" in mode else io.StringIO(self.download_as_bytes().decode("utf-8"))
+        return FakeBlobWriter(self)
+
+    def compose(self, sources: List["FakeBlob"], *args, **kwargs) -> None:
+        self.bucket.write(self.name, b"".join(source.download_as_bytes() for source in sources), content_type=self.content_type)
+
+    def delete(self, *args, **kwargs) -> None:
+        self.bucket.delete(self.name)
+
+
+class FakeBlobWriter(io.BytesIO):
+    def __init__(self, blob: FakeBlob) -> None:
+        super().__init__()
+        self.blob = blob
+
+    def close(self) -> None:
+        if not self.closed:
+            self.blob.bucket.write(self.blob.name, self.getvalue())
+        super().close()
+
+
+class FakeBucket(object):
+    def __init__(self, client: "FakeStorageClient", name: str) -> None:
+        self.client = client
+        self.name = name
+
+    @property
+    def objects(self) -> Dict[str, bytes]:
+        return self.client.buckets.setdefault(self.name, {})
+
+    def write(self, blob_name: str, data: bytes, content_type: str = None) -> None:
+        with self.client.lock:
+            self.objects[blob_name] = data
+            self.client.content_types[(self.name, blob_name)] = content_type
+            self.client.writes += 1
+
+    def delete(self, blob_name: str) -> None:
+        with self.client.lock:
+            self.objects.pop(blob_name, None)
+
+    def blob(self, blob_name: str, *args, **kwargs) -> FakeBlob:
+        return FakeBlob(self, blob_name)
+
+    def get_blob(self, blob_name: str, *args, **kwargs) -> Optional[FakeBlob]:
+        return FakeBlob(self, blob_name) if blob_name in self.objects else None
+
+    def list_blobs(self, prefix: str = None, *args, **kwargs) -> Iterator[FakeBlob]:
+        return iter([FakeBlob(self, name) for name in sorted(self.objects) if not prefix or name.startswith(prefix)])
+
+
+class FakeStorageClient(object):
+    def __init__(self, *args, **kwargs) -> None:
+        self.buckets: Dict[str, Dict[str, bytes]] = {}
+        self.content_types: Dict[tuple, Optional[str]] = {}  # (bucket name, blob name) -> content type written with
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.get_bucket_calls = 0
+
+    def bucket(self, bucket_name: str, *args, **kwargs) -> FakeBucket:
+        return FakeBucket(self, bucket_name)
+
+    def get_bucket(self, bucket_or_name, *args, **kwargs) -> FakeBucket:
+        self.get_bucket_calls += 1  # a metadata round trip with the real client
+        return FakeBucket(self, getattr(bucket_or_name, "name", bucket_or_name))
+
+    def list_blobs(self, bucket_or_name, prefix: str = None, *args, **kwargs) -> Iterator[FakeBlob]:
+        return self.bucket(getattr(bucket_or_name, "name", bucket_or_name)).list_blobs(prefix=prefix)
+
+
+class FakeOperation(object):
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._callbacks = []
+
+    def done(self) -> bool:
+        return True
+
+    def result(self, timeout: float = None):
+        return None
+
+    def add_done_callback(self, callback) -> None:
+        callback(self)
+
+
+class FakeSpeechClient(object):
+    """Accepts long running recognize requests and completes them immediately."""
+
+    requests: List = []  # shared across instances since the pipeline creates a client per request
+    lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs) -> None:
+        pass
+
+    def long_running_recognize(self, request=None, *args, **kwargs) -> FakeOperation:
+        with self.lock:
+            self.requests.append(request)
+            return FakeOperation(name=f"operations/{len(self.requests)}")
+
+
+class FakeDlpServiceClient(object):
+    def __init__(self, *args, **kwargs) -> None:
+        pass
+
+    def deidentify_content(self, request=None, *args, **kwargs):
+        return request
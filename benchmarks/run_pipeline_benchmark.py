@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Offline end-to-end benchmark of transcribe_audio_peerlogic_pubsub.
+
+Synthetic AudioReady events are pushed through the real handler. HTTP is replayed from a cassette, either a
+synthetic one built from deterministic fixtures or one recorded with HTTP_CASSETTE_MODE=record. Speech, DLP and
+GCS are in-memory fakes. Reports throughput, per-stage latency and peak memory.
+
+Usage: python benchmarks/run_pipeline_benchmark.py [--events 50] [--concurrency 1] [--audio-seconds 60] [--cassette path]
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import time
+import tracemalloc
+import types
+from typing import Dict, List, Optional
+from unittest import mock
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "src"))
+
+# must be set before the function's modules are imported
+os.environ.setdefault("PROJECT_ID", "benchmark")
+os.environ.setdefault("BUCKET_OUTPUT_AUDIO_PCM_ENCODED", "benchmark-audio-pcm-encoded")
+os.environ.setdefault("BUCKET_OUTPUT_RAW_EXTRACT", "benchmark-raw-extract")
+os.environ.setdefault("PEERLOGIC_API_URL", "http://peerlogic.test/api/")
+os.environ.setdefault("PEERLOGIC_API_USERNAME", "benchmark")
+os.environ.setdefault("PEERLOGIC_API_PASSWORD", "benchmark")
+os.environ.setdefault("TRACING_EXPORTERS", "")
+
+from fakes import FakeDlpServiceClient, FakeSpeechClient, FakeStorageClient  # noqa: E402
+from synthetic import make_audio_ready_event, make_pcm_wav_bytes, make_shortuuid  # noqa: E402
+
+FAKE_AUTH_TOKEN = {
+    "access_token": "benchmark-access-token",
+    "apiversion": "Version: 41.2.3",
+    "client_id": "peerlogic-api-benchmark",
+    "displayName": "Benchmark",
+    "domain": "Peerlogic",
+    "expires_in": 3600,
+    "refresh_token": "benchmark-refresh-token",
+    "scope": "Super User",
+    "territory": "Peerlogic",
+    "token_type": "Bearer",
+    "uid": "1234@Peerlogic",
+    "user": 1234,
+    "user_email": "benchmark@peerlogic.com",
+    "username": "1234@Peerlogic",
+}
+
+
+def build_synthetic_cassette(api_url: str, wav_bytes: bytes, seed: int):
+    """Responses for one event. Ids are replaced by the endpoint template matching, so it serves any event."""
+    from http_record_replay import Cassette
+
+    rng = random.Random(seed)
+    call_id, partial_id, audio_partial_id = make_shortuuid(rng), make_shortuuid(rng), make_shortuuid(rng)
+    host = api_url.split("/api")[0]
+    signed_url = f"https://storage.googleapis.com/benchmark-call-audio/{audio_partial_id}.wav?X-Goog-Signature=benchmark"
+
+    cassette = Cassette()
+    cassette.add("POST", f"{api_url.rstrip('/')}/login", 200, {"Content-Type": "application/json"}, json.dumps(FAKE_AUTH_TOKEN).encode("utf-8"))
+    audio_partial = {"id": audio_partial_id, "call_partial": partial_id, "mime_type": "audio/WAV", "status": "uploaded", "signed_url": signed_url}
+    cassette.add(
+        "GET",
+        f"{host}/api/calls/{call_id}/partials/{partial_id}/audio/{audio_partial_id}/",
+        200,
+        {"Content-Type": "application/json"},
+        json.dumps(audio_partial).encode("utf-8"),
+    )
+    cassette.add("GET", signed_url, 200, {"Content-Type": "audio/wav"}, wav_bytes)
+    return cassette
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+
+def run(events: int, concurrency: int, audio_seconds: float, sample_rate: int, seed: int, cassette_path: Optional[str], trace_memory: bool) -> Dict:
+    with ExitStack() as stack:
+        stack.enter_context(mock.patch("google.cloud.storage.Client", FakeStorageClient))
+        stack.enter_context(mock.patch("google.cloud.dlp_v2.DlpServiceClient", FakeDlpServiceClient))
+        stack.enter_context(mock.patch("google.cloud.speech_v1p1beta1.SpeechClient", FakeSpeechClient))
+
+        import flask
+
+        import main
+        import tracing
+        from http_record_replay import CASSETTE_MODE_REPLAY, Cassette, install_cassette
+        from peerlogic_api_client import PeerlogicAPIClient
+
+        logging.getLogger().setLevel(logging.WARNING)  # main configures logging for Cloud Functions
+
+        if cassette_path:
+            cassette = Cassette.load(cassette_path)
+        else:
+            cassette = build_synthetic_cassette(os.environ["PEERLOGIC_API_URL"], make_pcm_wav_bytes(audio_seconds, sample_rate=sample_rate, seed=seed), seed)
+
+        client = PeerlogicAPIClient()
+        client.session_initializers.append(lambda session: install_cassette(session, cassette, CASSETTE_MODE_REPLAY))
+        main.peerlogic_api_client = client
+
+        collector = tracing.InMemorySpanExporter()
+        tracing.exporters[:] = [collector]
+
+        app = flask.Flask("benchmark")
+        rng = random.Random(seed)
+        payloads = [make_audio_ready_event(rng)[0] for _ in range(events)]
+        errors: List[str] = []
+
+        def handle(index: int) -> None:
+            context = types.SimpleNamespace(event_id=str(index), timestamp="2022-01-21T20:53:35.121Z")
+            with app.app_context():
+                try:
+                    main.transcribe_audio_peerlogic_pubsub(payloads[index], context)
+                except Exception as e:
+                    errors.append(f"{type(e).__name__}: {e}")
+
+        if trace_memory:
+            tracemalloc.start()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(handle, range(events)))
+        elapsed = time.perf_counter() - started
+
+        traced_peak_bytes = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+
+    stages = {
+        stage: {
+            "count": len(durations),
+            "mean_ms": sum(durations) / len(durations) * 1000,
+            "p50_ms": percentile(durations, 0.50) * 1000,
+            "p95_ms": percentile(durations, 0.95) * 1000,
+            "p99_ms": percentile(durations, 0.99) * 1000,
+        }
+        for stage, durations in collector.get_stage_durations().items()
+    }
+
+    return {
+        "events": events,
+        "concurrency": concurrency,
+        "audio_seconds": audio_seconds,
+        "sample_rate": sample_rate,
+        "errors": len(errors),
+        "first_errors": errors[:5],
+        "elapsed_seconds": elapsed,
+        "throughput_events_per_second": events / elapsed if elapsed else None,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,  # kilobytes on linux
+        "traced_peak_mb": traced_peak_bytes / 1024 / 1024 if traced_peak_bytes is not None else None,
+        "stages": stages,
+    }
+
+
+def print_report(report: Dict) -> None:
+    print(
+        f"events={report['events']} concurrency={report['concurrency']} audio_seconds={report['audio_seconds']} errors={report['errors']} "
+        f"elapsed={report['elapsed_seconds']:.2f}s throughput={report['throughput_events_per_second']:.1f} events/s peak_rss={report['peak_rss_mb']:.1f}MB"
+        + (f" traced_peak={report['traced_peak_mb']:.1f}MB" if report["traced_peak_mb"] is not None else "")
+    )
+    for error in report["first_errors"]:
+        print(f"  error: {error}")
+
+    print(f"{'stage':<70}{'count':>7}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, stats in report["stages"].items():
+        print(f"{stage:<70}{stats['count']:>7}{stats['mean_ms']:>10.2f}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--audio-seconds", type=float, default=60.0, help="Length of the synthetic recording")
+    parser.add_argument("--sample-rate", type=int, default=8000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cassette", help="Replay a recorded cassette instead of synthetic fixtures")
+    parser.add_argument("--trace-memory", action="store_true", help="Also report the peak of Python allocations using tracemalloc (slower)")
+    parser.add_argument("--json", help="Write the report to this path as JSON")
+    args = parser.parse_args()
+
+    report = run(args.events, args.concurrency, args.audio_seconds, args.sample_rate, args.seed, args.cassette, args.trace_memory)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
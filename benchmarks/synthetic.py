@@ -0,0 +1,151 @@
+"""
+Deterministic synthetic fixtures for benchmarks. The same seed always produces the same bytes.
+"""
+import base64
+import io
+import json
+import math
+import random
+import struct
+import wave
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Tuple
+
+import requests
+
+SHORTUUID_ALPHABET = "23456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+# words of a typical dental office call, so transcripts have realistic word lengths and repeats
+VOCABULARY = (
+    "hi thanks for calling the dental office this is how can I help you today I'd like to schedule a cleaning "
+    "appointment for next week do you have anything on tuesday morning we have an opening at nine thirty "
+    "is that your insurance still the same yes it is great you're all set see you then bye"
+).split()
+
+
+def make_shortuuid(rng: random.Random) -> str:
+    return "".join(rng.choice(SHORTUUID_ALPHABET) for _ in range(22))
+
+
+def make_pcm_wav_bytes(duration_seconds: float, sample_rate: int = 8000, channels: int = 2, seed: int = 0) -> bytes:
+    """16-bit PCM WAV of a tone per channel with a little noise, so it doesn't compress to nothing."""
+    rng = random.Random(seed)
+    frame_count = int(duration_seconds * sample_rate)
+    samples = _tone_samples(frame_count, sample_rate, channels, rng)
+    frames = struct.pack(f"<{len(samples)}h", *samples)
+
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wave_file:
+        wave_file.setnchannels(channels)
+        wave_file.setsampwidth(2)
+        wave_file.setframerate(sample_rate)
+        wave_file.writeframes(frames)
+    return buffer.getvalue()
+
+
+def _tone_samples(frame_count: int, sample_rate: int, channels: int, rng: random.Random) -> List[int]:
+    frequencies = [220.0 * (channel + 1) for channel in range(channels)]
+    return [int(8000 * math.sin(2 * math.pi * frequency * i / sample_rate)) + rng.randint(-500, 500) for i in range(frame_count) for frequency in frequencies]
+
+
+def linear_to_mulaw(sample: int) -> int:
+    """G.711 µ-law encoding of one 16-bit sample."""
+    sign = 0x80 if sample < 0 else 0
+    magnitude = min(-sample if sign else sample, 32635) + 0x84
+    exponent = min(7, max(0, magnitude.bit_length() - 8))
+    mantissa = (magnitude >> (exponent + 3)) & 0x0F
+    return ~(sign | (exponent << 4) | mantissa) & 0xFF
+
+
+def make_mulaw_wav_bytes(duration_seconds: float, sample_rate: int = 8000, channels: int = 2, seed: int = 0) -> bytes:
+    """8-bit µ-law WAV, the format telephony recordings often arrive in. The wave module only writes PCM, so the header is built here."""
+    rng = random.Random(seed)
+    frame_count = int(duration_seconds * sample_rate)
+    data = bytes(linear_to_mulaw(sample) for sample in _tone_samples(frame_count, sample_rate, channels, rng))
+
+    fmt = struct.pack("<HHIIHHH", 7, channels, sample_rate, sample_rate * channels, channels, 8, 0)  # WAVE_FORMAT_MULAW, cbSize 0
+    chunks = b"fmt " + struct.pack("<I", len(fmt)) + fmt
+    chunks += b"fact" + struct.pack("<II", 4, frame_count)
+    chunks += b"data" + struct.pack("<I", len(data)) + data + (b"\0" if len(data) % 2 else b"")
+    return b"RIFF" + struct.pack("<I", 4 + len(chunks)) + b"WAVE" + chunks
+
+
+def make_speech_raw_extract(word_count: int, channel_count: int = 2, words_per_result: int = 12, seed: int = 0) -> Dict[str, Any]:
+    """
+    Speech-to-Text raw extract, as written to BUCKET_OUTPUT_RAW_EXTRACT, with word_count words in results alternating
+    between channels. Each channel's words advance in time independently, so channels overlap like a real conversation.
+    """
+    rng = random.Random(seed)
+    results = []
+    channel_times = [0.0] * channel_count
+    words_remaining = word_count
+    while words_remaining > 0:
+        channel_index = len(results) % channel_count
+        words = []
+        for _ in range(min(words_per_result, words_remaining)):
+            start_time = channel_times[channel_index] + rng.choice((0.0, 0.1, 0.2))
+            end_time = start_time + rng.choice((0.2, 0.3, 0.4, 0.5))
+            channel_times[channel_index] = end_time
+            words.append({"start_time": f"{start_time:.1f}s", "end_time": f"{end_time:.1f}s", "word": rng.choice(VOCABULARY)})
+        words_remaining -= len(words)
+
+        results.append(
+            {
+                "alternatives": [{"transcript": " ".join(word["word"] for word in words), "confidence": round(rng.uniform(0.8, 0.99), 4), "words": words}],
+                "channel_tag": channel_index + 1,
+                "result_end_time": words[-1]["end_time"],
+                "language_code": "en-us",
+            }
+        )
+    return {"results": results}
+
+
+def make_json_response(payload: Any, status_code: int = 200) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers["Content-Type"] = "application/json"
+    response._content = json.dumps(payload).encode("utf-8")
+    return response
+
+
+def make_recording_urls_payload(count: int) -> List[Dict[str, Any]]:
+    """Netsapiens recording/read response."""
+    started = datetime(2022, 2, 22, 12, 0, 0)
+    return [
+        {
+            "status": "converted",
+            "call_id": f"{i:08d}@pbx.example.com",
+            "time_open": started.isoformat(sep=" "),
+            "time_close": (started + timedelta(seconds=90 + i)).isoformat(sep=" "),
+            "time": started.isoformat(sep=" "),
+            "duration": 90 + i,
+            "url": f"https://recordings.example.com/{i}.wav?token=abcdef",
+            "geo_id": "na",
+            "size": 4096 * (i + 1),
+        }
+        for i in range(count)
+    ]
+
+
+def make_call_transcripts_payload(count: int) -> Dict[str, Any]:
+    """Peerlogic API paginated call transcripts response."""
+    results = [
+        {
+            "id": f"transcript{i:014d}",
+            "signed_url": f"https://storage.googleapis.com/bucket/{i}.txt?X-Goog-Signature=abcdef",
+            "transcript_type": "full_text",
+            "raw_call_transcript_model_run_id": f"run{i:019d}",
+        }
+        for i in range(count)
+    ]
+    return {"count": count, "results": results}
+
+
+def make_audio_ready_event(rng: random.Random) -> Tuple[Dict, Dict[str, str]]:
+    """Returns a Pub/Sub background event like the one the function receives, and its identifiers."""
+    identifiers = {"call_id": make_shortuuid(rng), "partial_id": make_shortuuid(rng), "audio_partial_id": make_shortuuid(rng)}
+    event = {
+        "data": base64.b64encode(json.dumps(identifiers).encode("utf-8")).decode("ascii"),
+        "attributes": {"call_id": identifiers["call_id"]},
+    }
+    return event, identifiers
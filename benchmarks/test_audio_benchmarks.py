@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+from audio_conversion import MAX_WAV_HEADER_BYTES, negotiate_speech_format, parse_wav_header, wav_codec_to_pcm_s16le
+from conftest import get_wav_bytes, requires_ffmpeg
+from local_file_helpers import get_sample_rate
+
+ENCODINGS = ["pcm", "mulaw"]
+SAMPLE_RATES = [8000, 16000]
+DURATIONS_SECONDS = [10, 60]
+
+
+@pytest.mark.parametrize("duration_seconds", DURATIONS_SECONDS)
+@pytest.mark.parametrize("sample_rate", SAMPLE_RATES)
+def test_get_sample_rate(benchmark, wav_path, sample_rate, duration_seconds):
+    # the wave module only reads PCM, so there's no µ-law variant
+    path = wav_path("pcm", sample_rate, duration_seconds)
+
+    assert benchmark(get_sample_rate, path) == sample_rate
+
+
+@pytest.mark.parametrize("sample_rate", SAMPLE_RATES)
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_parse_wav_header_and_negotiate_speech_format(benchmark, encoding, sample_rate):
+    wav_bytes = get_wav_bytes(encoding, sample_rate, DURATIONS_SECONDS[0])
+
+    def negotiate():
+        header = parse_wav_header(wav_bytes[:MAX_WAV_HEADER_BYTES])
+        return negotiate_speech_format(header, file_size=len(wav_bytes))
+
+    decision = benchmark(negotiate)
+
+    assert decision.action
+
+
+@requires_ffmpeg
+@pytest.mark.parametrize("duration_seconds", DURATIONS_SECONDS)
+@pytest.mark.parametrize("sample_rate", SAMPLE_RATES)
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_wav_codec_to_pcm_s16le(benchmark, wav_path, encoding, sample_rate, duration_seconds):
+    path = wav_path(encoding, sample_rate, duration_seconds)
+
+    # each round runs ffmpeg, a few rounds are enough to see a change
+    encoded_path, _ = benchmark.pedantic(wav_codec_to_pcm_s16le, args=(path, "benchmark-encoded"), rounds=3, iterations=1)
+
+    assert os.path.getsize(encoded_path) > 0
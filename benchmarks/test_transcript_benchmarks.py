@@ -0,0 +1,116 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from conftest import get_raw_extract
+from procedure_keywords import DEFAULT_PROCEDURE_VOCABULARY, ProcedureKeywordMatcher
+from speech_to_text import get_channel_segregated_transcripts, get_transcript_words, order_transcript_words_by_start_time
+from transcript_index import TranscriptIndex
+from transcript_merge import MergedCallTranscript
+from transcript_prettifiers import format_transcript
+
+WORD_COUNTS = [500, 5000]  # roughly a 3 minute and a 30 minute call
+CHANNEL_COUNTS = [1, 2]
+PROCEDURE_VOCABULARY_SIZES = [len(DEFAULT_PROCEDURE_VOCABULARY), 500]
+PARTIAL_COUNTS = [2, 20]
+PARTIAL_WORD_COUNT = 500
+PARTIAL_SECONDS = 300  # longer than a synthetic partial of PARTIAL_WORD_COUNT words, so partials don't overlap
+
+
+def make_procedure_vocabulary(size: int):
+    # the default vocabulary, padded with made up multi-word procedures that share prefixes with it
+    vocabulary = dict(DEFAULT_PROCEDURE_VOCABULARY)
+    for i in range(size - len(vocabulary)):
+        vocabulary[f"procedure {i}"] = [f"root procedure {i}", f"deep procedure {i} variant"]
+    return vocabulary
+
+
+@pytest.mark.parametrize("channel_count", CHANNEL_COUNTS)
+@pytest.mark.parametrize("word_count", WORD_COUNTS)
+def test_order_transcript_words_by_start_time(benchmark, word_count, channel_count):
+    raw_extract = get_raw_extract(word_count, channel_count)
+
+    ordered_words = benchmark(order_transcript_words_by_start_time, raw_extract)
+
+    assert 0 < len(ordered_words) <= word_count
+
+
+@pytest.mark.parametrize("channel_count", CHANNEL_COUNTS)
+@pytest.mark.parametrize("word_count", WORD_COUNTS)
+def test_get_channel_segregated_transcripts(benchmark, word_count, channel_count):
+    raw_extract = get_raw_extract(word_count, channel_count)
+
+    benchmark(get_channel_segregated_transcripts, raw_extract)
+
+
+@pytest.mark.parametrize("word_count", WORD_COUNTS)
+def test_format_transcript(benchmark, word_count):
+    ordered_words = order_transcript_words_by_start_time(get_raw_extract(word_count, 2))
+
+    transcript = benchmark(format_transcript, ordered_words)
+
+    assert transcript
+
+
+@pytest.mark.parametrize("word_count", WORD_COUNTS)
+def test_get_transcript_words(benchmark, word_count):
+    raw_extract = get_raw_extract(word_count, 2)
+
+    transcript_words = benchmark(get_transcript_words, raw_extract)
+
+    assert len(transcript_words) == word_count
+
+
+@pytest.mark.parametrize("vocabulary_size", PROCEDURE_VOCABULARY_SIZES)
+@pytest.mark.parametrize("word_count", WORD_COUNTS)
+def test_find_procedure_keyword_matches(benchmark, word_count, vocabulary_size):
+    # scan time should stay flat as the vocabulary grows
+    matcher = ProcedureKeywordMatcher(make_procedure_vocabulary(vocabulary_size))
+    transcript_words = get_transcript_words(get_raw_extract(word_count, 2))
+
+    matches = benchmark(matcher.find_matches, transcript_words)
+
+    assert {match.keyword for match in matches} <= set(DEFAULT_PROCEDURE_VOCABULARY)
+
+
+@pytest.mark.parametrize("partial_count", PARTIAL_COUNTS)
+def test_merge_late_call_partial(benchmark, partial_count):
+    # the cost of one more partial should be about its own size, not the whole call's
+    call_start_time = datetime(2022, 1, 1, tzinfo=timezone.utc)
+    raw_extract = get_raw_extract(PARTIAL_WORD_COUNT, 2)
+
+    def merge():
+        merged = MergedCallTranscript(call_start_time)
+        for i in range(1, partial_count):
+            merged.add_partial(f"partial{i}", call_start_time + timedelta(seconds=i * PARTIAL_SECONDS), raw_extract)
+        return merged
+
+    def merge_late_partial(merged):
+        return merged.add_partial("partial0", call_start_time, raw_extract)
+
+    added = benchmark.pedantic(merge_late_partial, setup=lambda: ((merge(),), {}), rounds=50)
+
+    assert added == PARTIAL_WORD_COUNT
+
+
+@pytest.mark.parametrize("word_count", WORD_COUNTS)
+def test_build_transcript_index(benchmark, word_count):
+    transcript_words = get_transcript_words(get_raw_extract(word_count, 2))
+
+    index = benchmark(TranscriptIndex, transcript_words)
+
+    assert len(index) == word_count
+
+
+@pytest.mark.parametrize("word_count", WORD_COUNTS)
+def test_transcript_index_lookups(benchmark, word_count):
+    # a 30 second window on one channel, and the word nearest its middle
+    index = TranscriptIndex(get_transcript_words(get_raw_extract(word_count, 2)))
+    middle = index.end_times[-1] / 2
+
+    def lookup():
+        return index.get_words_between(middle - 15, middle + 15, channel_tag=2), index.get_nearest_word(middle)
+
+    words, nearest = benchmark(lookup)
+
+    assert words and nearest
@@ -0,0 +1,85 @@
+from datetime import datetime
+
+import pytest
+
+from netsapiens_api_client import transform_to_netsapiens_recording_urls
+from peerlogic_api_client import (
+    transform_to_bytes,
+    transform_to_call_transcript,
+    transform_to_netsapiens_api_credentials,
+    transform_to_telecom_caller_name_info,
+)
+from synthetic import make_call_transcripts_payload, make_json_response, make_pcm_wav_bytes, make_recording_urls_payload
+
+ITEM_COUNTS = [10, 200]
+
+
+def make_netsapiens_api_credentials_payload():
+    return {
+        "count": 1,
+        "results": [
+            {
+                "id": "credentials00000000000",
+                "created_at": datetime(2022, 1, 1).isoformat(),
+                "created_by": None,
+                "modified_at": datetime(2022, 1, 2).isoformat(),
+                "modified_by": None,
+                "voip_provider": "voipprovider000000000",
+                "api_url": "https://pbx.example.com/ns-api/",
+                "client_id": "benchmark",
+                "client_secret": "benchmark",
+                "username": "1234@example",
+                "password": "benchmark",
+                "active": True,
+            }
+        ],
+    }
+
+
+def make_telecom_caller_name_info_payload():
+    return {
+        "created_at": datetime(2022, 1, 1).isoformat(),
+        "modified_at": datetime(2022, 1, 2).isoformat(),
+        "phone_number": "+12345678900",
+        "caller_name": "PEERLOGIC DENTAL",
+        "caller_name_type": "business",
+        "source": "twilio",
+        "carrier_name": "Vonage/Nexmo - Sybase365",
+        "carrier_type": "voip",
+        "mobile_country_code": None,
+        "mobile_network_code": None,
+    }
+
+
+@pytest.mark.parametrize("item_count", ITEM_COUNTS)
+def test_transform_to_netsapiens_recording_urls(benchmark, response_decoding_mode, item_count):
+    response = make_json_response(make_recording_urls_payload(item_count))
+
+    assert len(benchmark(transform_to_netsapiens_recording_urls, response)) == item_count
+
+
+@pytest.mark.parametrize("item_count", ITEM_COUNTS)
+def test_transform_to_call_transcript(benchmark, response_decoding_mode, item_count):
+    response = make_json_response(make_call_transcripts_payload(item_count))
+
+    assert len(benchmark(transform_to_call_transcript, response)) == item_count
+
+
+def test_transform_to_netsapiens_api_credentials(benchmark, response_decoding_mode):
+    response = make_json_response(make_netsapiens_api_credentials_payload())
+
+    assert benchmark(transform_to_netsapiens_api_credentials, response).active
+
+
+def test_transform_to_telecom_caller_name_info(benchmark, response_decoding_mode):
+    response = make_json_response(make_telecom_caller_name_info_payload())
+
+    assert benchmark(transform_to_telecom_caller_name_info, response).is_business()
+
+
+def test_transform_to_bytes(benchmark):
+    wav_bytes = make_pcm_wav_bytes(10)
+    response = make_json_response(None)
+    response._content = wav_bytes
+
+    assert benchmark(transform_to_bytes, response) == wav_bytes
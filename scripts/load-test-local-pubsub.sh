@@ -0,0 +1,11 @@
+#! /bin/bash
+
+ROOT="$( pwd )"
+
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
+
+source "${ROOT}/.env"
+
+python scripts/load_generator.py \
+  --url="http://localhost:${FUNCTION_PORT_PUBSUB}" \
+  "$@"
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Synthetic Pub/Sub load against the function running locally under functions-framework (./scripts/run-local-pubsub.sh).
+
+Each request is the envelope from scripts/payloads/test-local-pubsub-payload.json carrying a fresh base64 encoded
+AudioReady message. Closed loop (default): --concurrency senders each send back to back, optionally paced to a total
+of --rate per second. Open loop (--arrivals poisson): requests arrive as a Poisson process at --rate per second whether
+or not earlier ones have finished, and latency is measured from the scheduled arrival so queueing in the function counts.
+Reports throughput, error rate and latency percentiles.
+
+Usage: python scripts/load_generator.py [--requests 200] [--concurrency 8] [--rate 20] [--arrivals closed|poisson] [--url http://localhost:5001]
+"""
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import json
+import os
+import random
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+import requests
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SCRIPTS_DIR, "..", "benchmarks"))
+
+from synthetic import make_audio_ready_event  # noqa: E402
+
+PAYLOAD_TEMPLATE_PATH = os.path.join(SCRIPTS_DIR, "payloads", "test-local-pubsub-payload.json")
+
+ARRIVALS_CLOSED = "closed"
+ARRIVALS_POISSON = "poisson"
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+
+def make_envelopes(count: int, seed: int, template_path: str = PAYLOAD_TEMPLATE_PATH) -> List[Dict]:
+    """Background function envelopes like test-local-pubsub.sh sends, each with its own ids and event id."""
+    with open(template_path, "r") as f:
+        template = json.load(f)
+
+    rng = random.Random(seed)
+    envelopes = []
+    for i in range(count):
+        event, _ = make_audio_ready_event(rng)
+        envelope = copy.deepcopy(template)
+        envelope["eventId"] = f"load-{seed}-{i}"
+        envelope["data"]["data"] = event["data"]
+        envelope["data"]["attributes"] = {**envelope["data"].get("attributes", {}), **event["attributes"]}
+        envelope["data"]["messageId"] = f"load-{seed}-{i}"
+        envelopes.append(envelope)
+    return envelopes
+
+
+class LoadResults(object):
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.latencies: List[float] = []
+        self.statuses: Counter = Counter()
+        self.errors: List[str] = []
+
+    def record(self, latency: float, status: Optional[int], error: Optional[str] = None) -> None:
+        with self._lock:
+            self.latencies.append(latency)
+            self.statuses[status if status is not None else "exception"] += 1
+            if error is not None:
+                self.errors.append(error)
+
+
+def send(session: requests.Session, url: str, envelope: Dict, scheduled_at: float, timeout: float, results: LoadResults) -> None:
+    try:
+        response = session.post(url, json=envelope, timeout=timeout)
+        error = None if response.ok else f"status_code={response.status_code} body={response.text[:200]!r}"
+        results.record(time.perf_counter() - scheduled_at, response.status_code, error)
+    except requests.exceptions.RequestException as e:
+        results.record(time.perf_counter() - scheduled_at, None, f"{type(e).__name__}: {e}")
+
+
+def run(url: str, requests_count: int, concurrency: int, rate: Optional[float], arrivals: str, timeout: float, seed: int) -> Dict:
+    envelopes = make_envelopes(requests_count, seed)
+    results = LoadResults()
+    sessions = threading.local()
+
+    def get_session() -> requests.Session:
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+        return sessions.session
+
+    started = time.perf_counter()
+    if arrivals == ARRIVALS_POISSON:
+        if not rate:
+            raise ValueError("--rate is required for poisson arrivals")
+        rng = random.Random(seed)
+        # arrivals keep to their schedule regardless of responses, the pool only caps how many are in flight
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            arrival_at = started
+            for envelope in envelopes:
+                arrival_at += rng.expovariate(rate)
+                delay = arrival_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(lambda e=envelope, a=arrival_at: send(get_session(), url, e, a, timeout, results))
+    else:
+        next_index = iter(range(requests_count))
+        index_lock = threading.Lock()
+
+        def sender() -> None:
+            while True:
+                with index_lock:
+                    index = next(next_index, None)
+                if index is None:
+                    return
+                scheduled_at = started + index / rate if rate else time.perf_counter()
+                delay = scheduled_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                send(get_session(), url, envelopes[index], max(scheduled_at, started), timeout, results)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for _ in range(concurrency):
+                executor.submit(sender)
+    elapsed = time.perf_counter() - started
+
+    latencies = results.latencies
+    error_count = sum(count for status, count in results.statuses.items() if status == "exception" or not 200 <= status < 300)
+    return {
+        "url": url,
+        "arrivals": arrivals,
+        "requests": len(latencies),
+        "concurrency": concurrency,
+        "rate": rate,
+        "elapsed_seconds": elapsed,
+        "throughput_per_second": len(latencies) / elapsed if elapsed else None,
+        "errors": error_count,
+        "error_rate": error_count / len(latencies) if latencies else None,
+        "statuses": {str(status): count for status, count in results.statuses.items()},
+        "first_errors": results.errors[:5],
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50) * 1000,
+            "p95": percentile(latencies, 0.95) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "max": max(latencies) * 1000,
+        }
+        if latencies
+        else None,
+    }
+
+
+def print_report(report: Dict) -> None:
+    print(
+        f"url={report['url']} arrivals={report['arrivals']} requests={report['requests']} concurrency={report['concurrency']} rate={report['rate']} "
+        f"elapsed={report['elapsed_seconds']:.2f}s throughput={report['throughput_per_second']:.1f}/s "
+        f"errors={report['errors']} error_rate={report['error_rate']:.2%}"
+    )
+    print(f"statuses: {report['statuses']}")
+    for error in report["first_errors"]:
+        print(f"  error: {error}")
+    if report["latency_ms"]:
+        latency = report["latency_ms"]
+        print(f"latency ms p50={latency['p50']:.1f} p95={latency['p95']:.1f} p99={latency['p99']:.1f} max={latency['max']:.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=f"http://localhost:{os.getenv('FUNCTION_PORT_PUBSUB', '8080')}")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8, help="Closed loop senders, or the most requests in flight for poisson arrivals")
+    parser.add_argument("--rate", type=float, help="Requests per second in total. Closed loop is unpaced without it")
+    parser.add_argument("--arrivals", choices=[ARRIVALS_CLOSED, ARRIVALS_POISSON], default=ARRIVALS_CLOSED)
+    parser.add_argument("--timeout", type=float, default=600.0, help="Per request, in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Write the report to this path as JSON")
+    args = parser.parse_args()
+
+    report = run(args.url, args.requests, args.concurrency, args.rate, args.arrivals, args.timeout, args.seed)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,16 @@
+#! /bin/bash
+
+ROOT="$( pwd )"
+
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
+
+BENCHMARK_STORAGE="${BENCHMARK_STORAGE:-${ROOT}/.benchmarks}"
+
+ARGS=(--benchmark-only --benchmark-autosave --benchmark-storage="file://${BENCHMARK_STORAGE}")
+
+# compare against the last saved run, failing when a mean regresses by more than BENCHMARK_COMPARE_FAIL_PERCENT
+if ls "${BENCHMARK_STORAGE}"/*/*.json > /dev/null 2>&1; then
+  ARGS+=(--benchmark-compare --benchmark-compare-fail="mean:${BENCHMARK_COMPARE_FAIL_PERCENT:-10}%")
+fi
+
+python -m pytest benchmarks "${ARGS[@]}" "$@"
@@ -0,0 +1,12 @@
+#! /bin/bash
+
+ROOT="$( pwd )"
+
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
+
+source "${ROOT}/.env"
+
+python src/pull_worker.py \
+  --subscription="projects/${PROJECT_ID}/subscriptions/${PUBSUB_SUBSCRIPTION}" \
+  --max-concurrency=${PULL_WORKER_MAX_CONCURRENCY:-8} \
+  "$@"
@@ -1,11 +1,28 @@
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from functools import wraps
 import logging
+import random
+import threading
+import time
 from typing import (
+    Any,
     Callable,
+    Collection,
+    List,
+    Optional,
 )
 
 import requests
 import requests.compat
+from urllib3.exceptions import NewConnectionError
+
+from http_metrics import (
+    HTTPMetrics,
+    default_http_metrics,
+    instrument_session,
+)
+from http_record_replay import install_cassette_from_environment
 
 
 log = logging.getLogger(__name__)
@@ -19,9 +36,164 @@ class APIClientAuthorizationError(Exception):
     pass
 
 
+# Statuses which are worth retrying since they are typically transient
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+# Statuses where the server tells us it rejected the request before doing any work,
+# so it's safe to retry even non-idempotent requests like POST and PATCH
+REJECTED_BEFORE_PROCESSING_STATUS_CODES = frozenset({429, 503})
+
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE"})
+
+# Non-idempotent requests carrying this header can be retried since the server de-duplicates them
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+
+
+class RetryPolicy(object):
+    """
+    Decides whether a failed request should be retried and how long to wait before doing so.
+
+    Backoff is exponential with full jitter. A Retry-After sent by the server is honored as a floor,
+    unless it's longer than max_retry_after_seconds, in which case we give up and let the caller fail.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 4,
+        backoff_base_seconds: float = 0.05,
+        backoff_max_seconds: float = 5.0,
+        max_retry_after_seconds: float = 30.0,
+        retryable_status_codes: Collection[int] = RETRYABLE_STATUS_CODES,
+        sleep: Callable[[float], None] = time.sleep,
+        random: Callable[[], float] = random.random,
+    ) -> None:
+        self.max_attempts = max_attempts
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.max_retry_after_seconds = max_retry_after_seconds
+        self.retryable_status_codes = frozenset(retryable_status_codes)
+        self.sleep = sleep
+        self.random = random
+
+    def is_retryable_response(self, response: requests.Response) -> bool:
+        status_code = response.status_code
+        if status_code not in self.retryable_status_codes:
+            return False
+
+        if is_idempotent_request(response.request) or status_code in REJECTED_BEFORE_PROCESSING_STATUS_CODES:
+            return True
+
+        log.info(f"Not retrying non-idempotent request for status_code='{status_code}' since it may have been processed.")
+        return False
+
+    def is_retryable_exception(self, exception: requests.exceptions.RequestException) -> bool:
+        if isinstance(exception, requests.exceptions.HTTPError):
+            return exception.response is not None and self.is_retryable_response(exception.response)
+
+        if is_connection_never_established(exception):
+            return True  # nothing was sent, so any method is safe to retry
+
+        if isinstance(exception, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            # connection resets and read timeouts may happen after the server has acted on the request
+            return is_idempotent_request(exception.request)
+
+        return False
+
+    def get_delay(self, attempt: int, retry_after_seconds: Optional[float] = None) -> Optional[float]:
+        """Returns seconds to wait before the next attempt, or None if the server asked us to wait too long."""
+        if retry_after_seconds is not None and retry_after_seconds > self.max_retry_after_seconds:
+            return None
+
+        backoff_ceiling = min(self.backoff_max_seconds, self.backoff_base_seconds * (2 ** (attempt - 1)))
+        delay = self.random() * backoff_ceiling
+        if retry_after_seconds is not None:
+            delay = max(delay, retry_after_seconds)
+
+        return delay
+
+
+class TokenBucketRateLimiter(object):
+    """
+    Client-side token bucket, shared by all requests made through a client.
+
+    The bucket adapts to the server: when we're told to back off (429 with Retry-After), every caller
+    is paused rather than each one discovering the limit on its own.
+    """
+
+    def __init__(
+        self,
+        rate_per_second: float,
+        capacity: float = None,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ) -> None:
+        if rate_per_second <= 0:
+            raise ValueError(f"rate_per_second must be positive. rate_per_second='{rate_per_second}'")
+
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity if capacity is not None else max(1.0, rate_per_second)
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._updated_at = clock()
+        self._paused_until = 0.0
+
+    @classmethod
+    def from_netsapiens_rate_limit(cls, rate_limit: Optional[str]) -> Optional["TokenBucketRateLimiter"]:
+        """
+        Netsapiens reports rate_limit on its tokens as a string of requests per minute, where "0" means unlimited.
+        Returns None when there is no limit to enforce.
+        """
+        try:
+            requests_per_minute = int(rate_limit) if rate_limit else 0
+        except ValueError:
+            log.info(f"Ignoring unparseable Netsapiens rate_limit='{rate_limit}'")
+            return None
+
+        if requests_per_minute <= 0:
+            return None
+
+        return cls(rate_per_second=requests_per_minute / 60.0)
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        """Blocks until tokens are available. Returns the number of seconds spent waiting."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate_per_second)
+                self._updated_at = now
+
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                else:
+                    wait = (tokens - self._tokens) / self.rate_per_second
+
+            self._sleep(wait)
+            waited += wait
+
+    def pause(self, seconds: float) -> None:
+        """Stops handing out tokens for the given number of seconds and drains the bucket."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+            self._tokens = 0.0
+
+
 class APIClient(object):
-    def __init__(self, root_api_url: str = None) -> None:
+    def __init__(
+        self, root_api_url: str = None, retry_policy: RetryPolicy = None, rate_limiter: TokenBucketRateLimiter = None, metrics: HTTPMetrics = None
+    ) -> None:
         self._session = None
+        self.retry_policy = retry_policy if retry_policy else RetryPolicy()
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics if metrics else default_http_metrics
+
+        # called with every new session, e.g. to install a record/replay cassette
+        self.session_initializers: List[Callable[[requests.Session], Any]] = [install_cassette_from_environment]
 
         # normalize the base_url
         self.root_api_url = root_api_url
@@ -35,6 +207,13 @@ class APIClient(object):
     def root_api_url(self, value) -> None:
         self._root_api_url = value if value and value.endswith("/") else f"{value}/"
 
+    def create_session(self) -> requests.Session:
+        """All sessions must be created here so their requests are measured and can be recorded or replayed."""
+        session = instrument_session(requests.Session(), type(self).__name__, self.metrics)
+        for initialize_session in self.session_initializers:
+            initialize_session(session)
+        return session
+
     def login(self) -> requests.Response:
         raise NotImplementedError()
 
@@ -42,24 +221,151 @@ class APIClient(object):
         raise NotImplementedError()
 
 
+def is_idempotent_request(request: Optional[requests.PreparedRequest]) -> bool:
+    if request is None or not request.method:
+        return False  # can't tell what was sent, assume the worst
+
+    if request.method.upper() in IDEMPOTENT_METHODS:
+        return True
+
+    return bool(request.headers and request.headers.get(IDEMPOTENCY_KEY_HEADER))
+
+
+def is_connection_never_established(exception: requests.exceptions.RequestException) -> bool:
+    if isinstance(exception, requests.exceptions.ConnectTimeout):
+        return True
+
+    # requests wraps urllib3's MaxRetryError, whose reason tells us why the connection failed
+    reason = getattr(exception.args[0], "reason", None) if exception.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def find_request_exception(exception: BaseException) -> Optional[requests.exceptions.RequestException]:
+    """Walks the exception chain since our clients usually re-raise request errors with more context."""
+    seen = set()
+    while exception is not None and id(exception) not in seen:
+        if isinstance(exception, requests.exceptions.RequestException):
+            return exception
+        seen.add(id(exception))
+        exception = exception.__cause__ or exception.__context__
+
+    return None
+
+
+def get_retry_after_seconds(response: Optional[requests.Response]) -> Optional[float]:
+    """Parses the Retry-After header, which is either a number of seconds or an HTTP date."""
+    if response is None:
+        return None
+
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        log.info(f"Ignoring unparseable Retry-After header. retry_after='{retry_after}'")
+        return None
+
+
+def invoke_with_retries(client: APIClient, invoke: Callable[[], Any]) -> Any:
+    """
+    Calls invoke, retrying transient failures according to the client's retry policy.
+
+    Failures may be exceptions (anywhere in the chain) or returned responses with a retryable status.
+    Anything that isn't transient is passed through untouched.
+    """
+    retry_policy: RetryPolicy = client.retry_policy
+    rate_limiter: Optional[TokenBucketRateLimiter] = client.rate_limiter
+
+    attempt = 1
+    while True:
+        if rate_limiter:
+            rate_limiter.acquire()
+
+        try:
+            result = invoke()
+        except Exception as e:
+            request_exception = find_request_exception(e)
+            if attempt >= retry_policy.max_attempts or request_exception is None or not retry_policy.is_retryable_exception(request_exception):
+                raise
+
+            error = e
+            response = getattr(request_exception, "response", None)
+            failed_request = request_exception.request
+            failure = f"exception='{request_exception!r}'"
+        else:
+            error = None
+            response = result if isinstance(result, requests.Response) else None
+            if attempt >= retry_policy.max_attempts or response is None or not retry_policy.is_retryable_response(response):
+                return result
+
+            failed_request = response.request
+            failure = f"status_code='{response.status_code}'"
+
+        retry_after_seconds = get_retry_after_seconds(response)
+        delay = retry_policy.get_delay(attempt, retry_after_seconds)
+        if delay is None:
+            log.info(f"Not retrying since server asked us to wait too long. retry_after_seconds='{retry_after_seconds}' {failure}")
+            if error is not None:
+                raise error
+            return result
+
+        if rate_limiter and retry_after_seconds is not None:
+            rate_limiter.pause(retry_after_seconds)
+
+        if failed_request is not None:
+            client.metrics.record_retry(type(client).__name__, failed_request.method, failed_request.url)
+
+        log.info(f"Transient failure on attempt='{attempt}' of max_attempts='{retry_policy.max_attempts}'. Retrying in delay='{delay:.3f}s'. {failure}")
+        retry_policy.sleep(delay)
+        attempt += 1
+
+
+def with_retries(func) -> Callable:
+    """Retries transient failures of the decorated client method. Use this for methods that don't need requires_auth."""
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        return invoke_with_retries(self, lambda: func(self, *args, **kwargs))
+
+    return wrapper
+
+
 def requires_auth(func) -> Callable:
     @wraps(func)
     def wrapper(self, *args, **kwargs) -> requests.Response:
-        try:
+        def invoke() -> requests.Response:
+            return func(self, *args, **kwargs)
+
+        def invoke_and_check_statuses() -> requests.Response:
             log.info("Invoking function requiring auth.")
-            response: requests.Response = func(self, *args, **kwargs)  # attempt invocation
+            response: requests.Response = invoke()  # attempt invocation
             log.info("Invoked function requiring auth. Performing raise for status check.")
             raise_for_bad_auth_and_other_statuses(response)
             log.info("Auth status is good. Returning value from function.")
             return response
+
+        try:
+            return invoke_with_retries(self, invoke_and_check_statuses)
         except APIClientAuthenticationError as e:
             log.info("Authentication Error. Not logged in. Attempting to login and retrying function.")
+            self.metrics.record_auth_retry(type(self).__name__, "login")
             self.login()
-            return func(self, *args, **kwargs)  # re-attempt
+            return invoke_with_retries(self, invoke)  # re-attempt
         except APIClientAuthorizationError as e:
             log.info("Authorization Error. Token possibly expired. Attempting to refresh and retrying function.")
+            self.metrics.record_auth_retry(type(self).__name__, "refresh_token")
             self.refresh_token()
-            return func(self, *args, **kwargs)  # re-attempt
+            return invoke_with_retries(self, invoke)  # re-attempt
 
     return wrapper
 
@@ -1,5 +1,190 @@
 import os
+import struct
 import tempfile
+from typing import (
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+from urllib.parse import (
+    unquote,
+    urlsplit,
+)
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_ALAW = 0x0006
+WAVE_FORMAT_MULAW = 0x0007
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+MAX_WAV_HEADER_BYTES = 64 * 1024  # headers are usually 44 bytes, but LIST chunks may come first
+
+MAX_TRANSCRIBED_SECONDS = 1800  # longer audio is trimmed when transcoding
+
+# Speech to Text accepts LINEAR16 WAV files at these sample rates as they are
+SPEECH_MIN_SAMPLE_RATE_HERTZ = 8000
+SPEECH_MAX_SAMPLE_RATE_HERTZ = 48000
+
+SPEECH_FORMAT_PASSTHROUGH = "passthrough"  # Speech reads the original file
+SPEECH_FORMAT_REWRITE_HEADER = "rewrite_header"  # samples are fine, the header isn't, copy with a plain PCM header
+SPEECH_FORMAT_TRANSCODE = "transcode"  # decode and encode with ffmpeg
+
+
+class WavHeaderInfo(NamedTuple):
+    audio_format: int  # WAVE_FORMAT_*, for extensible files this is the sub format
+    channels: int
+    sample_rate: int
+    byte_rate: int
+    block_align: int
+    bits_per_sample: int
+    is_extensible: bool
+    data_offset: int  # where the samples start
+    data_size: int  # as declared, streaming writers sometimes leave this as 0 or 0xFFFFFFFF
+
+    @property
+    def duration_seconds(self) -> Optional[float]:
+        if not self.byte_rate or self.data_size in (0, 0xFFFFFFFF):
+            return None
+        return self.data_size / self.byte_rate
+
+
+def parse_wav_header(header: bytes) -> Optional[WavHeaderInfo]:
+    """
+    Parses the RIFF/WAVE header from the first bytes of a file, skipping any chunks before "data" (LIST, fact, etc).
+    Returns None if more bytes are needed to reach the data chunk. Raises ValueError if it isn't a WAV file.
+    """
+    if len(header) < 12:
+        return None
+    if header[0:4] != b"RIFF" or header[8:12] != b"WAVE":
+        raise ValueError("File does not start with a RIFF/WAVE header")
+
+    fmt = None
+    offset = 12
+    while offset + 8 <= len(header):
+        chunk_id = header[offset : offset + 4]
+        (chunk_size,) = struct.unpack_from("<I", header, offset + 4)
+        body_offset = offset + 8
+
+        if chunk_id == b"data":
+            if fmt is None:
+                raise ValueError("WAV data chunk found before fmt chunk")
+            return WavHeaderInfo(*fmt, data_offset=body_offset, data_size=chunk_size)
+
+        if chunk_id == b"fmt ":
+            if body_offset + 16 > len(header):
+                return None
+            audio_format, channels, sample_rate, byte_rate, block_align, bits_per_sample = struct.unpack_from("<HHIIHH", header, body_offset)
+            is_extensible = audio_format == WAVE_FORMAT_EXTENSIBLE
+            if is_extensible:
+                # the first two bytes of the sub format guid are the actual format
+                if body_offset + 26 > len(header):
+                    return None
+                (audio_format,) = struct.unpack_from("<H", header, body_offset + 24)
+            fmt = (audio_format, channels, sample_rate, byte_rate, block_align, bits_per_sample, is_extensible)
+
+        offset = body_offset + chunk_size + (chunk_size % 2)  # chunks are word aligned
+
+    return None
+
+
+class SpeechFormatDecision(NamedTuple):
+    action: str  # SPEECH_FORMAT_*
+    reason: str
+
+
+def negotiate_speech_format(
+    header: Optional[WavHeaderInfo], file_size: int = None, max_duration_seconds: float = MAX_TRANSCRIBED_SECONDS
+) -> SpeechFormatDecision:
+    """Decides the least work needed to turn audio with this header into 16-bit PCM WAV that Speech to Text accepts."""
+    if header is None:
+        return SpeechFormatDecision(SPEECH_FORMAT_TRANSCODE, "no parsable WAV header")
+
+    if header.audio_format != WAVE_FORMAT_PCM or header.bits_per_sample != 16:
+        return SpeechFormatDecision(SPEECH_FORMAT_TRANSCODE, f"audio_format={header.audio_format} bits_per_sample={header.bits_per_sample} is not 16-bit PCM")
+
+    if not SPEECH_MIN_SAMPLE_RATE_HERTZ <= header.sample_rate <= SPEECH_MAX_SAMPLE_RATE_HERTZ:
+        return SpeechFormatDecision(SPEECH_FORMAT_TRANSCODE, f"sample_rate={header.sample_rate} is not supported by Speech to Text")
+
+    duration_seconds = header.duration_seconds
+    is_data_size_declared = duration_seconds is not None
+    if not is_data_size_declared and file_size is not None and header.byte_rate:
+        duration_seconds = (file_size - header.data_offset) / header.byte_rate
+
+    if duration_seconds is None:
+        return SpeechFormatDecision(SPEECH_FORMAT_TRANSCODE, "duration unknown, it may need trimming")
+    if duration_seconds > max_duration_seconds:
+        return SpeechFormatDecision(SPEECH_FORMAT_TRANSCODE, f"duration_seconds={duration_seconds:.1f} needs trimming to {max_duration_seconds}")
+
+    if header.is_extensible:
+        return SpeechFormatDecision(SPEECH_FORMAT_REWRITE_HEADER, "WAVE_FORMAT_EXTENSIBLE header around 16-bit PCM")
+    if not is_data_size_declared:
+        return SpeechFormatDecision(SPEECH_FORMAT_REWRITE_HEADER, "data size not declared in header")
+
+    return SpeechFormatDecision(SPEECH_FORMAT_PASSTHROUGH, "already 16-bit PCM")
+
+
+def build_pcm_wav_header(channels: int, sample_rate: int, data_size: int, bits_per_sample: int = 16) -> bytes:
+    block_align = channels * bits_per_sample // 8
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF",
+        36 + data_size,
+        b"WAVE",
+        b"fmt ",
+        16,
+        WAVE_FORMAT_PCM,
+        channels,
+        sample_rate,
+        sample_rate * block_align,
+        block_align,
+        bits_per_sample,
+        b"data",
+        data_size,
+    )
+
+
+def rewrite_wav_header_to_pcm(path: str, header: WavHeaderInfo, encoded_subfolder: str = "encoded") -> Tuple[str, str]:
+    """Copies the samples behind a plain PCM header, no decoding. Same return values as wav_codec_to_pcm_s16le."""
+    file_basename = os.path.basename(path)
+    encoded_folderpath = os.path.join(tempfile.gettempdir(), encoded_subfolder)
+    if not os.path.exists(encoded_folderpath):
+        os.makedirs(encoded_folderpath)
+    encoded_filepath = os.path.join(encoded_folderpath, file_basename)
+
+    data_size = os.path.getsize(path) - header.data_offset
+    if header.data_size not in (0, 0xFFFFFFFF):
+        data_size = min(data_size, header.data_size)  # ignore trailing chunks
+    data_size -= data_size % header.block_align
+
+    with open(path, "rb") as source, open(encoded_filepath, "wb") as destination:
+        destination.write(build_pcm_wav_header(header.channels, header.sample_rate, data_size, header.bits_per_sample))
+        source.seek(header.data_offset)
+        remaining = data_size
+        while remaining > 0:
+            chunk = source.read(min(1024 * 1024, remaining))
+            if not chunk:
+                break
+            destination.write(chunk)
+            remaining -= len(chunk)
+
+    return encoded_filepath, file_basename
+
+
+def get_gcs_uri_from_signed_url(signed_url: str) -> Optional[str]:
+    """gs:// uri of the object a GCS signed url points at, so Speech can read it directly. None for other urls."""
+    parts = urlsplit(signed_url)
+    host = parts.hostname or ""
+    path = unquote(parts.path).lstrip("/")
+
+    if host == "storage.googleapis.com":
+        bucket, _, blob_name = path.partition("/")
+    elif host.endswith(".storage.googleapis.com"):
+        bucket, blob_name = host[: -len(".storage.googleapis.com")], path
+    else:
+        return None
+
+    if not bucket or not blob_name:
+        return None
+    return f"gs://{bucket}/{blob_name}"
 
 
 def wav_codec_to_pcm_s16le(path: str, encoded_subfolder: str = "encoded"):
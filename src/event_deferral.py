@@ -0,0 +1,104 @@
+import base64
+import json
+import logging
+import os
+import time
+from typing import (
+    Callable,
+    Dict,
+    Optional,
+)
+
+
+log = logging.getLogger(__name__)
+
+NOT_BEFORE_ATTRIBUTE = "not_before"  # seconds since epoch
+
+PUBSUB_SCOPE = "https://www.googleapis.com/auth/pubsub"
+
+# schedule(data, attributes, deliver_at) must return once delivery at deliver_at (seconds since epoch) is arranged
+Schedule = Callable[[bytes, Dict[str, str], float], None]
+
+
+def create_cloud_tasks_schedule(queue_path: str, topic_path: str, service_account_email: str) -> Schedule:
+    """
+    Schedules an HTTP task that publishes the message to topic_path at deliver_at, authenticated as service_account_email,
+    which needs roles/pubsub.publisher on the topic. The queue's own retry config covers failed publishes.
+    """
+    from google.cloud import tasks_v2  # only needed where deferral is enabled
+    from google.protobuf import timestamp_pb2
+
+    client = tasks_v2.CloudTasksClient()
+    url = f"https://pubsub.googleapis.com/v1/{topic_path}:publish"
+
+    def schedule(data: bytes, attributes: Dict[str, str], deliver_at: float) -> None:
+        body = {"messages": [{"data": base64.b64encode(data).decode("ascii"), "attributes": attributes}]}
+        schedule_time = timestamp_pb2.Timestamp()
+        schedule_time.FromNanoseconds(int(deliver_at * 1e9))
+        task = {
+            "http_request": {
+                "http_method": tasks_v2.HttpMethod.POST,
+                "url": url,
+                "headers": {"Content-Type": "application/json"},
+                "body": json.dumps(body).encode("utf-8"),
+                "oauth_token": {"service_account_email": service_account_email, "scope": PUBSUB_SCOPE},
+            },
+            "schedule_time": schedule_time,
+        }
+        client.create_task(request={"parent": queue_path, "task": task})
+
+    return schedule
+
+
+class EventDeferral(object):
+    """
+    Delivers a Pub/Sub event again later, e.g. when Speech-to-Text quota is used up or another delivery holds the work,
+    instead of failing it and leaving Pub/Sub to redeliver it straight away.
+
+    Pub/Sub can't delay delivery, so the event is handed to a Cloud Tasks queue whose task publishes it back to the topic
+    at its schedule_time, with a not_before attribute. The invocation returns as soon as the task is created, nothing
+    waits in the function. A redelivery that still arrives early (Cloud Tasks may run a task a little before its time,
+    or Pub/Sub may redeliver the old message) is scheduled again for the remainder.
+    """
+
+    def __init__(self, schedule: Schedule, early_tolerance_seconds: float = 1.0, clock: Callable[[], float] = time.time) -> None:
+        self._schedule = schedule
+        self.early_tolerance_seconds = early_tolerance_seconds
+        self._clock = clock
+
+    @classmethod
+    def from_environment(cls) -> Optional["EventDeferral"]:
+        """
+        Enabled by EVENT_DEFERRAL_QUEUE, projects/<project>/locations/<location>/queues/<queue>. EVENT_DEFERRAL_TOPIC is
+        the topic to deliver to, usually the one the function is triggered by, and EVENT_DEFERRAL_SERVICE_ACCOUNT the
+        service account the tasks publish as.
+        """
+        queue_path = os.getenv("EVENT_DEFERRAL_QUEUE")
+        if not queue_path:
+            return None
+
+        topic = os.environ["EVENT_DEFERRAL_TOPIC"]
+        topic_path = topic if topic.startswith("projects/") else f"projects/{os.environ['PROJECT_ID']}/topics/{topic}"
+        return cls(create_cloud_tasks_schedule(queue_path, topic_path, os.environ["EVENT_DEFERRAL_SERVICE_ACCOUNT"]))
+
+    def get_remaining_seconds(self, event: Dict) -> float:
+        """How long until the event is due, 0 if it is or was never deferred."""
+        not_before = (event.get("attributes") or {}).get(NOT_BEFORE_ATTRIBUTE)
+        if not not_before:
+            return 0.0
+        return max(0.0, float(not_before) - self._clock())
+
+    def defer(self, event: Dict, delay_seconds: float, reason: str, attributes: Dict[str, str] = None) -> None:
+        """Schedules the event to be delivered again after delay_seconds, with attributes added to its own."""
+        deliver_at = self._clock() + delay_seconds
+        attributes = {**(event.get("attributes") or {}), **(attributes or {}), NOT_BEFORE_ATTRIBUTE: f"{deliver_at:.3f}"}
+        log.info(f"Deferring event by {delay_seconds:.1f}s. Reason: {reason}")
+        self._schedule(base64.b64decode(event["data"]), attributes, deliver_at)
+
+    def defer_if_early(self, event: Dict) -> bool:
+        """Returns True if the event isn't due yet and was scheduled again for the remainder, in which case it's done with."""
+        remaining = self.get_remaining_seconds(event)
+        if remaining <= self.early_tolerance_seconds:
+            return False
+        self.defer(event, remaining, "delivered before its not_before")
+        return True
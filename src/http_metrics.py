@@ -0,0 +1,277 @@
+from bisect import bisect_left
+import json
+import logging
+import re
+import threading
+import weakref
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+from urllib.parse import (
+    parse_qsl,
+    urlsplit,
+)
+
+import requests
+
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS_SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+SHORTUUID_ALPHABET = "23456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+ID_PATH_SEGMENT = re.compile(
+    rf"^(?:"
+    rf"[0-9]+"  # numeric ids
+    rf"|[{SHORTUUID_ALPHABET}]{{22}}"  # shortuuids used by the Peerlogic API
+    rf"|[0-9a-fA-F]{{8}}-[0-9a-fA-F]{{4}}-[0-9a-fA-F]{{4}}-[0-9a-fA-F]{{4}}-[0-9a-fA-F]{{12}}"  # uuids
+    rf"|\+?[0-9()\-. %]{{7,}}"  # phone numbers, e.g. telecom caller name info lookups
+    rf")$"
+)
+
+# Netsapiens routes everything through one url, the endpoint is identified by these query parameters
+ENDPOINT_QUERY_PARAMETERS = ("object", "action")
+
+# Signed urls are unique per object, so they are all grouped together per host
+SIGNED_URL_HOSTS = ("storage.googleapis.com",)
+
+
+def get_endpoint_template(url: str) -> str:
+    """Collapses a url to the endpoint it calls, e.g. https://host/api/calls/<id>/partials/ becomes host/api/calls/{id}/partials/"""
+    parts = urlsplit(url)
+    host = parts.hostname or ""
+
+    if host in SIGNED_URL_HOSTS:
+        return f"{host}/{{bucket}}/{{object}}"
+
+    path = "/".join("{id}" if ID_PATH_SEGMENT.match(segment) else segment for segment in parts.path.split("/"))
+    template = f"{host}{path}"
+
+    query = dict(parse_qsl(parts.query))
+    endpoint_query = "&".join(f"{name}={query[name]}" for name in ENDPOINT_QUERY_PARAMETERS if name in query)
+    if endpoint_query:
+        template = f"{template}?{endpoint_query}"
+
+    return template
+
+
+def get_request_body_size(request: requests.PreparedRequest) -> int:
+    content_length = request.headers.get("Content-Length")
+    if content_length:
+        return int(content_length)
+
+    body = request.body
+    if isinstance(body, (bytes, str)):
+        return len(body)
+
+    return 0  # streamed with chunked transfer encoding, size isn't known up front
+
+
+def get_response_body_size(response: requests.Response) -> int:
+    content_length = response.headers.get("Content-Length")
+    if content_length and content_length.isdigit():
+        return int(content_length)
+
+    return 0  # chunked, counting it would mean consuming the stream
+
+
+class Histogram(object):
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS_SECONDS) -> None:
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket containing the q-th quantile, or None if there are no observations."""
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), self.bucket_counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+
+class EndpointStats(object):
+    def __init__(self) -> None:
+        self.latency = Histogram()
+        self.status_counts: Dict[int, int] = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.retries = 0
+
+
+class HTTPMetrics(object):
+    """
+    Thread-safe registry of HTTP metrics for API client sessions. Counters are cumulative for the life of the process.
+
+    Endpoints are keyed by (client, method, endpoint template) where ids are removed from the url.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._endpoints: Dict[Tuple[str, str, str], EndpointStats] = {}
+        self._auth_retries: Dict[Tuple[str, str], int] = {}
+        self._connections: Dict[Tuple[str, str], Dict[str, int]] = {}
+        # urllib3 pool -> num_connections. Weak, so counts go away with their pool and a recycled id can't inherit them
+        self._pool_connection_counts: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def _get_endpoint_stats(self, client: str, method: str, url: str) -> EndpointStats:
+        key = (client, method, get_endpoint_template(url))
+        stats = self._endpoints.get(key)
+        if stats is None:
+            stats = self._endpoints[key] = EndpointStats()
+        return stats
+
+    def record_response(self, client: str, response: requests.Response) -> None:
+        request = response.request
+        method = request.method or "UNKNOWN"
+        is_new_connection = self._is_new_connection(response)
+
+        with self._lock:
+            stats = self._get_endpoint_stats(client, method, request.url)
+            stats.latency.observe(response.elapsed.total_seconds())
+            stats.status_counts[response.status_code] = stats.status_counts.get(response.status_code, 0) + 1
+            stats.bytes_in += get_response_body_size(response)
+            stats.bytes_out += get_request_body_size(request)
+
+            if is_new_connection is not None:
+                connections = self._connections.setdefault((client, urlsplit(request.url).hostname or ""), {"new": 0, "reused": 0})
+                connections["new" if is_new_connection else "reused"] += 1
+
+    def _is_new_connection(self, response: requests.Response) -> Optional[bool]:
+        # urllib3 pools count the connections they've opened, if that went up this request needed a new one
+        pool = getattr(response.raw, "_pool", None)
+        num_connections = getattr(pool, "num_connections", None)
+        if num_connections is None:
+            return None
+
+        with self._lock:
+            previous = self._pool_connection_counts.get(pool, 0)
+            self._pool_connection_counts[pool] = num_connections
+        return num_connections > previous
+
+    def record_retry(self, client: str, method: str, url: str) -> None:
+        with self._lock:
+            self._get_endpoint_stats(client, method, url).retries += 1
+
+    def record_auth_retry(self, client: str, kind: str) -> None:
+        with self._lock:
+            self._auth_retries[(client, kind)] = self._auth_retries.get((client, kind), 0) + 1
+
+    def reset(self) -> None:
+        with self._lock:
+            self._endpoints.clear()
+            self._auth_retries.clear()
+            self._connections.clear()
+            self._pool_connection_counts.clear()
+
+    #
+    # Output
+    #
+
+    def render_prometheus(self) -> str:
+        """Renders metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+        with self._lock:
+            lines.append("# HELP api_client_request_duration_seconds Time until response headers were received.")
+            lines.append("# TYPE api_client_request_duration_seconds histogram")
+            for (client, method, endpoint), stats in sorted(self._endpoints.items()):
+                labels = f'client="{client}",method="{method}",endpoint="{endpoint}"'
+                cumulative = 0
+                for bound, bucket_count in zip(stats.latency.buckets + (float("inf"),), stats.latency.bucket_counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'api_client_request_duration_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+                lines.append(f"api_client_request_duration_seconds_sum{{{labels}}} {stats.latency.sum}")
+                lines.append(f"api_client_request_duration_seconds_count{{{labels}}} {stats.latency.count}")
+
+            lines.append("# TYPE api_client_responses_total counter")
+            for (client, method, endpoint), stats in sorted(self._endpoints.items()):
+                for status_code, count in sorted(stats.status_counts.items()):
+                    lines.append(f'api_client_responses_total{{client="{client}",method="{method}",endpoint="{endpoint}",status="{status_code}"}} {count}')
+
+            for metric, attribute in (
+                ("api_client_request_bytes_total", "bytes_out"),
+                ("api_client_response_bytes_total", "bytes_in"),
+                ("api_client_retries_total", "retries"),
+            ):
+                lines.append(f"# TYPE {metric} counter")
+                for (client, method, endpoint), stats in sorted(self._endpoints.items()):
+                    lines.append(f'{metric}{{client="{client}",method="{method}",endpoint="{endpoint}"}} {getattr(stats, attribute)}')
+
+            lines.append("# TYPE api_client_auth_retries_total counter")
+            for (client, kind), count in sorted(self._auth_retries.items()):
+                lines.append(f'api_client_auth_retries_total{{client="{client}",kind="{kind}"}} {count}')
+
+            lines.append("# TYPE api_client_connections_total counter")
+            for (client, host), connections in sorted(self._connections.items()):
+                for state, count in sorted(connections.items()):
+                    lines.append(f'api_client_connections_total{{client="{client}",host="{host}",state="{state}"}} {count}')
+
+        return "\n".join(lines) + "\n"
+
+    def get_summary(self) -> List[Dict]:
+        """One structured record per endpoint, plus one per client for auth retries and connection reuse."""
+        records: List[Dict] = []
+        with self._lock:
+            for (client, method, endpoint), stats in sorted(self._endpoints.items()):
+                latency = stats.latency
+                records.append(
+                    {
+                        "metric": "api_client_endpoint",
+                        "client": client,
+                        "method": method,
+                        "endpoint": endpoint,
+                        "count": latency.count,
+                        "latency_mean_seconds": latency.sum / latency.count if latency.count else None,
+                        "latency_p50_seconds": latency.quantile(0.5),
+                        "latency_p99_seconds": latency.quantile(0.99),
+                        "status_counts": {str(status_code): count for status_code, count in stats.status_counts.items()},
+                        "bytes_in": stats.bytes_in,
+                        "bytes_out": stats.bytes_out,
+                        "retries": stats.retries,
+                    }
+                )
+
+            for (client, kind), count in sorted(self._auth_retries.items()):
+                records.append({"metric": "api_client_auth_retries", "client": client, "kind": kind, "count": count})
+
+            for (client, host), connections in sorted(self._connections.items()):
+                records.append({"metric": "api_client_connections", "client": client, "host": host, **connections})
+
+        return records
+
+    def log_summary(self, logger: logging.Logger = log) -> None:
+        for record in self.get_summary():
+            logger.info(json.dumps(record, default=str))
+
+
+# shared by every client unless one is given its own
+default_http_metrics = HTTPMetrics()
+
+
+def instrument_session(session: requests.Session, client: str, metrics: HTTPMetrics = default_http_metrics) -> requests.Session:
+    """Records every response received through the session."""
+
+    def record_response(response: requests.Response, *args, **kwargs) -> None:
+        try:
+            metrics.record_response(client, response)
+        except Exception:
+            log.exception("Problem occurred recording HTTP metrics. Ignoring.")  # metrics must never break a request
+
+    session.hooks["response"].append(record_response)
+    return session
@@ -0,0 +1,171 @@
+import base64
+import io
+import json
+import logging
+import os
+import threading
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.response import HTTPResponse
+
+from http_metrics import get_endpoint_template
+
+
+log = logging.getLogger(__name__)
+
+CASSETTE_MODE_RECORD = "record"
+CASSETTE_MODE_REPLAY = "replay"
+
+# Set by the server or transport, not meaningful (or wrong) when replayed
+UNRECORDED_RESPONSE_HEADERS = ("set-cookie", "content-encoding", "transfer-encoding", "content-length", "connection")
+
+
+def build_raw_response(status: int, headers: Dict[str, str], body: bytes, reason: str = None) -> HTTPResponse:
+    headers = {**headers, "Content-Length": str(len(body))}
+    return HTTPResponse(body=io.BytesIO(body), headers=headers, status=status, reason=reason, preload_content=False, decode_content=False)
+
+
+class Cassette(object):
+    """
+    Recorded HTTP interactions, stored as JSON.
+
+    Interactions are matched by method and exact url first, then by method and endpoint template (ids removed),
+    so fixtures recorded for one call can be replayed for synthetic ones. Matches are served in recorded order,
+    and the last one is repeated once they run out so cassettes can be replayed in a loop.
+
+    Request headers aren't recorded, but response bodies are, so cassettes recorded against a live environment
+    contain whatever that environment returned (including auth tokens). Only record against development environments.
+    """
+
+    def __init__(self, path: str = None, interactions: List[Dict] = None) -> None:
+        self.path = path
+        self.interactions: List[Dict] = interactions if interactions is not None else []
+        self._lock = threading.Lock()
+        self._positions: Dict[Tuple[str, str], int] = {}
+
+    @classmethod
+    def load(cls, path: str) -> "Cassette":
+        with open(path, "r") as f:
+            return cls(path=path, interactions=json.load(f)["interactions"])
+
+    def save(self, path: str = None) -> None:
+        path = path if path else self.path
+        with self._lock:
+            content = json.dumps({"interactions": self.interactions}, indent=2)
+        with open(path, "w") as f:
+            f.write(content)
+
+    def add(self, method: str, url: str, status: int, headers: Dict[str, str], body: bytes, reason: str = None) -> None:
+        interaction = {
+            "request": {"method": method.upper(), "url": url},
+            "response": {
+                "status": status,
+                "reason": reason,
+                "headers": {name: value for name, value in headers.items() if name.lower() not in UNRECORDED_RESPONSE_HEADERS},
+                "body_base64": base64.b64encode(body).decode("ascii"),
+            },
+        }
+        with self._lock:
+            self.interactions.append(interaction)
+            self._positions.clear()
+
+    def find(self, method: str, url: str) -> Optional[Dict]:
+        method = method.upper()
+        template = get_endpoint_template(url)
+        with self._lock:
+            candidates = [i for i in self.interactions if i["request"]["method"] == method and i["request"]["url"] == url]
+            position_key = (method, url)
+            if not candidates:
+                candidates = [i for i in self.interactions if i["request"]["method"] == method and get_endpoint_template(i["request"]["url"]) == template]
+                position_key = (method, template)
+            if not candidates:
+                return None
+
+            position = self._positions.get(position_key, 0)
+            self._positions[position_key] = position + 1
+            return candidates[min(position, len(candidates) - 1)]
+
+
+class RecordingAdapter(HTTPAdapter):
+    """Sends requests for real and records the responses to the cassette."""
+
+    def __init__(self, cassette: Cassette, save_after_each: bool = True, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.cassette = cassette
+        self.save_after_each = save_after_each
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        response = super().send(request, **kwargs)
+        body = response.content  # decoded, which is why Content-Encoding isn't recorded
+
+        self.cassette.add(request.method, request.url, response.status_code, dict(response.headers), body, reason=response.reason)
+        if self.save_after_each and self.cassette.path:
+            self.cassette.save()
+
+        # the body has been consumed, give streaming callers a fresh one
+        response.raw = build_raw_response(response.status_code, dict(response.headers), body, reason=response.reason)
+        response._content = False
+        response._content_consumed = False
+        return response
+
+
+class ReplayAdapter(HTTPAdapter):
+    """Serves responses from the cassette without touching the network."""
+
+    def __init__(self, cassette: Cassette, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.cassette = cassette
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        interaction = self.cassette.find(request.method, request.url)
+        if interaction is None:
+            raise requests.exceptions.ConnectionError(f"No recorded interaction for method='{request.method}' url='{request.url}'", request=request)
+
+        recorded = interaction["response"]
+        body = base64.b64decode(recorded["body_base64"])
+        raw = build_raw_response(recorded["status"], recorded["headers"], body, reason=recorded.get("reason"))
+        return self.build_response(request, raw)
+
+
+def install_cassette(session: requests.Session, cassette: Cassette, mode: str) -> requests.Session:
+    if mode == CASSETTE_MODE_RECORD:
+        adapter = RecordingAdapter(cassette)
+    elif mode == CASSETTE_MODE_REPLAY:
+        adapter = ReplayAdapter(cassette)
+    else:
+        raise ValueError(f"Unknown cassette mode='{mode}'. Expected '{CASSETTE_MODE_RECORD}' or '{CASSETTE_MODE_REPLAY}'.")
+
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_environment_cassette: Optional[Cassette] = None
+_environment_cassette_lock = threading.Lock()
+
+
+def install_cassette_from_environment(session: requests.Session) -> requests.Session:
+    """
+    Installs the cassette at HTTP_CASSETTE_PATH in HTTP_CASSETTE_MODE (record or replay), if set.
+    All sessions share the same cassette, e.g. to record a run of ./scripts/run-local-pubsub.sh.
+    """
+    global _environment_cassette
+
+    path = os.getenv("HTTP_CASSETTE_PATH")
+    if not path:
+        return session
+
+    mode = os.getenv("HTTP_CASSETTE_MODE", CASSETTE_MODE_REPLAY)
+    with _environment_cassette_lock:
+        if _environment_cassette is None:
+            _environment_cassette = Cassette.load(path) if mode == CASSETTE_MODE_REPLAY or os.path.exists(path) else Cassette(path=path)
+            log.info(f"Using HTTP cassette path='{path}' in mode='{mode}'")
+
+    return install_cassette(session, _environment_cassette, mode)
@@ -0,0 +1,438 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import (
+    Callable,
+    Dict,
+    NamedTuple,
+    Optional,
+    Protocol,
+)
+import uuid
+
+from google.api_core import exceptions as google_exceptions
+from google.cloud import storage
+
+
+log = logging.getLogger(__name__)
+
+STATE_IN_FLIGHT = "in_flight"
+STATE_COMPLETED = "completed"
+
+CLAIM_ACQUIRED = "acquired"
+CLAIM_DUPLICATE_IN_FLIGHT = "duplicate_in_flight"  # another delivery is working on it right now
+CLAIM_DUPLICATE_COMPLETED = "duplicate_completed"
+
+DEFAULT_LEASE_SECONDS = 2 * 60  # short, and renewed while the work runs, so crashed work is taken over soon
+
+
+class DuplicateInFlightError(Exception):
+    """
+    Raised for a delivery of work another delivery holds the lease on. It must not be acknowledged, the holder may
+    still die, so it should be retried after retry_after_seconds, when the lease would have expired unless renewed.
+    """
+
+    def __init__(self, msg: str, retry_after_seconds: float) -> None:
+        super().__init__(msg)
+        self.retry_after_seconds = retry_after_seconds
+
+
+class LedgerEntry(NamedTuple):
+    state: str
+    owner: str
+    event_id: Optional[str]
+    lease_expires_at: float  # seconds since epoch, only meaningful while in flight
+
+
+class IdempotencyBackend(Protocol):
+    def try_acquire(self, key: str, entry: LedgerEntry) -> Optional[LedgerEntry]:
+        """Stores entry if there's no entry for the key or the existing one's lease expired. Otherwise returns the existing entry."""
+        ...
+
+    def renew(self, key: str, entry: LedgerEntry) -> bool:
+        """Stores entry's lease_expires_at, if the key is still in flight and held by entry.owner. Returns whether it was."""
+        ...
+
+    def complete(self, key: str, entry: LedgerEntry) -> None:
+        """Marks the key completed, if still held by entry.owner."""
+        ...
+
+    def release(self, key: str, owner: str) -> None:
+        """Removes the in-flight entry, if still held by owner, so a redelivery can try again."""
+        ...
+
+
+def is_lease_expired(entry: LedgerEntry, now: float) -> bool:
+    return entry.state == STATE_IN_FLIGHT and entry.lease_expires_at <= now
+
+
+class SQLiteIdempotencyBackend(object):
+    """For local runs and single-host workers. The database may be shared by processes on the same host."""
+
+    def __init__(self, path: str, clock: Callable[[], float] = time.time) -> None:
+        self.path = path
+        self._clock = clock
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS idempotency_ledger ("
+                "key TEXT PRIMARY KEY, state TEXT NOT NULL, owner TEXT NOT NULL, event_id TEXT, lease_expires_at REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        return connection
+
+    def try_acquire(self, key: str, entry: LedgerEntry) -> Optional[LedgerEntry]:
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")  # serializes acquisitions across connections
+        try:
+            row = connection.execute("SELECT state, owner, event_id, lease_expires_at FROM idempotency_ledger WHERE key = ?", (key,)).fetchone()
+            if row is not None and not is_lease_expired(LedgerEntry(*row), self._clock()):
+                return LedgerEntry(*row)
+
+            connection.execute("INSERT OR REPLACE INTO idempotency_ledger VALUES (?, ?, ?, ?, ?)", (key, *entry))
+            return None
+        finally:
+            connection.execute("COMMIT")
+
+    def renew(self, key: str, entry: LedgerEntry) -> bool:
+        cursor = self._connect().execute(
+            "UPDATE idempotency_ledger SET lease_expires_at = ? WHERE key = ? AND owner = ? AND state = ?",
+            (entry.lease_expires_at, key, entry.owner, STATE_IN_FLIGHT),
+        )
+        return cursor.rowcount > 0
+
+    def complete(self, key: str, entry: LedgerEntry) -> None:
+        self._connect().execute(
+            "UPDATE idempotency_ledger SET state = ?, event_id = ? WHERE key = ? AND owner = ?", (STATE_COMPLETED, entry.event_id, key, entry.owner)
+        )
+
+    def release(self, key: str, owner: str) -> None:
+        self._connect().execute("DELETE FROM idempotency_ledger WHERE key = ? AND owner = ? AND state = ?", (key, owner, STATE_IN_FLIGHT))
+
+
+class FileIdempotencyBackend(object):
+    """
+    One file per key, hard linked into place so only one process can take a free key. For local runs on one host,
+    taking over an expired lease is not atomic across processes.
+    """
+
+    def __init__(self, directory: str, clock: Callable[[], float] = time.time) -> None:
+        self.directory = directory
+        self._clock = clock
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.json")
+
+    def _read(self, path: str) -> Optional[LedgerEntry]:
+        try:
+            with open(path, "r") as f:
+                return LedgerEntry(**json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def _write_temporary(self, entry: LedgerEntry) -> str:
+        fd, temporary_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry._asdict(), f)
+        return temporary_path
+
+    def _write_atomically(self, path: str, entry: LedgerEntry) -> None:
+        os.replace(self._write_temporary(entry), path)
+
+    def try_acquire(self, key: str, entry: LedgerEntry) -> Optional[LedgerEntry]:
+        path = self._path(key)
+        temporary_path = self._write_temporary(entry)
+        try:
+            # linking a fully written file fails atomically if the key exists, so readers never see a partial entry
+            os.link(temporary_path, path)
+            return None
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temporary_path)
+
+        existing = self._read(path)
+        if existing is not None and not is_lease_expired(existing, self._clock()):
+            return existing
+
+        self._write_atomically(path, entry)
+        return None
+
+    def renew(self, key: str, entry: LedgerEntry) -> bool:
+        path = self._path(key)
+        existing = self._read(path)
+        if existing is None or existing.owner != entry.owner or existing.state != STATE_IN_FLIGHT:
+            return False
+        self._write_atomically(path, existing._replace(lease_expires_at=entry.lease_expires_at))
+        return True
+
+    def complete(self, key: str, entry: LedgerEntry) -> None:
+        path = self._path(key)
+        existing = self._read(path)
+        if existing is None or existing.owner == entry.owner:
+            self._write_atomically(path, entry._replace(state=STATE_COMPLETED))
+
+    def release(self, key: str, owner: str) -> None:
+        path = self._path(key)
+        existing = self._read(path)
+        if existing is not None and existing.owner == owner and existing.state == STATE_IN_FLIGHT:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class GCSIdempotencyBackend(object):
+    """
+    One small blob per key. Generation preconditions make every transition atomic across instances:
+    creating requires that no blob exists, and taking over, completing and releasing require the generation we last saw.
+    """
+
+    def __init__(self, bucket_name: str, prefix: str = "idempotency/", storage_client: storage.Client = None, clock: Callable[[], float] = time.time) -> None:
+        if storage_client is None:
+            from local_file_helpers import storage_client
+
+        self._bucket = storage_client.bucket(bucket_name)
+        self.prefix = prefix
+        self._clock = clock
+        self._generations = {}  # (key, owner) -> generation we wrote
+        self._lock = threading.Lock()
+
+    def _blob(self, key: str) -> storage.Blob:
+        return self._bucket.blob(f"{self.prefix}{hashlib.sha256(key.encode('utf-8')).hexdigest()}.json")
+
+    def _write(self, key: str, entry: LedgerEntry, if_generation_match: int) -> None:
+        blob = self._blob(key)
+        blob.upload_from_string(json.dumps(entry._asdict()), content_type="application/json", if_generation_match=if_generation_match)
+        with self._lock:
+            self._generations[(key, entry.owner)] = blob.generation
+
+    def try_acquire(self, key: str, entry: LedgerEntry) -> Optional[LedgerEntry]:
+        try:
+            self._write(key, entry, if_generation_match=0)
+            return None
+        except google_exceptions.PreconditionFailed:
+            pass
+
+        blob = self._blob(key)
+        try:
+            existing = LedgerEntry(**json.loads(blob.download_as_bytes()))
+        except google_exceptions.NotFound:
+            return self.try_acquire(key, entry)  # released in the meantime
+        if not is_lease_expired(existing, self._clock()):
+            return existing
+
+        try:
+            self._write(key, entry, if_generation_match=blob.generation)
+            return None
+        except google_exceptions.PreconditionFailed:
+            return existing  # someone else took it over first
+
+    def renew(self, key: str, entry: LedgerEntry) -> bool:
+        with self._lock:
+            generation = self._generations.get((key, entry.owner))
+        if generation is None:
+            return False
+        try:
+            self._write(key, entry, if_generation_match=generation)
+            return True
+        except google_exceptions.PreconditionFailed:
+            with self._lock:
+                self._generations.pop((key, entry.owner), None)
+            return False
+
+    def complete(self, key: str, entry: LedgerEntry) -> None:
+        with self._lock:
+            generation = self._generations.pop((key, entry.owner), None)
+        if generation is None:
+            return
+        try:
+            self._write(key, entry._replace(state=STATE_COMPLETED), if_generation_match=generation)
+        except google_exceptions.PreconditionFailed:
+            log.warning(f"Idempotency lease for key='{key}' was taken over before completion was recorded.")
+
+    def release(self, key: str, owner: str) -> None:
+        with self._lock:
+            generation = self._generations.pop((key, owner), None)
+        if generation is None:
+            return
+        try:
+            self._blob(key).delete(if_generation_match=generation)
+        except (google_exceptions.PreconditionFailed, google_exceptions.NotFound):
+            pass
+
+
+class IdempotencyClaim(object):
+    """
+    The outcome of claiming an event. Use as a context manager: leaving normally records completion, leaving with an
+    error releases the lease so a redelivery can try again. release() gives the work up early, e.g. when deferring it.
+    Until then the ledger renews the lease, see IdempotencyLedger.renew_claims.
+    """
+
+    def __init__(
+        self,
+        backend: Optional[IdempotencyBackend],
+        key: str,
+        entry: LedgerEntry,
+        state: str,
+        holder: Optional[LedgerEntry] = None,
+        on_settled: Callable[["IdempotencyClaim"], None] = None,
+    ) -> None:
+        self._backend = backend
+        self.key = key
+        self.entry = entry
+        self.state = state
+        self.holder = holder  # the entry that made this a duplicate
+        self._on_settled = on_settled
+        self._is_settled = state != CLAIM_ACQUIRED
+        self._lock = threading.Lock()
+
+    @property
+    def acquired(self) -> bool:
+        return self.state == CLAIM_ACQUIRED
+
+    def _settle(self) -> bool:
+        with self._lock:
+            if self._is_settled:
+                return False
+            self._is_settled = True
+        if self._on_settled is not None:
+            self._on_settled(self)
+        return True
+
+    def release(self) -> None:
+        if self._settle() and self._backend is not None:
+            self._backend.release(self.key, self.entry.owner)
+
+    def complete(self) -> None:
+        if self._settle() and self._backend is not None:
+            self._backend.complete(self.key, self.entry)
+
+    def renew(self, lease_expires_at: float) -> bool:
+        """Extends the lease while the work runs. Returns False if it was lost, i.e. expired and taken over."""
+        with self._lock:
+            if self._is_settled or self._backend is None:
+                return True  # nothing left to renew
+            entry = self.entry._replace(lease_expires_at=lease_expires_at)
+            if not self._backend.renew(self.key, entry):
+                return False
+            self.entry = entry
+            return True
+
+    def __enter__(self) -> "IdempotencyClaim":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        try:
+            if exc_type is None:
+                self.complete()
+            else:
+                self.release()
+        except Exception:
+            # the work itself is done (or failed) either way, a ledger problem only weakens de-duplication
+            log.exception(f"Problem occurred settling idempotency claim for key='{self.key}'. Ignoring.")
+
+
+class IdempotencyLedger(object):
+    """
+    De-duplicates at-least-once deliveries. A claim takes a lease on the key before work starts, and duplicates are
+    reported: completed ones can be acknowledged without doing anything, in-flight ones must be retried later since the
+    holder may yet die. Without a backend every claim is acquired, which is the behavior before de-duplication existed.
+
+    Leases are short and renewed by renew_claims while the work runs, from the pull worker's lease extension loop or,
+    in the Cloud Function, from a thread started with start_renewing, so crashed work is taken over within lease_seconds.
+    """
+
+    def __init__(self, backend: Optional[IdempotencyBackend], lease_seconds: float = DEFAULT_LEASE_SECONDS, clock: Callable[[], float] = time.time) -> None:
+        self.backend = backend
+        self.lease_seconds = lease_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._held: Dict[str, IdempotencyClaim] = {}  # owner -> claim acquired and not yet settled
+        self._renewer: Optional[threading.Thread] = None
+
+    def claim(self, key: str, event_id: Optional[str] = None) -> IdempotencyClaim:
+        entry = LedgerEntry(state=STATE_IN_FLIGHT, owner=uuid.uuid4().hex, event_id=event_id, lease_expires_at=self._clock() + self.lease_seconds)
+        if self.backend is None:
+            return IdempotencyClaim(None, key, entry, CLAIM_ACQUIRED)
+
+        try:
+            holder = self.backend.try_acquire(key, entry)
+        except Exception:
+            log.exception(f"Problem occurred claiming idempotency key='{key}'. Processing without de-duplication.")
+            return IdempotencyClaim(None, key, entry, CLAIM_ACQUIRED)
+
+        if holder is None:
+            claim = IdempotencyClaim(self.backend, key, entry, CLAIM_ACQUIRED, on_settled=self._forget)
+            with self._lock:
+                self._held[entry.owner] = claim
+            return claim
+
+        state = CLAIM_DUPLICATE_COMPLETED if holder.state == STATE_COMPLETED else CLAIM_DUPLICATE_IN_FLIGHT
+        return IdempotencyClaim(self.backend, key, entry, state, holder=holder)
+
+    def _forget(self, claim: IdempotencyClaim) -> None:
+        with self._lock:
+            self._held.pop(claim.entry.owner, None)
+
+    def renew_claims(self) -> None:
+        """Extends the lease of every claim held by this process by lease_seconds from now."""
+        with self._lock:
+            claims = list(self._held.values())
+        lease_expires_at = self._clock() + self.lease_seconds
+        for claim in claims:
+            try:
+                if not claim.renew(lease_expires_at):
+                    log.warning(f"Idempotency lease for key='{claim.key}' was lost, a redelivery may be doing the same work.")
+                    self._forget(claim)
+            except Exception:
+                log.exception(f"Problem occurred renewing idempotency lease for key='{claim.key}'. Retrying next interval.")
+
+    def start_renewing(self, interval_seconds: float = None) -> None:
+        """Renews held claims every interval_seconds (a third of the lease by default) from a daemon thread. Idempotent."""
+        if self.backend is None:
+            return
+        interval_seconds = interval_seconds if interval_seconds is not None else self.lease_seconds / 3
+        with self._lock:
+            if self._renewer is not None:
+                return
+            self._renewer = threading.Thread(target=self._renew_forever, args=(interval_seconds,), name="idempotency-renewer", daemon=True)
+        self._renewer.start()
+
+    def _renew_forever(self, interval_seconds: float) -> None:
+        while True:
+            time.sleep(interval_seconds)
+            self.renew_claims()
+
+
+def get_audio_partial_idempotency_key(call_id: Optional[str], partial_id: str, audio_partial_id: str) -> str:
+    return f"audio_partial/{call_id}/{partial_id}/{audio_partial_id}"
+
+
+def get_idempotency_ledger_from_environment() -> IdempotencyLedger:
+    """IDEMPOTENCY_BACKEND is none (default), sqlite, file or gcs."""
+    backend_name = os.getenv("IDEMPOTENCY_BACKEND", "none")
+    lease_seconds = float(os.getenv("IDEMPOTENCY_LEASE_SECONDS", str(DEFAULT_LEASE_SECONDS)))
+
+    if backend_name == "none":
+        backend = None
+    elif backend_name == "sqlite":
+        backend = SQLiteIdempotencyBackend(os.getenv("IDEMPOTENCY_SQLITE_PATH", os.path.join(tempfile.gettempdir(), "idempotency.sqlite3")))
+    elif backend_name == "file":
+        backend = FileIdempotencyBackend(os.getenv("IDEMPOTENCY_FILE_DIRECTORY", os.path.join(tempfile.gettempdir(), "idempotency")))
+    elif backend_name == "gcs":
+        backend = GCSIdempotencyBackend(os.environ["IDEMPOTENCY_BUCKET"], prefix=os.getenv("IDEMPOTENCY_PREFIX", "idempotency/"))
+    else:
+        raise ValueError(f"Unknown IDEMPOTENCY_BACKEND='{backend_name}'. Expected none, sqlite, file or gcs.")
+
+    return IdempotencyLedger(backend, lease_seconds=lease_seconds)
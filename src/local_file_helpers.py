@@ -1,10 +1,19 @@
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import logging
+import mimetypes
 import os
 import tempfile
+import uuid
 import wave
-from typing import Union
+from typing import (
+    List,
+    Union,
+)
 
 from google.cloud import storage
+import google_crc32c
 
 from config import PROJECT_ID
 
@@ -13,6 +22,13 @@ storage_client = storage.Client(project=PROJECT_ID)
 # Get an instance of a logger
 log = logging.getLogger(__name__)
 
+# Files at least this large are uploaded as parts in parallel and composed, 0 disables
+PARALLEL_COMPOSITE_UPLOAD_THRESHOLD_BYTES = int(os.getenv("PARALLEL_COMPOSITE_UPLOAD_THRESHOLD_BYTES", str(32 * 1024 * 1024)))
+PARALLEL_COMPOSITE_UPLOAD_MAX_WORKERS = int(os.getenv("PARALLEL_COMPOSITE_UPLOAD_MAX_WORKERS", "8"))
+PARALLEL_COMPOSITE_UPLOAD_MIN_PART_SIZE_BYTES = 8 * 1024 * 1024
+MAX_COMPOSE_SOURCES = 32  # GCS limit per compose request
+CHECKSUM_READ_SIZE = 1024 * 1024
+
 
 def download(file: bytes, file_name: str, tmp_subfolder: str = "downloaded") -> str:
     folder = os.path.join(tempfile.gettempdir(), tmp_subfolder)
@@ -44,10 +60,26 @@ def get_sample_rate(wave_file_path: str) -> int:
             raise Exception("Wavefile possibly corrupt!")
 
 
-def upload_file_to_bucket(blob_name: str, path_to_file: str, bucket_name: str, storage_client: storage.Client = storage_client) -> str:
-    bucket = storage_client.get_bucket(bucket_name)
+def guess_content_type(path: str) -> str:
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+@lru_cache(maxsize=64)
+def get_bucket(bucket_name: str, storage_client: storage.Client = storage_client) -> storage.Bucket:
+    """Bucket handle without the metadata round trip get_bucket makes. A missing bucket surfaces on the first write instead."""
+    return storage_client.bucket(bucket_name)
+
+
+def upload_file_to_bucket(
+    blob_name: str, path_to_file: str, bucket_name: str, content_type: str = None, storage_client: storage.Client = storage_client
+) -> str:
+    """content_type is guessed from path_to_file's extension if not given."""
+    if PARALLEL_COMPOSITE_UPLOAD_THRESHOLD_BYTES and os.path.getsize(path_to_file) >= PARALLEL_COMPOSITE_UPLOAD_THRESHOLD_BYTES:
+        return parallel_composite_upload(blob_name, path_to_file, bucket_name, content_type=content_type, storage_client=storage_client)
+
+    bucket = get_bucket(bucket_name, storage_client)
     blob = bucket.blob(blob_name)
-    blob.upload_from_filename(path_to_file)
+    blob.upload_from_filename(path_to_file, content_type=content_type)
     uri = f"gs://{bucket_name}/{blob_name}"
     return uri
 
@@ -55,8 +87,80 @@ def upload_file_to_bucket(blob_name: str, path_to_file: str, bucket_name: str, s
 def upload_content_to_new_blob(
     blob_name: str, content: Union[bytes, str], content_type: str, bucket_name: str, storage_client: storage.Client = storage_client
 ) -> str:
-    bucket = storage_client.get_bucket(bucket_name)
+    bucket = get_bucket(bucket_name, storage_client)
     blob = bucket.blob(blob_name)
     blob.upload_from_string(content, content_type)
     uri = f"gs://{bucket_name}/{blob_name}"
     return uri
+
+
+def get_file_crc32c(path: str, offset: int = 0, length: int = None) -> str:
+    """Base64 encoded crc32c, the same encoding GCS uses."""
+    checksum = google_crc32c.Checksum()
+    remaining = length if length is not None else os.path.getsize(path) - offset
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while remaining > 0:
+            chunk = f.read(min(CHECKSUM_READ_SIZE, remaining))
+            if not chunk:
+                break
+            checksum.update(chunk)
+            remaining -= len(chunk)
+    return base64.b64encode(checksum.digest()).decode("ascii")
+
+
+def get_part_ranges(size: int, max_parts: int = MAX_COMPOSE_SOURCES, min_part_size: int = PARALLEL_COMPOSITE_UPLOAD_MIN_PART_SIZE_BYTES) -> List[range]:
+    part_count = max(1, min(max_parts, size // min_part_size))
+    part_size = -(-size // part_count)  # ceiling division
+    return [range(offset, min(offset + part_size, size)) for offset in range(0, size, part_size)]
+
+
+def parallel_composite_upload(
+    blob_name: str,
+    path_to_file: str,
+    bucket_name: str,
+    content_type: str = None,
+    max_workers: int = PARALLEL_COMPOSITE_UPLOAD_MAX_WORKERS,
+    storage_client: storage.Client = storage_client,
+) -> str:
+    """
+    Uploads the file as up to 32 parts in parallel, then composes them into blob_name and deletes the parts.
+
+    Each part is verified by its upload, and the composed blob's crc32c is checked against the local file's.
+    Composite objects have no md5, only crc32c. content_type is guessed from path_to_file's extension if not given,
+    like upload_from_filename does.
+    """
+    if content_type is None:
+        content_type = guess_content_type(path_to_file)
+    bucket = get_bucket(bucket_name, storage_client)
+    parts_prefix = f"{blob_name}.parts/{uuid.uuid4().hex}"
+    ranges = get_part_ranges(os.path.getsize(path_to_file))
+    part_blobs = [bucket.blob(f"{parts_prefix}/{index:02d}") for index in range(len(ranges))]
+    uri = f"gs://{bucket_name}/{blob_name}"
+    log.info(f"Uploading path='{path_to_file}' to uri='{uri}' as {len(ranges)} parts in parallel")
+
+    def upload_part(part_blob: storage.Blob, part_range: range) -> None:
+        with open(path_to_file, "rb") as f:
+            f.seek(part_range.start)
+            part_blob.upload_from_file(f, size=len(part_range), checksum="crc32c")
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="composite-upload") as executor:
+            uploads = [executor.submit(upload_part, part_blob, part_range) for part_blob, part_range in zip(part_blobs, ranges)]
+            expected_crc32c = get_file_crc32c(path_to_file)  # while the parts upload
+            for upload in uploads:
+                upload.result()
+
+        blob = bucket.blob(blob_name)
+        blob.content_type = content_type
+        blob.compose(part_blobs)
+        if blob.crc32c != expected_crc32c:
+            raise Exception(f"Composed blob uri='{uri}' has crc32c='{blob.crc32c}', expected crc32c='{expected_crc32c}' from path='{path_to_file}'.")
+    finally:
+        for part_blob in part_blobs:
+            try:
+                part_blob.delete()
+            except Exception:
+                log.warning(f"Could not delete upload part blob='{part_blob.name}'. It may never have been uploaded.")
+
+    return uri
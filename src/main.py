@@ -1,8 +1,13 @@
 import base64
+from contextlib import nullcontext
 from typing import Optional
 from config import BUCKET_OUTPUT_AUDIO_PCM_ENCODED, BUCKET_OUTPUT_RAW_EXTRACT
 import json
 import logging
+import os
+import tempfile
+import threading
+import time
 
 from flask import current_app, escape
 from google.cloud import dlp_v2
@@ -10,10 +15,32 @@ from google.cloud import speech_v1p1beta1 as speech
 
 from pydantic import BaseModel
 
-from audio_conversion import wav_codec_to_pcm_s16le
-from local_file_helpers import download, get_sample_rate, log_file_contents, upload_file_to_bucket
+from audio_conversion import (
+    MAX_WAV_HEADER_BYTES,
+    SPEECH_FORMAT_PASSTHROUGH,
+    SPEECH_FORMAT_REWRITE_HEADER,
+    get_gcs_uri_from_signed_url,
+    negotiate_speech_format,
+    parse_wav_header,
+    rewrite_wav_header_to_pcm,
+    wav_codec_to_pcm_s16le,
+)
+from event_deferral import EventDeferral
+from http_metrics import default_http_metrics
+from idempotency import (
+    CLAIM_DUPLICATE_COMPLETED,
+    DuplicateInFlightError,
+    IdempotencyLedger,
+    get_audio_partial_idempotency_key,
+    get_idempotency_ledger_from_environment,
+)
+from local_file_helpers import get_sample_rate, log_file_contents, upload_file_to_bucket
 from peerlogic_api_client import PeerlogicAPIClient
+from profiling import EventProfiler
+import resource_accounting
+from speech_admission import SpeechAdmissionController, SpeechQuotaExhaustedError
 from speech_to_text import transcribe_model_selection
+from tracing import span, start_trace
 
 logging.basicConfig(level=logging.NOTSET)
 
@@ -27,6 +54,24 @@ log.info(f"Cold started.")
 # Declared at cold-start, but only initialized if/when the function executes
 # We want to hold onto the bearer token for as long as possible to reduce lookups / calls
 peerlogic_api_client: Optional[PeerlogicAPIClient] = None
+peerlogic_api_client_lock = threading.Lock()  # the pull worker handles events on several threads
+
+# Delivers events again later through Cloud Tasks, e.g. when Speech-to-Text quota is used up. None unless EVENT_DEFERRAL_QUEUE is set.
+event_deferral: Optional[EventDeferral] = EventDeferral.from_environment()
+
+# Keeps Speech-to-Text submissions within quota across bursts. None unless SPEECH_REQUESTS_PER_MINUTE is set.
+speech_admission_controller: Optional[SpeechAdmissionController] = SpeechAdmissionController.from_environment()
+if speech_admission_controller and not event_deferral:
+    log.warning(f"Speech-to-Text admission control is enabled without EVENT_DEFERRAL_QUEUE, events over quota will fail and be retried by Pub/Sub.")
+
+# Profiles selected events (env, message attribute or sample rate). None, so no overhead, unless PROFILING_OUTPUT is set.
+event_profiler: Optional[EventProfiler] = EventProfiler.from_environment()
+
+# Records memory and /tmp usage per stage on the trace, warning near the budget. Off unless RESOURCE_ACCOUNTING_ENABLED is set.
+resource_accounting.install_from_environment()
+
+# Acknowledges redeliveries of work that's done, and retries those of work in flight elsewhere later. Claims always succeed unless IDEMPOTENCY_BACKEND is set.
+idempotency_ledger: IdempotencyLedger = get_idempotency_ledger_from_environment()
 
 
 class AudioReady(BaseModel):
@@ -61,66 +106,182 @@ def transcribe_audio_peerlogic_pubsub(event, context):
          metadata. The `event_id` field contains the Pub/Sub message ID. The
          `timestamp` field contains the publish time.
     """
-    global peerlogic_api_client
+    idempotency_ledger.start_renewing()  # the pull worker renews from its own lease extension loop instead
+    handle_audio_ready_event(event, context, current_app.logger)
 
-    log = current_app.logger
 
+def handle_audio_ready_event(event, context, log: logging.Logger) -> None:
+    """Handles one Pub/Sub event, shared by the Cloud Function and the long-running pull worker (pull_worker.py)."""
     log.info(f"Started! Transcribe Audio - Stereo. Event: {event}, Context: {context}")
 
-    log.info(f"Validating attributes and data.")
-    data = base64.b64decode(event["data"]).decode("utf-8")
-    data = json.loads(data)
-    call_id = event.get("attributes", {}).get("call_id")
-    audio_ready_event = AudioReady(**data)
+    try:
+        with event_profiler.profile(event, context) if event_profiler else nullcontext():
+            _handle_audio_ready_event(event, context, log)
+    finally:
+        # cumulative since cold start, so regressions and hot endpoints show up across invocations of an instance
+        default_http_metrics.log_summary(log)
+
+
+def _handle_audio_ready_event(event, context, log: logging.Logger) -> None:
+    if event_deferral and event_deferral.defer_if_early(event):
+        return
+
+    with start_trace("transcribe_audio_peerlogic_pubsub", event_id=getattr(context, "event_id", None)) as trace:
+        with span("decode_event"):
+            log.info(f"Validating attributes and data.")
+            data = base64.b64decode(event["data"]).decode("utf-8")
+            data = json.loads(data)
+            call_id = event.get("attributes", {}).get("call_id")
+            audio_ready_event = AudioReady(**data)
+
+        trace.set_attributes(call_id=call_id, partial_id=audio_ready_event.partial_id, audio_partial_id=audio_ready_event.audio_partial_id)
+        with span("claim_idempotency_key") as claim_span:
+            idempotency_key = get_audio_partial_idempotency_key(call_id, audio_ready_event.partial_id, audio_ready_event.audio_partial_id)
+            claim = idempotency_ledger.claim(idempotency_key, event_id=getattr(context, "event_id", None))
+            claim_span.set_attribute("state", claim.state)
+        holder_event_id = claim.holder.event_id if claim.holder else None
+        if claim.state == CLAIM_DUPLICATE_COMPLETED:
+            log.info(f"Acknowledging duplicate delivery state='{claim.state}' key='{idempotency_key}' first_event_id='{holder_event_id}'")
+            return
+        if not claim.acquired:
+            # the holder may still die, so this delivery comes back once its lease could have expired
+            retry_after = max(0.0, claim.holder.lease_expires_at - time.time()) + 1.0
+            msg = f"Duplicate delivery state='{claim.state}' key='{idempotency_key}' first_event_id='{holder_event_id}', retrying in {retry_after:.1f}s."
+            if not event_deferral:
+                raise DuplicateInFlightError(msg, retry_after_seconds=retry_after)
+            log.info(msg)
+            with span("defer_until_lease_expiry"):
+                event_deferral.defer(event, retry_after, msg)
+            return
+
+        with claim:
+            try:
+                process_audio_ready_event(call_id, audio_ready_event, log)
+            except SpeechQuotaExhaustedError as e:
+                if not event_deferral:
+                    log.warning(f"Cannot defer event over Speech-to-Text quota without EVENT_DEFERRAL_QUEUE, failing it for Pub/Sub to retry. Error: {e}")
+                    raise
+                # the redelivered event carries the same key, it must be able to claim it
+                claim.release()
+                with span("defer_until_speech_quota"):
+                    event_deferral.defer(event, e.retry_after_seconds, str(e))
+
+
+def process_audio_ready_event(call_id: str, audio_ready_event: AudioReady, log: logging.Logger) -> None:
+    """Runs the pipeline for one audio partial. Each stage is timed as a span of the active trace."""
+    global peerlogic_api_client
+
     partial_id = audio_ready_event.partial_id
     audio_partial_id = audio_ready_event.audio_partial_id
 
     log_event_identifiers = f"call_id='{call_id}' audio_partial_id='{audio_partial_id}'"
     log.info(f"Audio Ready Event detected for {log_event_identifiers}")
 
-    # This value is initialized only if (and when) the function is called
-    if not peerlogic_api_client:
-        log.info(f"Peerlogic API Client does not currently exist, logging in.")
-        peerlogic_api_client = PeerlogicAPIClient()
+    with span("login"):
+        # This value is initialized only if (and when) the function is called. After that, requires_auth logs in again
+        # or refreshes the token when a request is rejected, so concurrent events share one bearer token
+        with peerlogic_api_client_lock:
+            if not peerlogic_api_client:
+                log.info(f"Peerlogic API Client does not currently exist, logging in.")
+                client = PeerlogicAPIClient()
+                client.login()
+                peerlogic_api_client = client
+
+    # named per audio partial and invocation, since audio partials of one call partial, and duplicate deliveries, may be
+    # handled at the same time on one instance
+    downloaded_file, downloaded_path = tempfile.mkstemp(suffix=f"-{audio_partial_id}.wav")
+    os.close(downloaded_file)
+    try:
+        process_audio_partial(call_id, audio_ready_event, downloaded_path, log)
+    finally:
+        if os.path.exists(downloaded_path):
+            os.remove(downloaded_path)
+
 
-    # for some reason this is not getting called and causing issues locally.
-    # TODO: move back to above if statement
-    peerlogic_api_client.login()
+def process_audio_partial(call_id: str, audio_ready_event: AudioReady, downloaded_path: str, log: logging.Logger) -> None:
+    """Downloads the audio partial to downloaded_path, which the caller removes, and transcribes it."""
+    partial_id = audio_ready_event.partial_id
+    audio_partial_id = audio_ready_event.audio_partial_id
+    log_event_identifiers = f"call_id='{call_id}' audio_partial_id='{audio_partial_id}'"
 
     # Get Wavfile
-    log.info(f"Getting the call audio partials for audio_partial_id='{audio_partial_id}'")
-    call_audio_partial_file = peerlogic_api_client.get_call_audio_partial_wav_file(call_id, partial_id, audio_partial_id)
-    log.info(f"Got the call audio partial wavefile in memory for call_id='{call_id}' partial_id='{partial_id}' audio_partial_id='{audio_partial_id}")
+    prefer_low_memory = resource_accounting.should_prefer_low_memory()
+    with span("download_audio_partial", low_memory=prefer_low_memory) as download_span:
+        log.info(f"Getting the call audio partials for audio_partial_id='{audio_partial_id}'")
+        signed_url = peerlogic_api_client.get_call_audio_partial_signed_url(call_id, partial_id, audio_partial_id)
+        if prefer_low_memory:
+            # straight to the tmp directory, only the header is read back into memory
+            response = peerlogic_api_client.download_signed_url_file(signed_url, downloaded_path)
+            response.raise_for_status()  # the retry after an auth refresh isn't status checked
+            with open(downloaded_path, "rb") as f:
+                call_audio_partial_header = f.read(MAX_WAV_HEADER_BYTES)
+            call_audio_partial_size = os.path.getsize(downloaded_path)
+            log.info(f"Streamed the call audio partial wavefile to {downloaded_path} for {log_event_identifiers}")
+        else:
+            call_audio_partial_file = peerlogic_api_client.get_signed_url_file(signed_url)
+            call_audio_partial_header = call_audio_partial_file[:MAX_WAV_HEADER_BYTES]
+            call_audio_partial_size = len(call_audio_partial_file)
+            log.info(f"Got the call audio partial wavefile in memory for call_id='{call_id}' partial_id='{partial_id}' audio_partial_id='{audio_partial_id}")
+        download_span.set_attribute("bytes", call_audio_partial_size)
 
-    log.info(f"Saving file to tmp directory")
-    downloaded_path = download(call_audio_partial_file, f"{partial_id}.wav")
-    log.info(f"Saved file to tmp directory")
+    if not prefer_low_memory:
+        with span("save_to_tmp"):
+            log.info(f"Saving file to tmp directory")
+            with open(downloaded_path, "wb") as f:
+                f.write(call_audio_partial_file)
+            del call_audio_partial_file  # everything after this reads the saved copy
+            log.info(f"Saved file to tmp directory")
 
-    log.info(f"Getting sample rate of wavefile to pass as Speech To Text arguments")
-    try:
-        sample_rate = get_sample_rate(downloaded_path)
-    except Exception as e:
-        log.exception(e)
-        log.exception(f"Problem encountered with call_id audio: {call_id}")
-        log_file_contents(downloaded_path)
-        raise e
-    log.info(f"Got sample rate of wavefile to pass as Speech To Text arguments")
+    with span("probe_sample_rate") as probe_span:
+        log.info(f"Getting sample rate of wavefile to pass as Speech To Text arguments")
+        try:
+            sample_rate = get_sample_rate(downloaded_path)
+        except Exception as e:
+            log.exception(e)
+            log.exception(f"Problem encountered with call_id audio: {call_id}")
+            log_file_contents(downloaded_path)
+            raise e
+        probe_span.set_attribute("sample_rate", sample_rate)
+        log.info(f"Got sample rate of wavefile to pass as Speech To Text arguments")
+
+    with span("negotiate_speech_format") as negotiate_span:
+        try:
+            wav_header = parse_wav_header(call_audio_partial_header)
+        except ValueError:
+            wav_header = None
+        speech_format = negotiate_speech_format(wav_header, file_size=call_audio_partial_size)
+        negotiate_span.set_attributes(action=speech_format.action, reason=speech_format.reason)
+        log.info(f"Negotiated speech format action='{speech_format.action}' reason='{speech_format.reason}' for {log_event_identifiers}")
 
     # Processing:
     log.info(f"NOT YET IMPLEMENTED. DEVELOPMENT IN PROGRESS. THIS IS FINE. DO NOT BE ALARMED.")
-    # log.info("Converting in memory wavefile to pcm")
-    # pcm_file_path, _ = wav_codec_to_pcm_s16le(downloaded_path)
-    # log.info("Converted in memory wavefile to pcm")
+    # # Only convert and upload a copy when Speech can't read the original as it is.
+    # # Passthrough needs the Speech service account to have read access to the original's bucket.
+    # pcm_file_gs_uri = get_gcs_uri_from_signed_url(signed_url) if speech_format.action == SPEECH_FORMAT_PASSTHROUGH else None
+    # if not pcm_file_gs_uri:
+    #     if speech_format.action == SPEECH_FORMAT_REWRITE_HEADER:
+    #         log.info("Rewriting wavefile header to plain pcm")
+    #         pcm_file_path, _ = rewrite_wav_header_to_pcm(downloaded_path, wav_header)
+    #     else:
+    #         log.info("Converting in memory wavefile to pcm")
+    #         pcm_file_path, _ = wav_codec_to_pcm_s16le(downloaded_path)
+    #     log.info("Converted in memory wavefile to pcm")
 
-    # # PCM is still wav extension: https://trac.ffmpeg.org/wiki/audio%20types
-    # log.info(f"Saving local pcm encoded file {partial_id}.wav to bucket {BUCKET_OUTPUT_AUDIO_PCM_ENCODED}")
-    # pcm_file_gs_uri = upload_file_to_bucket(f"{partial_id}.wav", pcm_file_path, bucket_name=BUCKET_OUTPUT_AUDIO_PCM_ENCODED)
-    # log.info(f"Saved local pcm encoded file to bucket {BUCKET_OUTPUT_AUDIO_PCM_ENCODED}")
+    #     # PCM is still wav extension: https://trac.ffmpeg.org/wiki/audio%20types
+    #     log.info(f"Saving local pcm encoded file {partial_id}.wav to bucket {BUCKET_OUTPUT_AUDIO_PCM_ENCODED}")
+    #     pcm_file_gs_uri = upload_file_to_bucket(f"{partial_id}.wav", pcm_file_path, bucket_name=BUCKET_OUTPUT_AUDIO_PCM_ENCODED)
+    #     log.info(f"Saved local pcm encoded file to bucket {BUCKET_OUTPUT_AUDIO_PCM_ENCODED}")
 
     # # Transcribe and specify destination for output using call partial id
     # destination_uri = f"gs://{BUCKET_OUTPUT_RAW_EXTRACT}/{call_id}-{partial_id}-{audio_partial_id}.json"
     # log.info(f"Beginning long-running transcription of pcm encoded wave file using Google Speech to Text.")
-    # transcribe_model_selection(pcm_file_gs_uri, destination_uri, sample_rate_hertz=sample_rate)
+    # submit = lambda: transcribe_model_selection(pcm_file_gs_uri, destination_uri, sample_rate_hertz=sample_rate)
+    # if speech_admission_controller:
+    #     # raises SpeechQuotaExhaustedError straight away when over quota, to defer the event
+    #     duration_seconds = wav_header.duration_seconds if wav_header else 0.0
+    #     speech_admission_controller.submit(submit, audio_seconds=duration_seconds)
+    # else:
+    #     submit()
     # # TODO: See if timeouts mean failure and this will reprocess from dead-letter queue
     # # Otherwise, figure out how to not make this blocking
     # log.info(f"Finished calling long-running transcription of pcm encoded file using Google Speech to Text with destination uri: {destination_uri}")
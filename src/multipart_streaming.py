@@ -0,0 +1,269 @@
+import io
+import logging
+import os
+import uuid
+import weakref
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Union,
+)
+
+from urllib3.response import HTTPResponse
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# file-like object, upstream urllib3 response, bytes, str or an iterable of bytes such as a generator
+MultipartSource = Any
+
+# sources that can't be rewound and have been streamed already, so a retry fails instead of sending an empty part
+_consumed_sources: "weakref.WeakSet" = weakref.WeakSet()
+
+
+def is_rewindable(source: MultipartSource) -> bool:
+    """Whether every read of source starts from the beginning. Generators, iterators and unseekable streams can only be read once."""
+    if isinstance(source, (bytes, str)):
+        return True
+    if hasattr(source, "read"):
+        return hasattr(source, "seekable") and source.seekable()
+    return iter(source) is not source  # an iterable that isn't its own iterator, e.g. a list, starts over each time
+
+
+def is_consumed(source: MultipartSource) -> bool:
+    try:
+        return source in _consumed_sources
+    except TypeError:
+        return False  # not weakly referenceable, only the part that read it knows
+
+
+def guess_filename(source: MultipartSource) -> Optional[str]:
+    """Same rules as requests, so the server sees the same filenames as it did with session.patch(files=...)"""
+    name = getattr(source, "name", None)
+    if name and isinstance(name, str) and name[0] != "<" and name[-1] != ">":
+        return os.path.basename(name)
+    return None
+
+
+def quote_header_param(value: str) -> str:
+    # matches urllib3's html5 formatting which requests uses for multipart bodies
+    return value.replace("\\", "\\\\").replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+
+class MultipartPart(object):
+    def __init__(self, name: str, source: MultipartSource, filename: str = None, content_type: str = None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+        self.name = name
+        self.source = source
+        self.filename = filename if filename is not None else (guess_filename(source) or name)
+        self.content_type = content_type
+        self.chunk_size = chunk_size
+        self._consumed = False
+
+        if isinstance(source, HTTPResponse) and source.tell():
+            # an upstream response can't be rewound, sending the rest of it would corrupt the upload
+            raise Exception(f"Cannot stream multipart field name='{name}'. Upstream response has already been partially read.")
+        if is_consumed(source):
+            raise Exception(f"Cannot stream multipart field name='{name}'. Its source can't be rewound and was already sent, e.g. by an earlier attempt.")
+
+    def _mark_consumed(self) -> None:
+        if self._consumed:
+            raise Exception(f"Cannot stream multipart field name='{self.name}' again. Its source can't be rewound and was already sent.")
+        self._consumed = True
+        try:
+            _consumed_sources.add(self.source)
+        except TypeError:
+            pass  # e.g. list iterators can't be weakly referenced, the part's own flag still guards it
+
+    def render_headers(self) -> bytes:
+        headers = f'Content-Disposition: form-data; name="{quote_header_param(self.name)}"; filename="{quote_header_param(self.filename)}"\r\n'
+        if self.content_type:
+            headers += f"Content-Type: {self.content_type}\r\n"
+        return f"{headers}\r\n".encode("utf-8")
+
+    def get_length(self) -> Optional[int]:
+        """Returns the size of the body of this part in bytes, or None if it can't be known without reading it."""
+        source = self.source
+        if isinstance(source, bytes):
+            return len(source)
+
+        if isinstance(source, str):
+            return sum(len(source[i : i + self.chunk_size].encode("utf-8")) for i in range(0, len(source), self.chunk_size))
+
+        if isinstance(source, HTTPResponse):
+            return source.length_remaining
+
+        if isinstance(source, io.TextIOBase):
+            return None  # text streams have to be encoded to be measured
+
+        if hasattr(source, "fileno"):
+            try:
+                return os.fstat(source.fileno()).st_size
+            except (io.UnsupportedOperation, OSError):
+                pass
+
+        if hasattr(source, "seek") and hasattr(source, "tell"):
+            try:
+                position = source.tell()
+                length = source.seek(0, io.SEEK_END)
+                source.seek(position)
+                return length
+            except (io.UnsupportedOperation, OSError):
+                pass
+
+        return None
+
+    def iter_body(self) -> Iterator[bytes]:
+        """Yields the body of this part. Raises for sources that can't be rewound if they've been sent before."""
+        if is_rewindable(self.source):
+            yield from self._iter_source()
+            return
+
+        self._mark_consumed()
+        sent_bytes = 0
+        for chunk in self._iter_source():
+            sent_bytes += len(chunk)
+            yield chunk
+        if not sent_bytes:
+            # most likely exhausted by an attempt the guards above couldn't see, an empty part would be uploaded as if it were the file
+            raise Exception(f"Cannot stream multipart field name='{self.name}'. Its source can't be rewound and produced no data.")
+
+    def _iter_source(self) -> Iterator[bytes]:
+        source = self.source
+        chunk_size = self.chunk_size
+
+        if isinstance(source, bytes):
+            for i in range(0, len(source), chunk_size):
+                yield source[i : i + chunk_size]
+            return
+
+        if isinstance(source, str):
+            for i in range(0, len(source), chunk_size):
+                yield source[i : i + chunk_size].encode("utf-8")
+            return
+
+        if hasattr(source, "read"):
+            if hasattr(source, "seekable") and source.seekable():
+                source.seek(0)  # seekable sources are always sent whole, which is what makes a retry safe
+
+            while True:
+                chunk = source.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+
+        for chunk in source:  # generators and other iterables of bytes
+            yield chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+
+
+class StreamingMultipartEncoder(object):
+    """
+    multipart/form-data body which is produced chunk by chunk instead of being built in memory by requests.
+
+    Pass it as data along with its content type, e.g.:
+
+        encoder = StreamingMultipartEncoder({"audio/WAV": file})
+        session.patch(url, data=encoder, headers={"Content-Type": encoder.content_type})
+
+    When the size of every part can be known up front, requests sends a Content-Length and reads the body with read().
+    Otherwise (generators, text streams, upstream responses without Content-Length) it's sent with chunked transfer encoding.
+    """
+
+    def __init__(
+        self,
+        fields: Union[Dict[str, MultipartSource], List[MultipartPart]],
+        boundary: str = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        progress_callback: Callable[[int, Optional[int]], None] = None,
+    ) -> None:
+        if isinstance(fields, dict):
+            fields = [MultipartPart(name, source, chunk_size=chunk_size) for name, source in fields.items()]
+
+        self.parts: List[MultipartPart] = fields
+        self.boundary = boundary if boundary else uuid.uuid4().hex
+        self.chunk_size = chunk_size
+        self.progress_callback = progress_callback
+
+        self.bytes_sent = 0
+        self._length = self._compute_length()
+        self._iterator: Optional[Iterator[bytes]] = None
+        self._buffer = b""
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    @property
+    def len(self) -> Optional[int]:
+        """Total size of the body in bytes, or None if it must be sent chunked. requests uses this for Content-Length."""
+        return self._length
+
+    def _compute_length(self) -> Optional[int]:
+        length = len(self._render_closing_boundary())
+        for part in self.parts:
+            part_length = part.get_length()
+            if part_length is None:
+                return None
+            length += len(self._render_opening_boundary()) + len(part.render_headers()) + part_length + len(b"\r\n")
+        return length
+
+    def _render_opening_boundary(self) -> bytes:
+        return f"--{self.boundary}\r\n".encode("utf-8")
+
+    def _render_closing_boundary(self) -> bytes:
+        return f"--{self.boundary}--\r\n".encode("utf-8")
+
+    def _iter_encoded(self) -> Iterator[bytes]:
+        for part in self.parts:
+            yield self._render_opening_boundary() + part.render_headers()
+            for chunk in part.iter_body():
+                if chunk:
+                    yield chunk
+            yield b"\r\n"
+        yield self._render_closing_boundary()
+
+    def _report_progress(self, chunk: bytes) -> bytes:
+        self.bytes_sent += len(chunk)
+        if self.progress_callback:
+            self.progress_callback(self.bytes_sent, self._length)
+        return chunk
+
+    def __iter__(self) -> Iterator[bytes]:
+        """Used by requests when sending with chunked transfer encoding."""
+        for chunk in self._iter_encoded():
+            yield self._report_progress(chunk)
+
+    def read(self, size: int = -1) -> bytes:
+        """Used by http.client when sending with a known Content-Length."""
+        if self._iterator is None:
+            self._iterator = self._iter_encoded()
+
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._iterator, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+
+        if size < 0:
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+
+        return self._report_progress(data) if data else data
+
+
+def log_upload_progress(description: str, every_bytes: int = 10 * 1024 * 1024) -> Callable[[int, Optional[int]], None]:
+    """Returns a progress_callback which logs roughly every every_bytes."""
+    state = {"next_log_at": every_bytes}
+
+    def progress_callback(bytes_sent: int, total_bytes: Optional[int]) -> None:
+        if bytes_sent >= state["next_log_at"] or bytes_sent == total_bytes:
+            log.info(f"Uploading {description}. bytes_sent='{bytes_sent}' total_bytes='{total_bytes}'")
+            state["next_log_at"] = bytes_sent + every_bytes
+
+    return progress_callback
@@ -1,24 +1,42 @@
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import (
+    datetime,
+    timedelta,
+)
 import logging
+import time
 from typing import (
+    Any,
     Callable,
     Dict,
+    Iterator,
     List,
+    Optional,
+    Tuple,
 )
 from urllib3.response import HTTPResponse
 
-from pydantic import (
-    BaseModel,
-    parse_obj_as,
-)
+from pydantic import BaseModel
 import requests
 import requests.compat
 
-from api_client import APIClient
+from api_client import (
+    APIClient,
+    TokenBucketRateLimiter,
+    with_retries,
+)
+from response_decoding import (
+    decode_json,
+    parse_model,
+    parse_model_list,
+)
 
 
 log = logging.getLogger(__name__)
 
+NETSAPIENS_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+DEFAULT_PAGE_SIZE = 100
+
 
 class NetsapiensAuthToken(BaseModel):
     # Expected format as of 2022-02-22
@@ -28,6 +46,7 @@ class NetsapiensAuthToken(BaseModel):
     displayName: str  # USER NAME
     domain: str  # e.g. "Peerlogic"
     expires_in: int  # e.g. "3600"
+    rate_limit: Optional[str]  # e.g. "0", yes this is a string and not a number
     refresh_token: str  # alphanumberic
     scope: str  # e.g. "Super User"
     territory: str  # "Peerlogic"
@@ -53,6 +72,17 @@ class NetsapiensRefreshToken(BaseModel):
     uid: str  # e.g. "1234@Peerlogic"
 
 
+class RecordingNotReadyError(Exception):
+    """
+    Netsapiens hasn't finished with the recording yet, either it hasn't been generated or it's still unconverted.
+    Retrying later is expected to succeed. duration_seconds is the recording's length when known, conversion time scales with it.
+    """
+
+    def __init__(self, msg: str, duration_seconds: Optional[int] = None) -> None:
+        super().__init__(msg)
+        self.duration_seconds = duration_seconds
+
+
 class NetsapiensRecordingUrl(BaseModel):
     status: str  # unconverted, converted, archived
     call_id: str  # typically the orig_callid, also term_callid
@@ -65,14 +95,39 @@ class NetsapiensRecordingUrl(BaseModel):
     size: int  # 0, 4096 may be the smallest we see
 
 
+class NetsapiensCdr2(BaseModel):
+    # Only the fields we rely on, Netsapiens returns many more which are kept as extras
+    orig_callid: Optional[str]
+    term_callid: Optional[str]
+    time_start: Optional[datetime]
+    time_release: Optional[datetime]
+    duration: Optional[int]  # in seconds
+
+    class Config:
+        extra = "allow"
+
+
+def shard_date_range(start: datetime, end: datetime, shard_count: int) -> List[Tuple[datetime, datetime]]:
+    """
+    Splits [start, end) into shard_count contiguous ranges of (nearly) equal length, aligned to whole seconds since
+    that's the resolution Netsapiens filters on. Each backfill worker takes the range at its own index.
+    """
+    if shard_count < 1:
+        raise ValueError(f"shard_count must be at least 1. shard_count='{shard_count}'")
+
+    total_seconds = int((end - start).total_seconds())
+    boundaries = [start + timedelta(seconds=total_seconds * i // shard_count) for i in range(shard_count)] + [end]
+    return [(boundaries[i], boundaries[i + 1]) for i in range(shard_count) if boundaries[i] < boundaries[i + 1]]
+
+
 def transform_to_netsapiens_recording_urls(response: requests.Response) -> List[NetsapiensRecordingUrl]:
     # attempt to get response content as json
     try:
-        recording_urls = response.json()
+        recording_urls = decode_json(response)
     except requests.exceptions.JSONDecodeError:
         msg = "Problem attempting to retrieve JSON response for recording urls. No JSON in response. No recording URLs found. It's expected that this may happen if a recording hasn't yet been generated."
         log.info(msg)
-        raise Exception(msg)
+        raise RecordingNotReadyError(msg)
 
     # detect typing and normalize to list
     if type(recording_urls) == dict:
@@ -87,7 +142,7 @@ def transform_to_netsapiens_recording_urls(response: requests.Response) -> List[
         raise Exception(msg)
 
     # convert and validate structure
-    recording_urls = parse_obj_as(List[NetsapiensRecordingUrl], recording_urls)
+    recording_urls = parse_model_list(NetsapiensRecordingUrl, recording_urls)
 
     return recording_urls
 
@@ -105,9 +160,14 @@ def get_full_and_ready_netsapiens_recording_url(netsapiens_recording_urls: List[
 
         # check if converted / ready
         if full_recording_url.status == "unconverted":
-            raise Exception(f"Full recording is not ready. Status in 'unconverted' full_recording_url'{full_recording_url}'")
+            raise RecordingNotReadyError(
+                f"Full recording is not ready. Status in 'unconverted' full_recording_url'{full_recording_url}'",
+                duration_seconds=int(full_recording_url.duration),
+            )
 
         return full_recording_url
+    except RecordingNotReadyError:
+        raise  # callers defer these instead of failing
     except Exception as e:
         msg = f"Problem occurred getting the largest url from netsapiens_recording_urls='{netsapiens_recording_urls}'."
         raise Exception(msg) from e
@@ -122,6 +182,10 @@ class NetsapiensAPIClient(APIClient):
         self._netsapiens_auth_url = requests.compat.urljoin(root_api_url, "oauth2/token/")
         self._netsapiens_cdr2_url = root_api_url
 
+        # kept so the client can log in again on its own once the refresh token is no good
+        self._credentials: Optional[Dict[str, str]] = None
+        self._token_expires_at: Optional[float] = None  # time.monotonic() based
+
     def get_auth_url(self) -> str:
         return self._netsapiens_auth_url
 
@@ -135,11 +199,25 @@ class NetsapiensAPIClient(APIClient):
 
         return s
 
-    def login(self, username: str, password: str, client_id: str, client_secret: str, request: Callable = requests.request) -> requests.Response:
+    def get_token_expires_in(self) -> Optional[float]:
+        """Seconds until the access token expires, or None if not logged in."""
+        if self._token_expires_at is None:
+            return None
+        return self._token_expires_at - time.monotonic()
+
+    def login(
+        self, username: str = None, password: str = None, client_id: str = None, client_secret: str = None, request: Callable = None
+    ) -> requests.Response:
         """
-        Perform a login, grabbing an auth token.
+        Perform a login, grabbing an auth token. Credentials default to those of the previous login.
         """
+        if username is None:
+            if not self._credentials:
+                raise TypeError("Credentials are required for the first login.")
+            username, password, client_id, client_secret = (self._credentials[k] for k in ("username", "password", "client_id", "client_secret"))
+
         try:
+            requested_at = time.monotonic()
             headers = {"Content-Type": "application/x-www-form-urlencoded"}  # explicitly set even though it's not necessary
             payload = {
                 "username": username,
@@ -152,22 +230,76 @@ class NetsapiensAPIClient(APIClient):
 
             url = self.get_auth_url()
             log.info(f"Authing into url='{url}' as username: '{username}'")
+            session = self.create_session()
+            if request is None:
+                request = session.request  # the auth request's connection is reused by the authorized session
             auth_response = request("POST", url, headers=headers, data=payload)
             auth_response.raise_for_status()
 
             # parse response
             self._auth_token = NetsapiensAuthToken.parse_obj(auth_response.json())
+            self._token_expires_at = requested_at + self._auth_token.expires_in
+            self._credentials = {"username": username, "password": password, "client_id": client_id, "client_secret": client_secret}
 
             # Session and Authorization header construction
             access_token = self._auth_token.access_token
-            self._session = requests.Session()
+            session.cookies.clear()  # only the bearer token should authorize later requests
+            self._session = session
             self._session.headers.update({"Authorization": f"Bearer {access_token}"})
 
+            # honor the rate limit Netsapiens assigns to this token instead of discovering it through 429s
+            self.rate_limiter = TokenBucketRateLimiter.from_netsapiens_rate_limit(self._auth_token.rate_limit)
+
             return auth_response
         except Exception as e:
             msg = f"Problem occurred authenticating to url '{url}'."
             raise Exception(msg) from e
 
+    def refresh_token(self, refresh_token: str = None, request: Callable = None) -> requests.Response:
+        """Exchange the refresh token for a new access token, cheaper for Netsapiens than a password login."""
+        if not self._credentials:
+            raise TypeError("Must call the login() method before refreshing the token.")
+
+        try:
+            if refresh_token is None:
+                refresh_token = self._auth_token.refresh_token
+
+            headers = {"Content-Type": "application/x-www-form-urlencoded"}  # explicitly set even though it's not necessary
+            url = self.get_auth_url()
+            payload = {
+                "grant_type": "refresh_token",
+                "refresh_token": refresh_token,
+                "client_id": self._credentials["client_id"],
+                "client_secret": self._credentials["client_secret"],
+                "format": "json",
+            }
+
+            log.info(f"Re-authing into url='{url}'")
+            requested_at = time.monotonic()
+            session = self.create_session()
+            if request is None:
+                request = session.request  # the auth request's connection is reused by the authorized session
+            auth_response = request("POST", url, headers=headers, data=payload)
+            auth_response.raise_for_status()
+
+            # parse response
+            self._auth_token = NetsapiensRefreshToken.parse_obj(auth_response.json())
+            self._token_expires_at = requested_at + self._auth_token.expires_in
+
+            # Session and Authorization header construction
+            access_token = self._auth_token.access_token
+            session.cookies.clear()  # only the bearer token should authorize later requests
+            self._session = session
+            self._session.headers.update({"Authorization": f"Bearer {access_token}"})
+
+            self.rate_limiter = TokenBucketRateLimiter.from_netsapiens_rate_limit(self._auth_token.rate_limit)
+
+            return auth_response
+        except Exception as e:
+            msg = f"Problem occurred refreshing token at url '{url}'."
+            raise Exception(msg) from e
+
+    @with_retries
     def get_cdr2(self, orig_callid: str, term_callid: str, session: requests.Session = None) -> Dict:
         try:
             response = None  # define for proper logging as needed
@@ -181,13 +313,14 @@ class NetsapiensAPIClient(APIClient):
             response = session.get(url=url, params=params)
             response.raise_for_status()
 
-            return response.json()
+            return decode_json(response)
         except Exception as e:
             msg = f"Problem occurred extracting from url '{url}'."
             if response is not None and response.text:
                 msg = f"{msg}. Response text: '{response.text}'. Response code: '{response.status_code}'"
             raise Exception(msg) from e
 
+    @with_retries
     def get_recording_urls(self, orig_callid: str, term_callid: str, session: requests.Session = None) -> HTTPResponse:
         try:
             response = None  # define for proper logging as needed
@@ -208,14 +341,23 @@ class NetsapiensAPIClient(APIClient):
                 msg = f"{msg}. Response text: '{response.text}'. Response code: '{response.status_code}'"
             raise Exception(msg) from e
 
-    def get_recording_file(self, url: str, session: requests.Session = None) -> HTTPResponse:
+    @with_retries
+    def get_recording_file(self, url: str, session: requests.Session = None, start_byte: int = 0) -> HTTPResponse:
+        """
+        Streams the recording. With start_byte, only the rest of the recording is requested, check the response status
+        since servers that don't support ranges answer with 200 and the whole file instead of 206.
+        """
         try:
             response = None  # define for proper logging as needed
 
             if not session:
                 session = self.get_session()
 
-            response = session.get(url, stream=True)
+            headers = {"Accept-Encoding": "identity"}  # byte offsets must refer to the recording itself for ranges to work
+            if start_byte:
+                headers["Range"] = f"bytes={start_byte}-"
+
+            response = session.get(url, headers=headers, stream=True)
             response.raise_for_status()
 
             return response.raw
@@ -224,3 +366,68 @@ class NetsapiensAPIClient(APIClient):
             if response is not None and response.text:
                 msg = f"{msg}. Response text: '{response.text}'. Response code: '{response.status_code}'"
             raise Exception(msg) from e
+
+    #
+    # Paginated listings
+    #
+
+    @with_retries
+    def get_page(self, params: Dict[str, Any], offset: int, limit: int, session: requests.Session = None) -> List[Dict]:
+        """One page of a read action as raw records. Netsapiens answers an empty page with no JSON at all."""
+        try:
+            response = None  # define for proper logging as needed
+
+            if not session:
+                session = self.get_session()
+
+            url = self.root_api_url
+            response = session.get(url=url, params={**params, "format": "json", "limit": limit, "offset": offset})
+            response.raise_for_status()
+
+            if not response.content.strip():
+                return []
+            records = decode_json(response)
+            return [records] if isinstance(records, dict) else records
+        except Exception as e:
+            msg = f"Problem occurred reading page from url='{url}', params='{params}', offset='{offset}'."
+            if response is not None and response.text:
+                msg = f"{msg}. Response text: '{response.text}'. Response code: '{response.status_code}'"
+            raise Exception(msg) from e
+
+    def iter_pages(self, params: Dict[str, Any], page_size: int = DEFAULT_PAGE_SIZE) -> Iterator[List[Dict]]:
+        """
+        Yields pages until a short one, fetching the next page in the background while the caller works on the current one.
+        Stopping early is fine, at most one page is fetched that isn't used.
+        """
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="netsapiens-prefetch")
+        try:
+            offset = 0
+            next_page = executor.submit(self.get_page, params, offset, page_size)
+            while next_page is not None:
+                page = next_page.result()
+                offset += len(page)
+                next_page = executor.submit(self.get_page, params, offset, page_size) if len(page) >= page_size else None
+                if page:
+                    yield page
+        finally:
+            executor.shutdown(wait=False)
+
+    def iter_cdr2(self, start_date: datetime, end_date: datetime, page_size: int = DEFAULT_PAGE_SIZE, **filters: Any) -> Iterator[NetsapiensCdr2]:
+        """CDRs for calls in [start_date, end_date), e.g. one shard from shard_date_range. Records are parsed as they're reached."""
+        params = {
+            "object": "cdr2",
+            "action": "read",
+            "start_date": start_date.strftime(NETSAPIENS_DATETIME_FORMAT),
+            "end_date": (end_date - timedelta(seconds=1)).strftime(NETSAPIENS_DATETIME_FORMAT),  # Netsapiens' end_date is inclusive
+            **filters,
+        }
+        for page in self.iter_pages(params, page_size):
+            for record in page:
+                yield parse_model(NetsapiensCdr2, record)
+
+    def iter_recording_urls(self, page_size: int = DEFAULT_PAGE_SIZE, **filters: Any) -> Iterator[NetsapiensRecordingUrl]:
+        """Recordings matching the filters, e.g. orig_callid and term_callid. Records are parsed as they're reached."""
+        params = {"object": "recording", "action": "read", **filters}
+        for page in self.iter_pages(params, page_size):
+            for record in page:
+                yield parse_model(NetsapiensRecordingUrl, record)
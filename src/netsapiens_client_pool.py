@@ -0,0 +1,138 @@
+from collections import OrderedDict
+import hashlib
+import logging
+import threading
+import time
+from typing import (
+    Callable,
+    Dict,
+    Tuple,
+)
+
+from netsapiens_api_client import NetsapiensAPIClient
+from peerlogic_api_client import PeerlogicAPIClient
+from peerlogic_api_models import NetsapiensAPICredentials
+from ttl_lru_cache import TTLLRUCache
+
+
+log = logging.getLogger(__name__)
+
+
+def get_credentials_fingerprint(credentials: NetsapiensAPICredentials) -> str:
+    """Changes whenever anything used to log in changes, without keeping the secrets themselves around as a key."""
+    material = "\0".join((credentials.api_url, credentials.client_id, credentials.client_secret, credentials.username, credentials.password))
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class PooledNetsapiensClient(object):
+    def __init__(self, client: NetsapiensAPIClient, fingerprint: str) -> None:
+        self.client = client
+        self.fingerprint = fingerprint
+        self.lock = threading.Lock()  # one login or refresh at a time per client
+
+
+class NetsapiensClientPool(object):
+    """
+    Authenticated NetsapiensAPIClients, one per voip provider and credentials record.
+
+    Tokens are reused until they're within refresh_margin_seconds of expiring, then refreshed (or logged in again if
+    the refresh fails). Credentials are looked up from the Peerlogic API at most once per credentials_ttl_seconds per
+    provider, and a client is replaced when its credentials change. The least recently used client is dropped once
+    there are more than max_clients.
+    """
+
+    def __init__(
+        self,
+        peerlogic_api_client: PeerlogicAPIClient,
+        max_clients: int = 32,
+        refresh_margin_seconds: float = 5 * 60,
+        credentials_ttl_seconds: float = 5 * 60,
+        client_factory: Callable[[str], NetsapiensAPIClient] = NetsapiensAPIClient,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._peerlogic_api_client = peerlogic_api_client
+        self.max_clients = max_clients
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.credentials_ttl_seconds = credentials_ttl_seconds
+        self._client_factory = client_factory
+
+        self._lock = threading.Lock()
+        self._credentials = TTLLRUCache(max_entries=max_clients, clock=clock)
+        self._clients: "OrderedDict[Tuple[str, str], PooledNetsapiensClient]" = OrderedDict()
+
+        self.logins = 0
+        self.refreshes = 0
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    def get_client(self, voip_provider_id: str) -> NetsapiensAPIClient:
+        credentials = self._get_credentials(voip_provider_id)
+        if not credentials.active:
+            raise Exception(f"Netsapiens API credentials id='{credentials.id}' for voip_provider_id='{voip_provider_id}' are not active.")
+
+        key = (voip_provider_id, credentials.id)
+        fingerprint = get_credentials_fingerprint(credentials)
+        with self._lock:
+            pooled = self._clients.get(key)
+            if pooled is not None and pooled.fingerprint != fingerprint:
+                log.info(f"Netsapiens API credentials id='{credentials.id}' changed for voip_provider_id='{voip_provider_id}'. Replacing client.")
+                pooled = None
+
+            if pooled is None:
+                # credentials records may be replaced rather than updated, drop clients for the provider's old records
+                for stale_key in [k for k in self._clients if k[0] == voip_provider_id]:
+                    del self._clients[stale_key]
+                pooled = self._clients[key] = PooledNetsapiensClient(self._client_factory(credentials.api_url), fingerprint)
+
+            self._clients.move_to_end(key)
+            while len(self._clients) > self.max_clients:
+                evicted_key, _ = self._clients.popitem(last=False)
+                log.info(f"Evicted Netsapiens client for voip_provider_id='{evicted_key[0]}' from the pool.")
+
+        with pooled.lock:
+            self._ensure_authenticated(pooled.client, credentials)
+
+        return pooled.client
+
+    def invalidate(self, voip_provider_id: str) -> None:
+        """Forgets the provider's credentials and clients, e.g. after they were rejected."""
+        with self._lock:
+            self._credentials.delete(voip_provider_id)
+            for key in [k for k in self._clients if k[0] == voip_provider_id]:
+                del self._clients[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._credentials.clear()
+            self._clients.clear()
+
+    def _get_credentials(self, voip_provider_id: str) -> NetsapiensAPICredentials:
+        with self._lock:
+            credentials = self._credentials.get(voip_provider_id)
+        if credentials is not None:
+            return credentials
+
+        credentials = self._peerlogic_api_client.get_netsapiens_api_credentials(voip_provider_id)
+        with self._lock:
+            self._credentials.set(voip_provider_id, credentials, self.credentials_ttl_seconds)
+        return credentials
+
+    def _ensure_authenticated(self, client: NetsapiensAPIClient, credentials: NetsapiensAPICredentials) -> None:
+        expires_in = client.get_token_expires_in()
+        if expires_in is not None and expires_in > self.refresh_margin_seconds:
+            return
+
+        if expires_in is not None:
+            try:
+                client.refresh_token()
+                self.refreshes += 1
+                return
+            except Exception:
+                log.exception(f"Problem occurred refreshing Netsapiens token for credentials id='{credentials.id}'. Logging in again.")
+
+        client.login(credentials.username, credentials.password, credentials.client_id, credentials.client_secret)
+        self.logins += 1
+
+    def get_stats(self) -> Dict[str, int]:
+        return {"clients": len(self._clients), "logins": self.logins, "refreshes": self.refreshes}
@@ -1,16 +1,15 @@
 from datetime import (
     datetime,
 )
-import io
 import logging
 import os
 from typing import (
     Callable,
     Dict,
     List,
+    Optional,
 )
 
-from pydantic import parse_obj_as
 import requests
 import requests.compat
 from urllib3.response import HTTPResponse
@@ -21,6 +20,10 @@ from api_client import (
     extract_and_transform,
     requires_auth,
 )
+from multipart_streaming import (
+    StreamingMultipartEncoder,
+    log_upload_progress,
+)
 from peerlogic_api_models import (
     CallOutcome,
     CallOutcomeReason,
@@ -30,6 +33,11 @@ from peerlogic_api_models import (
     TelecomCallerNameInfo,
 )
 from netsapiens_api_client import NetsapiensAuthToken, NetsapiensRefreshToken
+from response_decoding import (
+    decode_json,
+    parse_model,
+    parse_model_list,
+)
 
 
 log = logging.getLogger(__name__)
@@ -40,37 +48,37 @@ def transform_to_bytes(response: requests.Response) -> bytes:
 
 
 def transform_to_call_transcript(response: requests.Response) -> List[CallTranscript]:
-    data = response.json()
+    data = decode_json(response)
     transcript_count = data.get("count")
     transcript_list = data.get("results")
 
-    return parse_obj_as(List[CallTranscript], transcript_list)
+    return parse_model_list(CallTranscript, transcript_list)
 
 
 def transform_to_call_outcome(response: requests.Response) -> CallOutcome:
-    return CallOutcome(**response.json())
+    return parse_model(CallOutcome, decode_json(response))
 
 
 def transform_to_call_outcome_reason(response: requests.Response) -> CallOutcomeReason:
-    return CallOutcomeReason(**response.json())
+    return parse_model(CallOutcomeReason, decode_json(response))
 
 
 def transform_to_call_purpose(response: requests.Response) -> CallPurpose:
-    return CallPurpose(**response.json())
+    return parse_model(CallPurpose, decode_json(response))
 
 
 def transform_to_netsapiens_api_credentials(response: requests.Response) -> NetsapiensAPICredentials:
-    data = response.json()
+    data = decode_json(response)
     credentials_count = data.get("count")
     credentials_list = data.get("results")
     if credentials_count == 0:
         raise Exception(f"No active credentials found from url='{response.request.url}'")
 
-    return NetsapiensAPICredentials(**credentials_list[0])
+    return parse_model(NetsapiensAPICredentials, credentials_list[0])
 
 
 def transform_to_telecom_caller_name_info(response: requests.Response) -> TelecomCallerNameInfo:
-    return TelecomCallerNameInfo(**response.json())
+    return parse_model(TelecomCallerNameInfo, decode_json(response))
 
 
 class PeerlogicAPIClient(APIClient):
@@ -176,7 +184,7 @@ class PeerlogicAPIClient(APIClient):
 
         return s
 
-    def login(self, username: str = None, password: str = None, request: Callable = requests.request) -> requests.Response:
+    def login(self, username: str = None, password: str = None, request: Callable = None) -> requests.Response:
         """Perform a login, grabbing an auth token."""
         try:
             # allow one-time overrides when calling login
@@ -193,6 +201,9 @@ class PeerlogicAPIClient(APIClient):
 
             url = self.get_auth_url()
             log.info(f"Authing into url='{url}' as username: '{username}'")
+            session = self.create_session()
+            if request is None:
+                request = session.request  # the auth request's connection is reused by the authorized session
             auth_response = request("POST", url, headers=headers, data=payload)
             auth_response.raise_for_status()
 
@@ -201,7 +212,8 @@ class PeerlogicAPIClient(APIClient):
 
             # Session and Authorization header construction
             access_token = self._auth_token.access_token
-            self._session = requests.Session()
+            session.cookies.clear()  # only the bearer token should authorize later requests
+            self._session = session
             self._session.headers.update({"Authorization": f"Bearer {access_token}"})
 
             return auth_response
@@ -211,7 +223,7 @@ class PeerlogicAPIClient(APIClient):
                 msg = f"{msg}. Response text: '{response.text}'"
             raise Exception(msg) from e
 
-    def refresh_token(self, refresh_token: str = None, request: Callable = requests.request) -> requests.Response:
+    def refresh_token(self, refresh_token: str = None, request: Callable = None) -> requests.Response:
         try:
             if refresh_token is None:
                 refresh_token = self._auth_token.refresh_token
@@ -223,6 +235,9 @@ class PeerlogicAPIClient(APIClient):
 
             url = self.get_auth_url()
             log.info(f"Re-authing into url='{url}'")
+            session = self.create_session()
+            if request is None:
+                request = session.request  # the auth request's connection is reused by the authorized session
             auth_response = request("POST", url, headers=headers, data=payload)
             auth_response.raise_for_status()
 
@@ -231,7 +246,8 @@ class PeerlogicAPIClient(APIClient):
 
             # Session and Authorization header construction
             access_token = self._auth_token.access_token
-            self._session = requests.Session()
+            session.cookies.clear()  # only the bearer token should authorize later requests
+            self._session = session
             self._session.headers.update({"Authorization": f"Bearer {access_token}"})
 
             return auth_response
@@ -290,6 +306,40 @@ class PeerlogicAPIClient(APIClient):
         response = session.get(url=url)
         return response
 
+    def get_call_audio_partial_signed_url(self, call_id: str, call_partial_id: str, call_audio_partial_id: str) -> str:
+        call_audio_data: requests.Response = self.get_call_audio_partial(call_id, call_partial_id, call_audio_partial_id)
+        return call_audio_data.json().get("signed_url")
+
+    @extract_and_transform(transform_to_bytes)
+    @requires_auth
+    def get_signed_url_file(self, signed_url: str, session: requests.Session = None) -> requests.Response:
+        """Downloads a file by signed url, e.g. from get_call_audio_partial_signed_url. Useful when the url itself is needed too."""
+        if not session:
+            session = self.get_session()
+
+        response = session.get(url=signed_url)
+        return response
+
+    @requires_auth
+    def download_signed_url_file(self, signed_url: str, path: str, chunk_size: int = 1024 * 1024, session: requests.Session = None) -> requests.Response:
+        """
+        Streams a file by signed url to path without holding it in memory. A retried attempt starts the file over.
+        path is only written when the response is ok, check the returned response before reading it.
+        """
+        if not session:
+            session = self.get_session()
+
+        # a copy left by an earlier invocation on this instance must never be mistaken for this download
+        if os.path.exists(path):
+            os.remove(path)
+
+        with session.get(url=signed_url, stream=True) as response:
+            if response.ok:
+                with open(path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+        return response
+
     @extract_and_transform(transform_to_bytes)
     @requires_auth
     def get_call_audio_partial_wav_file(self, call_id: str, call_partial_id: str, call_audio_partial_id: str, session: requests.Session = None) -> requests.Response:
@@ -328,15 +378,26 @@ class PeerlogicAPIClient(APIClient):
 
     @requires_auth
     def finalize_call_audio_partial(
-        self, call_id: str, call_partial_id: str, call_audio_partial_id, file: HTTPResponse, mime_type: str = "audio/WAV", session: requests.Session = None
+        self,
+        call_id: str,
+        call_partial_id: str,
+        call_audio_partial_id,
+        file: HTTPResponse,
+        mime_type: str = "audio/WAV",
+        session: requests.Session = None,
+        progress_callback: Callable[[int, Optional[int]], None] = None,
     ) -> requests.Response:
+        """file may be a file, a generator of bytes or an upstream HTTPResponse. It's streamed rather than read into memory."""
         url = self.get_call_audio_partial_file_patch_url(call_id, call_partial_id, call_audio_partial_id)
-        files = {mime_type: file}
+
+        if not progress_callback:
+            progress_callback = log_upload_progress(f"call_audio_partial_id='{call_audio_partial_id}'")
+        encoder = StreamingMultipartEncoder({mime_type: file}, progress_callback=progress_callback)
 
         if not session:
             session = self.get_session()
 
-        response = session.patch(url=url, files=files)
+        response = session.patch(url=url, data=encoder, headers={"Content-Type": encoder.content_type})
         return response
 
     @requires_auth
@@ -487,10 +548,9 @@ class PeerlogicAPIClient(APIClient):
             session = self.get_session()
 
         url = self.get_call_transcript_partial_url(call_id, call_partial_id, id)
-        file = io.StringIO(transcript_string)
-        files = {mime_type: file}
+        encoder = StreamingMultipartEncoder({mime_type: transcript_string})
 
-        response = session.patch(url=url, files=files)
+        response = session.patch(url=url, data=encoder, headers={"Content-Type": encoder.content_type})
         return response
 
 
@@ -546,3 +606,11 @@ if __name__ == "__main__":
     print(caller_name_info)
     print(caller_name_info.is_business())
     print(caller_name_info.is_consumer_carrier_type())
+
+    # the same number in every format above is a single request when going through the caching lookup
+    from telecom_caller_name_lookup import TelecomCallerNameInfoLookup
+
+    caller_name_info_lookup = TelecomCallerNameInfoLookup(peerlogic_api)
+    for phone_number in ("1 (800) 554-1907", "+18005541907", "8005541907"):
+        print(caller_name_info_lookup.get(phone_number))
+    print(f"hits={caller_name_info_lookup.hits} misses={caller_name_info_lookup.misses}")
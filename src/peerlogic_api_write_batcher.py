@@ -0,0 +1,220 @@
+import atexit
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+import logging
+import threading
+import time
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+)
+
+from peerlogic_api_client import PeerlogicAPIClient
+from peerlogic_api_models import (
+    CallOutcome,
+    CallOutcomeReason,
+    CallPurpose,
+)
+
+
+log = logging.getLogger(__name__)
+
+
+# Writes are flushed one stage at a time so that children are only sent once their parents exist and have ids.
+# Procedures discussed don't depend on anything so they go out with the first stage.
+STAGE_CALL_PURPOSE = 0
+STAGE_CALL_OUTCOME = 1
+STAGE_CALL_OUTCOME_REASON = 2
+STAGES = (STAGE_CALL_PURPOSE, STAGE_CALL_OUTCOME, STAGE_CALL_OUTCOME_REASON)
+
+
+class PendingWrite(object):
+    def __init__(self, stage: int, description: str, write: Callable[[], Any], parent: Optional[Future] = None) -> None:
+        self.stage = stage
+        self.description = description
+        self.write = write
+        self.parent = parent
+        self.future: Future = Future()
+
+    def run(self) -> None:
+        parent_exception = self.parent.exception() if self.parent is not None else None
+        if parent_exception is not None:
+            e = Exception(f"Not writing {self.description} since its parent failed to write.")
+            e.__cause__ = parent_exception
+            self.future.set_exception(e)
+            return
+
+        try:
+            self.future.set_result(self.write())
+        except Exception as e:
+            log.exception(f"Problem occurred writing {self.description}.")
+            self.future.set_exception(e)
+
+
+class PeerlogicAPIWriteBatcher(object):
+    """
+    Write-behind queue for call purposes, outcomes, outcome reasons and procedures discussed.
+
+    Writes are queued and return a Future immediately. Queued writes are flushed when max_batch_size is reached,
+    max_delay_seconds after the oldest queued write, on flush() and on close() (also registered at exit).
+
+    The Peerlogic API has no bulk create endpoints for these resources, so writes within a stage are pipelined
+    concurrently over the client's session. A call's write latency is therefore about one round trip per stage
+    instead of one per record.
+
+    Children may be queued before their parents are written by passing the parent's Future. The parent's id is
+    filled in on the child right before it's sent, e.g.:
+
+        purpose = batcher.create_call_purpose(CallPurpose(call=call_id, ...))
+        outcome = batcher.create_call_outcome(call_id, CallOutcome(call_purpose="", ...), call_purpose=purpose)
+    """
+
+    def __init__(
+        self, peerlogic_api_client: PeerlogicAPIClient, max_batch_size: int = 50, max_delay_seconds: float = 1.0, max_concurrent_writes: int = 8
+    ) -> None:
+        self._client = peerlogic_api_client
+        self.max_batch_size = max_batch_size
+        self.max_delay_seconds = max_delay_seconds
+
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_writes, thread_name_prefix="peerlogic-api-write")
+        self._pending: List[PendingWrite] = []
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # flushes must not interleave or parent-to-child ordering breaks
+        self._oldest_pending_at: Optional[float] = None
+        self._closed = False
+
+        self._wakeup = threading.Event()
+        self._timer_thread = threading.Thread(target=self._flush_on_timer, name="peerlogic-api-write-timer", daemon=True)
+        self._timer_thread.start()
+
+        atexit.register(self.close)
+
+    def __enter__(self) -> "PeerlogicAPIWriteBatcher":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    #
+    # Queueing
+    #
+
+    def create_call_purpose(self, call_purpose: CallPurpose) -> Future:
+        """Queues a call purpose. The Future resolves to the created CallPurpose."""
+        return self._enqueue(
+            PendingWrite(
+                STAGE_CALL_PURPOSE,
+                f"call_purpose for call_id='{call_purpose.call}'",
+                lambda: self._client.create_call_purpose(call_purpose=call_purpose),
+            )
+        )
+
+    def create_call_outcome(self, call_id: str, call_outcome: CallOutcome, call_purpose: Future = None) -> Future:
+        """Queues a call outcome. If call_purpose is given, its id replaces call_outcome.call_purpose once it has been written."""
+
+        def write() -> CallOutcome:
+            outcome = call_outcome
+            if call_purpose is not None:
+                outcome = call_outcome.copy(update={"call_purpose": call_purpose.result().id})
+            return self._client.create_call_outcome(call_id=call_id, call_outcome=outcome)
+
+        return self._enqueue(PendingWrite(STAGE_CALL_OUTCOME, f"call_outcome for call_id='{call_id}'", write, parent=call_purpose))
+
+    def create_call_outcome_reason(self, call_id: str, call_outcome_reason: CallOutcomeReason, call_outcome: Future = None) -> Future:
+        """Queues a call outcome reason. If call_outcome is given, its id replaces call_outcome_reason.call_outcome once it has been written."""
+
+        def write() -> CallOutcomeReason:
+            outcome_reason = call_outcome_reason
+            if call_outcome is not None:
+                outcome_reason = call_outcome_reason.copy(update={"call_outcome": call_outcome.result().id})
+            return self._client.create_call_outcome_reason(call_id=call_id, call_outcome_reason=outcome_reason)
+
+        return self._enqueue(PendingWrite(STAGE_CALL_OUTCOME_REASON, f"call_outcome_reason for call_id='{call_id}'", write, parent=call_outcome))
+
+    def create_procedure_discussed(self, call_id: str, keyword: str) -> Future:
+        """Queues a procedure discussed. The Future resolves to the response."""
+        return self._enqueue(
+            PendingWrite(
+                STAGE_CALL_PURPOSE,
+                f"procedure_discussed keyword='{keyword}' for call_id='{call_id}'",
+                lambda: self._client.create_procedure_discussed(call_id=call_id, keyword=keyword),
+            )
+        )
+
+    def _enqueue(self, pending_write: PendingWrite) -> Future:
+        with self._pending_lock:
+            if self._closed:
+                raise Exception(f"Cannot queue {pending_write.description}. Write batcher is closed.")
+
+            self._pending.append(pending_write)
+            if self._oldest_pending_at is None:
+                self._oldest_pending_at = time.monotonic()
+                self._wakeup.set()  # start the timer for this batch
+            should_flush = len(self._pending) >= self.max_batch_size
+
+        if should_flush:
+            self.flush()
+
+        return pending_write.future
+
+    #
+    # Flushing
+    #
+
+    def flush(self) -> None:
+        """Writes everything queued so far, blocking until done. Failures are reported through each write's Future."""
+        with self._flush_lock:
+            with self._pending_lock:
+                batch, self._pending = self._pending, []
+                self._oldest_pending_at = None
+
+            if not batch:
+                return
+
+            log.info(f"Flushing batch of {len(batch)} Peerlogic API writes.")
+            stages: Dict[int, List[PendingWrite]] = {stage: [] for stage in STAGES}
+            for pending_write in batch:
+                stages[pending_write.stage].append(pending_write)
+
+            for stage in STAGES:
+                futures = [self._executor.submit(pending_write.run) for pending_write in stages[stage]]
+                wait(futures)
+
+    def close(self) -> None:
+        """Flushes remaining writes and stops accepting new ones. Safe to call more than once."""
+        with self._pending_lock:
+            if self._closed:
+                return
+            self._closed = True
+
+        self._wakeup.set()
+        self.flush()
+        self._executor.shutdown(wait=True)
+        atexit.unregister(self.close)
+
+    def _flush_on_timer(self) -> None:
+        # state is re-read on every wakeup, so a wakeup racing with a flush is harmless
+        while True:
+            with self._pending_lock:
+                if self._closed:
+                    return
+                oldest_pending_at = self._oldest_pending_at
+
+            if oldest_pending_at is None:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            remaining = oldest_pending_at + self.max_delay_seconds - time.monotonic()
+            if remaining > 0:
+                self._wakeup.wait(remaining)
+                self._wakeup.clear()
+                continue
+
+            self.flush()
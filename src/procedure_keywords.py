@@ -0,0 +1,242 @@
+from collections import deque
+from concurrent.futures import Future
+import json
+import logging
+import re
+from typing import (
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from peerlogic_api_write_batcher import PeerlogicAPIWriteBatcher
+from speech_to_text import TranscriptWord
+
+
+log = logging.getLogger(__name__)
+
+# Keyword sent to create_procedure_discussed, and the phrases that mean it. The keyword itself always matches.
+# Words that are ordinary front desk speech on their own ("pulled", "consult", "scaling", "cap", "partial") only match in a phrase.
+DEFAULT_PROCEDURE_VOCABULARY: Dict[str, List[str]] = {
+    "exam": ["examination", "checkup", "check up", "check-up", "new patient exam", "comprehensive exam", "periodic exam", "dental evaluation"],
+    "cleaning": ["prophy", "prophylaxis", "hygiene appointment", "teeth cleaning"],
+    "deep cleaning": ["scaling and root planing", "root planing", "deep scaling", "srp"],
+    "periodontal maintenance": ["perio maintenance", "gum maintenance"],
+    "x-ray": ["xray", "x ray", "radiograph", "bitewing", "panoramic x-ray", "pano", "full mouth series", "fmx"],
+    "filling": ["cavity", "composite filling", "amalgam", "tooth colored filling"],
+    "crown": ["dental cap", "tooth cap", "onlay", "inlay"],
+    "root canal": ["endodontic", "root canal therapy", "pulpotomy"],
+    "extraction": ["pull a tooth", "pull the tooth", "tooth pulled", "teeth pulled", "tooth removal", "wisdom teeth", "wisdom tooth"],
+    "implant": ["dental implant", "implant crown", "abutment"],
+    "bridge": ["dental bridge", "fixed bridge"],
+    "dentures": ["denture", "partial dentures", "full denture"],
+    "veneers": ["veneer", "porcelain veneers"],
+    "whitening": ["teeth whitening", "bleaching", "zoom whitening"],
+    "bonding": ["cosmetic bonding", "tooth bonding"],
+    "sealants": ["sealant"],
+    "fluoride": ["fluoride treatment", "fluoride varnish", "varnish"],
+    "orthodontics": ["braces", "invisalign", "clear aligners", "aligners", "retainer"],
+    "night guard": ["nightguard", "mouth guard", "mouthguard", "occlusal guard", "bite guard"],
+    "consultation": ["free consult", "implant consult", "ortho consult", "second opinion"],
+    "emergency": ["toothache", "tooth ache", "broken tooth", "chipped tooth", "abscess", "facial swelling", "gum swelling"],
+}
+
+# Phrases that contain a procedure word without meaning the procedure. Matching one drops the match it contains.
+DEFAULT_EXCLUDED_PHRASES: List[str] = [
+    "filling out",
+    "filling in",
+    "filling up",
+    "cleaning up",
+    "cleaning out",
+    "crown point",
+    "check up on",
+    "check up with",
+]
+
+EXCLUDED = ""  # keyword of excluded phrases
+EXCLUDED_PHRASES_KEY = "_excluded"
+
+NON_WORD_CHARACTERS = re.compile(r"[^a-z0-9]+")
+
+
+def normalize_token(word: str) -> str:
+    """Lower case without punctuation, so "X-rays," and "xrays" compare equal."""
+    return NON_WORD_CHARACTERS.sub("", word.lower())
+
+
+def stem(token: str) -> str:
+    """
+    Plurals only: "fillings" and "filling", "cavities" and "cavity" compare equal. Verb endings are left alone since they
+    change the meaning here, "filled out" isn't a "filling".
+    """
+    if len(token) <= 3:
+        return token
+    if token.endswith("ies") and len(token) > 4:
+        return token[:-3] + "y"
+    if token.endswith(("sses", "xes", "ches", "shes")):
+        return token[:-2]
+    if token.endswith("s") and not token.endswith(("ss", "us", "is")):
+        return token[:-1]
+    return token
+
+
+def tokenize(phrase: str) -> Tuple[str, ...]:
+    tokens = (stem(normalize_token(word)) for word in phrase.split())
+    return tuple(token for token in tokens if token)
+
+
+class ProcedureMatch(NamedTuple):
+    keyword: str
+    phrase: str  # as spoken
+    start_time: float
+    end_time: float
+    channel_tag: int
+
+
+class ProcedureKeywordMatcher(object):
+    """
+    Aho-Corasick automaton over stemmed tokens, built once from the vocabulary. Scanning a transcript is one pass over
+    its words, with a constant amount of work per word however many phrases the vocabulary has.
+
+    Channels are scanned independently, since words ordered by start time interleave both sides of the conversation
+    and a phrase is only ever spoken by one of them. Where phrases overlap and end on the same word, only the longest
+    matches, so "deep cleaning" doesn't also count as "cleaning". Excluded phrases are matched like any other but
+    only to drop the match they contain, so "filling out the forms" isn't a "filling".
+    """
+
+    def __init__(
+        self, vocabulary: Mapping[str, Iterable[str]] = DEFAULT_PROCEDURE_VOCABULARY, excluded_phrases: Iterable[str] = DEFAULT_EXCLUDED_PHRASES
+    ) -> None:
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # longest phrase ending at each state, including through its fail links: (keyword, token count)
+        self._output: List[Optional[Tuple[str, int]]] = [None]
+        self.max_phrase_length = 0
+
+        for keyword, synonyms in vocabulary.items():
+            for phrase in [keyword, *synonyms]:
+                self._add(keyword, phrase)
+        for phrase in excluded_phrases:
+            self._add(EXCLUDED, phrase)
+        self._build_fail_links()
+
+    @classmethod
+    def from_file(cls, path: str) -> "ProcedureKeywordMatcher":
+        """
+        Vocabulary from a JSON object of keyword to a list of synonyms, in the shape of DEFAULT_PROCEDURE_VOCABULARY.
+        Excluded phrases may be given under the "_excluded" key, otherwise the defaults apply.
+        """
+        with open(path, "r") as f:
+            vocabulary = json.load(f)
+        excluded_phrases = vocabulary.pop(EXCLUDED_PHRASES_KEY, DEFAULT_EXCLUDED_PHRASES)
+        return cls(vocabulary, excluded_phrases=excluded_phrases)
+
+    @property
+    def state_count(self) -> int:
+        return len(self._goto)
+
+    def _add(self, keyword: str, phrase: str) -> None:
+        tokens = tokenize(phrase)
+        if not tokens:
+            return
+
+        state = 0
+        for token in tokens:
+            next_state = self._goto[state].get(token)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(None)
+                self._goto[state][token] = next_state
+            state = next_state
+
+        existing = self._output[state]
+        if existing is not None and existing[0] != keyword:
+            log.warning(f"Phrase '{phrase}' is already a synonym of keyword '{existing[0]}', not also matching it as '{keyword}'.")
+            return
+        self._output[state] = (keyword, len(tokens))
+        self.max_phrase_length = max(self.max_phrase_length, len(tokens))
+
+    def _build_fail_links(self) -> None:
+        # breadth first, so a state's fail link is final before its children's are computed from it
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            if self._output[state] is None:
+                self._output[state] = self._output[self._fail[state]]
+            for token, child in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and token not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(token, 0)
+                queue.append(child)
+
+    def _step(self, state: int, token: str) -> int:
+        while state and token not in self._goto[state]:
+            state = self._fail[state]
+        return self._goto[state].get(token, 0)
+
+    def find_matches(self, transcript_words: Iterable[TranscriptWord]) -> List[ProcedureMatch]:
+        """
+        Matches in the order they end, for words ordered by start time as get_transcript_words returns them. A match
+        that contains an earlier one on its channel replaces it, e.g. "scaling and root planing" replaces "scaling".
+        """
+        states: Dict[int, int] = {}
+        positions: Dict[int, int] = {}
+        recent_words: Dict[int, Deque[TranscriptWord]] = {}
+        last_matches: Dict[int, Tuple[int, int]] = {}  # channel_tag: (index in matches, start position)
+        matches: List[Optional[ProcedureMatch]] = []
+        for transcript_word in transcript_words:
+            token = stem(normalize_token(transcript_word.word))
+            if not token:
+                continue  # punctuation only, doesn't break a phrase
+
+            channel_tag = transcript_word.channel_tag
+            if channel_tag not in states:
+                states[channel_tag] = 0
+                positions[channel_tag] = -1
+                recent_words[channel_tag] = deque(maxlen=self.max_phrase_length)
+            state = states[channel_tag] = self._step(states[channel_tag], token)
+            positions[channel_tag] += 1
+            recent_words[channel_tag].append(transcript_word)
+
+            output = self._output[state]
+            if output is None:
+                continue
+            keyword, length = output
+            start_position = positions[channel_tag] - length + 1
+            last_match = last_matches.get(channel_tag)
+            if last_match is not None and last_match[1] >= start_position:
+                matches[last_match[0]] = None
+            if keyword == EXCLUDED:
+                last_matches.pop(channel_tag, None)
+                continue
+
+            phrase_words = list(recent_words[channel_tag])[-length:]
+            last_matches[channel_tag] = (len(matches), start_position)
+            matches.append(
+                ProcedureMatch(
+                    keyword=keyword,
+                    phrase=" ".join(phrase_word.word for phrase_word in phrase_words),
+                    start_time=phrase_words[0].start_time,
+                    end_time=phrase_words[-1].end_time,
+                    channel_tag=channel_tag,
+                )
+            )
+        return [match for match in matches if match is not None]
+
+
+def get_discussed_keywords(matches: Iterable[ProcedureMatch]) -> List[str]:
+    """Distinct keywords in the order they were first discussed."""
+    return list(dict.fromkeys(match.keyword for match in matches))
+
+
+def submit_procedures_discussed(batcher: PeerlogicAPIWriteBatcher, call_id: str, matches: Iterable[ProcedureMatch]) -> Dict[str, Future]:
+    """Queues one procedure discussed per distinct keyword. The Futures resolve to the responses."""
+    return {keyword: batcher.create_procedure_discussed(call_id=call_id, keyword=keyword) for keyword in get_discussed_keywords(matches)}
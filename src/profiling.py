@@ -0,0 +1,188 @@
+from contextlib import contextmanager, nullcontext
+import cProfile
+from datetime import datetime, timezone
+import io
+import logging
+import marshal
+import os
+import pstats
+import random
+import threading
+import tracemalloc
+from typing import (
+    Callable,
+    ContextManager,
+    Dict,
+    FrozenSet,
+    Iterator,
+    Optional,
+)
+
+
+log = logging.getLogger(__name__)
+
+PROFILE_KIND_CPU = "cpu"
+PROFILE_KIND_MEMORY = "memory"
+PROFILE_KINDS = frozenset({PROFILE_KIND_CPU, PROFILE_KIND_MEMORY})
+
+# Message attribute asking for an event to be profiled: "cpu", "memory", "cpu,memory", or "true" for the configured kinds
+PROFILE_ATTRIBUTE = "profile"
+
+TRACEMALLOC_FRAMES = 10
+
+
+def parse_profile_kinds(value: Optional[str], default: FrozenSet[str]) -> FrozenSet[str]:
+    if not value:
+        return frozenset()
+    value = value.strip().lower()
+    if value in ("1", "true", "yes", "all"):
+        return default
+    kinds = frozenset(kind.strip() for kind in value.split(",") if kind.strip())
+    unknown = kinds - PROFILE_KINDS
+    if unknown:
+        log.warning(f"Ignoring unknown profile kinds {sorted(unknown)}. Expected {sorted(PROFILE_KINDS)}.")
+    return kinds & PROFILE_KINDS
+
+
+class EventProfiler(object):
+    """
+    Profiles selected events with cProfile and/or tracemalloc, and writes a compact report per event under
+    {output}/{call_id}/ to a local directory or a gs://bucket/prefix.
+
+    An event is profiled when always is set, when it carries the profile attribute, or when it's sampled at sample_rate.
+    Events that aren't selected run under a nullcontext. Both profilers are process wide (tracemalloc) or interfere
+    with each other when nested, so one event is profiled at a time, and others that are selected meanwhile run unprofiled.
+    cProfile only sees the thread handling the event, not work it hands to other threads.
+    """
+
+    def __init__(
+        self,
+        output: str,
+        kinds: FrozenSet[str] = frozenset({PROFILE_KIND_CPU}),
+        always: bool = False,
+        sample_rate: float = 0.0,
+        top_count: int = 40,
+        random: Callable[[], float] = random.random,
+    ) -> None:
+        self.output = output.rstrip("/")
+        self.kinds = kinds
+        self.always = always
+        self.sample_rate = sample_rate
+        self.top_count = top_count
+        self._random = random
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls) -> Optional["EventProfiler"]:
+        """
+        Enabled by PROFILING_OUTPUT, a local directory or gs://bucket/prefix. PROFILING_KINDS picks cpu and/or memory.
+        PROFILING_ALWAYS profiles every event, PROFILING_SAMPLE_RATE a fraction of them, and otherwise only events with the
+        profile attribute are.
+        """
+        output = os.getenv("PROFILING_OUTPUT")
+        if not output:
+            return None
+
+        return cls(
+            output,
+            kinds=parse_profile_kinds(os.getenv("PROFILING_KINDS", PROFILE_KIND_CPU), default=PROFILE_KINDS) or frozenset({PROFILE_KIND_CPU}),
+            always=os.getenv("PROFILING_ALWAYS", "false").lower() in ("1", "true", "yes"),
+            sample_rate=float(os.getenv("PROFILING_SAMPLE_RATE", "0")),
+            top_count=int(os.getenv("PROFILING_TOP_COUNT", "40")),
+        )
+
+    def get_kinds(self, event: Dict) -> FrozenSet[str]:
+        """Which profilers to run for the event, empty if it isn't selected."""
+        requested = parse_profile_kinds((event.get("attributes") or {}).get(PROFILE_ATTRIBUTE), default=self.kinds)
+        if requested:
+            return requested
+        if self.always or (self.sample_rate and self._random() < self.sample_rate):
+            return self.kinds
+        return frozenset()
+
+    def profile(self, event: Dict, context=None) -> ContextManager:
+        kinds = self.get_kinds(event)
+        if not kinds:
+            return nullcontext()
+        call_id = (event.get("attributes") or {}).get("call_id") or "unknown"
+        return self._profile(kinds, call_id, getattr(context, "event_id", None) or "unknown")
+
+    @contextmanager
+    def _profile(self, kinds: FrozenSet[str], call_id: str, event_id: str) -> Iterator[None]:
+        if not self._lock.acquire(blocking=False):
+            log.info(f"Another event is being profiled, not profiling call_id='{call_id}' event_id='{event_id}'")
+            yield
+            return
+
+        profiler = cProfile.Profile() if PROFILE_KIND_CPU in kinds else None
+        started_tracemalloc = False
+        try:
+            if PROFILE_KIND_MEMORY in kinds:
+                started_tracemalloc = not tracemalloc.is_tracing()
+                if started_tracemalloc:
+                    tracemalloc.start(TRACEMALLOC_FRAMES)
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.take_snapshot()
+            if profiler:
+                profiler.enable()
+
+            try:
+                yield
+            finally:
+                if profiler:
+                    profiler.disable()
+                self._report(call_id, event_id, profiler, baseline if PROFILE_KIND_MEMORY in kinds else None)
+        finally:
+            if started_tracemalloc:
+                tracemalloc.stop()
+            self._lock.release()
+
+    def _report(self, call_id: str, event_id: str, profiler: Optional[cProfile.Profile], baseline: Optional[tracemalloc.Snapshot]) -> None:
+        # a problem here must not replace the event's own outcome
+        try:
+            reports = {}
+            if baseline is not None:
+                # before building the cpu report, whose allocations would otherwise top the list
+                reports["memory.txt"] = self._get_memory_report(baseline).encode("utf-8")
+            if profiler:
+                reports.update(self._get_cpu_reports(profiler))
+            self._write_reports(call_id, event_id, reports)
+        except Exception:
+            log.exception(f"Problem occurred reporting profile for call_id='{call_id}' event_id='{event_id}'. Ignoring.")
+
+    def _get_cpu_reports(self, profiler: cProfile.Profile) -> Dict[str, bytes]:
+        summary = io.StringIO()
+        stats = pstats.Stats(profiler, stream=summary)  # takes the profiler's stats over
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top_count)
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(self.top_count)
+        # cpu.pstats is the format pstats.Stats and snakeviz load
+        return {"cpu.pstats": marshal.dumps(stats.stats), "cpu.txt": summary.getvalue().encode("utf-8")}
+
+    def _get_memory_report(self, baseline: tracemalloc.Snapshot) -> str:
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        lines = [
+            f"traced_current_bytes={current} traced_peak_bytes={peak}",
+            "",
+            f"Top {self.top_count} allocation sites still held, by growth during the event:",
+        ]
+        lines += [str(difference) for difference in snapshot.compare_to(baseline, "lineno")[: self.top_count]]
+        lines += ["", f"Top {self.top_count} allocation sites still held, by size:"]
+        lines += [str(statistic) for statistic in snapshot.statistics("lineno")[: self.top_count]]
+        return "\n".join(lines) + "\n"
+
+    def _write_reports(self, call_id: str, event_id: str, reports: Dict[str, bytes]) -> None:
+        timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+        for suffix, content in reports.items():
+            name = f"{call_id}/{timestamp}-{event_id}.{suffix}"
+            if self.output.startswith("gs://"):
+                from local_file_helpers import upload_content_to_new_blob
+
+                bucket_name, _, prefix = self.output[len("gs://") :].partition("/")
+                location = upload_content_to_new_blob(f"{prefix}/{name}" if prefix else name, content, "application/octet-stream", bucket_name)
+            else:
+                location = os.path.join(self.output, name)
+                os.makedirs(os.path.dirname(location), exist_ok=True)
+                with open(location, "wb") as f:
+                    f.write(content)
+            log.info(f"Wrote profile for call_id='{call_id}' event_id='{event_id}' to {location}")
@@ -0,0 +1,401 @@
+"""
+Long-running worker that pulls AudioReady messages from a Pub/Sub subscription and processes them concurrently with the
+same pipeline as the Cloud Function. Meant for backfills, where one warm process with shared clients replaces thousands
+of invocations.
+
+Usage: python src/pull_worker.py --subscription projects/<project>/subscriptions/<name> [--max-concurrency 8]
+Set PUBSUB_EMULATOR_HOST to run against the Pub/Sub emulator.
+"""
+import argparse
+import base64
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+)
+from collections import deque
+import logging
+import signal
+import threading
+import time
+import types
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    List,
+    NamedTuple,
+    Protocol,
+)
+
+from event_deferral import NOT_BEFORE_ATTRIBUTE
+from idempotency import DuplicateInFlightError
+from netsapiens_api_client import RecordingNotReadyError
+from recording_readiness import (
+    READINESS_ATTEMPT_ATTRIBUTE,
+    ReadinessBackoff,
+)
+from speech_admission import SpeechQuotaExhaustedError
+
+
+log = logging.getLogger(__name__)
+
+MAX_ACK_DEADLINE_SECONDS = 600  # Pub/Sub's limit, also the longest a message can be put off without re-publishing it
+PUBLISH_TIMEOUT_SECONDS = 30.0
+
+
+class ReceivedMessage(NamedTuple):
+    ack_id: str
+    message_id: str
+    data: bytes
+    attributes: Dict[str, str]
+    delivery_attempt: int  # 0 unless the subscription has a dead letter policy
+
+
+class MessageSource(Protocol):
+    def pull(self, max_messages: int, timeout: float) -> List[ReceivedMessage]:
+        ...
+
+    def ack(self, ack_ids: List[str]) -> None:
+        ...
+
+    def modify_ack_deadline(self, ack_ids: List[str], seconds: int) -> None:
+        """Extends the lease, or with 0 nacks the messages so they're redelivered."""
+        ...
+
+    def republish(self, data: bytes, attributes: Dict[str, str]) -> None:
+        """Publishes a new message to the subscription's topic, returning once it's accepted."""
+        ...
+
+
+class PubSubMessageSource(object):
+    """
+    Synchronous pull from a subscription. Honors PUBSUB_EMULATOR_HOST like every Pub/Sub client.
+    Republishes to topic_path, by default the subscription's topic.
+    """
+
+    def __init__(self, subscription_path: str, subscriber=None, topic_path: str = None, publisher=None) -> None:
+        if subscriber is None:
+            from google.cloud import pubsub_v1
+
+            subscriber = pubsub_v1.SubscriberClient()
+
+        self.subscription_path = subscription_path
+        self.topic_path = topic_path
+        self._subscriber = subscriber
+        self._publisher = publisher
+        self._publisher_lock = threading.Lock()
+
+    def pull(self, max_messages: int, timeout: float) -> List[ReceivedMessage]:
+        from google.api_core import exceptions
+
+        try:
+            response = self._subscriber.pull(request={"subscription": self.subscription_path, "max_messages": max_messages}, timeout=timeout)
+        except exceptions.DeadlineExceeded:
+            return []  # nothing arrived in time
+
+        return [
+            ReceivedMessage(
+                ack_id=received.ack_id,
+                message_id=received.message.message_id,
+                data=received.message.data,
+                attributes=dict(received.message.attributes),
+                delivery_attempt=received.delivery_attempt,
+            )
+            for received in response.received_messages
+        ]
+
+    def ack(self, ack_ids: List[str]) -> None:
+        self._subscriber.acknowledge(request={"subscription": self.subscription_path, "ack_ids": ack_ids})
+
+    def modify_ack_deadline(self, ack_ids: List[str], seconds: int) -> None:
+        self._subscriber.modify_ack_deadline(request={"subscription": self.subscription_path, "ack_ids": ack_ids, "ack_deadline_seconds": seconds})
+
+    def republish(self, data: bytes, attributes: Dict[str, str]) -> None:
+        with self._publisher_lock:  # created on first use, most runs never republish
+            if self._publisher is None:
+                from google.cloud import pubsub_v1
+
+                self._publisher = pubsub_v1.PublisherClient()
+            if self.topic_path is None:
+                self.topic_path = self._subscriber.get_subscription(request={"subscription": self.subscription_path}).topic
+        self._publisher.publish(self.topic_path, data, **attributes).result(timeout=PUBLISH_TIMEOUT_SECONDS)
+
+
+class InMemoryMessageSource(object):
+    """
+    Stands in for a subscription locally and in benchmarks. Leases expire and nacked messages come back after their
+    deadline, like Pub/Sub, so deadline handling can be exercised too.
+    """
+
+    def __init__(self, ack_deadline_seconds: float = 10.0, clock: Callable[[], float] = time.monotonic) -> None:
+        self.ack_deadline_seconds = ack_deadline_seconds
+        self._clock = clock
+        self._lock = threading.Condition()
+        self._available: Deque[ReceivedMessage] = deque()
+        self._leased: Dict[str, tuple] = {}  # ack_id -> (message, lease expires at)
+        self._next_id = 0
+
+        self.acked: List[ReceivedMessage] = []
+        self.deliveries = 0
+
+    def publish(self, data: bytes, **attributes: str) -> str:
+        with self._lock:
+            self._next_id += 1
+            message_id = str(self._next_id)
+            self._available.append(ReceivedMessage("", message_id, data, attributes, 0))
+            self._lock.notify_all()
+        return message_id
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._available) + len(self._leased)
+
+    def _release_expired(self) -> None:
+        now = self._clock()
+        for ack_id, (message, expires_at) in list(self._leased.items()):
+            if expires_at <= now:
+                del self._leased[ack_id]
+                self._available.append(message)
+
+    def pull(self, max_messages: int, timeout: float) -> List[ReceivedMessage]:
+        deadline = self._clock() + timeout
+        with self._lock:
+            while True:
+                self._release_expired()
+                if self._available or self._clock() >= deadline:
+                    break
+                self._lock.wait(timeout=min(0.05, max(0.0, deadline - self._clock())))
+
+            received = []
+            while self._available and len(received) < max_messages:
+                message = self._available.popleft()
+                self._next_id += 1
+                ack_id = f"{message.message_id}:{self._next_id}"
+                message = message._replace(ack_id=ack_id, delivery_attempt=message.delivery_attempt + 1)
+                self._leased[ack_id] = (message, self._clock() + self.ack_deadline_seconds)
+                received.append(message)
+            self.deliveries += len(received)
+            return received
+
+    def ack(self, ack_ids: List[str]) -> None:
+        with self._lock:
+            for ack_id in ack_ids:
+                leased = self._leased.pop(ack_id, None)
+                if leased:  # acks for expired leases are lost, like with Pub/Sub
+                    self.acked.append(leased[0])
+
+    def modify_ack_deadline(self, ack_ids: List[str], seconds: int) -> None:
+        with self._lock:
+            for ack_id in ack_ids:
+                leased = self._leased.get(ack_id)
+                if not leased:
+                    continue
+                if seconds == 0:
+                    del self._leased[ack_id]
+                    self._available.append(leased[0])
+                else:
+                    self._leased[ack_id] = (leased[0], self._clock() + seconds)
+            self._lock.notify_all()
+
+    def republish(self, data: bytes, attributes: Dict[str, str]) -> None:
+        self.publish(data, **attributes)
+
+
+def handle_with_pipeline(message: ReceivedMessage) -> None:
+    """Runs the message through the Cloud Function's pipeline."""
+    import main
+
+    event = {"data": base64.b64encode(message.data).decode("ascii"), "attributes": message.attributes}
+    context = types.SimpleNamespace(event_id=message.message_id, timestamp=None)
+    main.handle_audio_ready_event(event, context, log)
+
+
+class PullWorker(object):
+    """
+    Pulls messages in batches and handles up to max_concurrency at once.
+
+    Leases of in-flight messages are extended every lease_extension_interval_seconds, up to max_lease_seconds.
+    Successes are acked and failures nacked for Pub/Sub to redeliver. Messages whose recording isn't ready yet are
+    published again with their attempt count and a not_before attribute, since delivery_attempt only counts with a dead
+    letter policy, and fail once readiness_backoff's attempts run out. Messages that arrive before their not_before are
+    put off by extending their deadline instead of holding a slot, as are duplicates of messages in flight elsewhere.
+    renew_leases is called along with each extension, so other leases on in-flight work (idempotency claims) last as long.
+    stop() (or SIGTERM) stops pulling and lets in-flight work finish.
+    """
+
+    def __init__(
+        self,
+        source: MessageSource,
+        handler: Callable[[ReceivedMessage], None] = handle_with_pipeline,
+        max_concurrency: int = 8,
+        batch_size: int = 10,
+        pull_timeout_seconds: float = 10.0,
+        ack_deadline_seconds: int = 60,
+        lease_extension_interval_seconds: float = 20.0,
+        max_lease_seconds: float = 60 * 60,
+        readiness_backoff: ReadinessBackoff = None,
+        renew_leases: Callable[[], None] = None,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self._source = source
+        self._handler = handler
+        self.max_concurrency = max_concurrency
+        self.batch_size = batch_size
+        self.pull_timeout_seconds = pull_timeout_seconds
+        self.ack_deadline_seconds = ack_deadline_seconds
+        self.lease_extension_interval_seconds = lease_extension_interval_seconds
+        self.max_lease_seconds = max_lease_seconds
+        self.readiness_backoff = readiness_backoff if readiness_backoff else ReadinessBackoff()
+        self._renew_leases = renew_leases  # e.g. the idempotency ledger's, renewed along with the ack deadlines
+        self._clock = clock
+
+        self._stopping = threading.Event()
+        self._finished = threading.Event()
+        self._lock = threading.Condition()
+        self._in_flight: Dict[str, float] = {}  # ack_id -> started at
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="pull-worker")
+
+        self.processed = 0
+        self.failed = 0
+        self.deferred = 0
+
+    def stop(self) -> None:
+        log.info("Stopping pull worker, finishing in-flight messages.")
+        self._stopping.set()
+        with self._lock:
+            self._lock.notify_all()
+
+    def install_signal_handlers(self) -> None:
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signal_number, lambda *args: self.stop())
+
+    def run(self, stop_when_idle: bool = False) -> None:
+        """Blocks until stopped. With stop_when_idle, also returns once a pull comes back empty with nothing in flight."""
+        lease_extender = threading.Thread(target=self._extend_leases, name="pull-worker-leases", daemon=True)
+        lease_extender.start()
+        try:
+            while not self._stopping.is_set():
+                with self._lock:
+                    while len(self._in_flight) >= self.max_concurrency and not self._stopping.is_set():
+                        self._lock.wait()
+                    capacity = self.max_concurrency - len(self._in_flight)
+                if self._stopping.is_set():
+                    break
+
+                messages = self._source.pull(min(self.batch_size, capacity), timeout=self.pull_timeout_seconds)
+                if not messages and stop_when_idle:
+                    with self._lock:
+                        if not self._in_flight:
+                            break
+                for message in messages:
+                    self._dispatch(message)
+        finally:
+            self._executor.shutdown(wait=True)
+            self._finished.set()
+            lease_extender.join()
+            log.info(f"Pull worker stopped. processed={self.processed} failed={self.failed} deferred={self.deferred}")
+
+    def _dispatch(self, message: ReceivedMessage) -> None:
+        not_before = message.attributes.get(NOT_BEFORE_ATTRIBUTE)
+        if not_before:
+            remaining = float(not_before) - self._clock()
+            if remaining > 0:
+                self._defer(message, remaining)
+                return
+
+        with self._lock:
+            self._in_flight[message.ack_id] = self._clock()
+        future = self._executor.submit(self._handler, message)
+        future.add_done_callback(lambda f: self._on_done(message, f))
+
+    def _on_done(self, message: ReceivedMessage, future: Future) -> None:
+        error = future.exception()
+        try:
+            if error is None:
+                self._source.ack([message.ack_id])
+                with self._lock:
+                    self.processed += 1
+            elif isinstance(error, RecordingNotReadyError):
+                self._defer_until_ready(message, error)
+            elif isinstance(error, (SpeechQuotaExhaustedError, DuplicateInFlightError)):
+                self._defer(message, error.retry_after_seconds)
+            else:
+                log.error(f"Problem occurred handling message_id='{message.message_id}'. Nacking for redelivery.", exc_info=error)
+                self._source.modify_ack_deadline([message.ack_id], 0)
+                with self._lock:
+                    self.failed += 1
+        except Exception:
+            log.exception(f"Problem occurred settling message_id='{message.message_id}'. Its lease will expire and it'll be redelivered.")
+        finally:
+            with self._lock:
+                self._in_flight.pop(message.ack_id, None)
+                self._lock.notify_all()
+
+    def _defer(self, message: ReceivedMessage, delay_seconds: float) -> None:
+        """Leaves the message unacked with a deadline of the delay, so Pub/Sub redelivers it then."""
+        seconds = int(min(MAX_ACK_DEADLINE_SECONDS, max(10, delay_seconds)))
+        log.info(f"Deferring message_id='{message.message_id}' by {seconds}s.")
+        self._source.modify_ack_deadline([message.ack_id], seconds)
+        with self._lock:
+            self.deferred += 1
+
+    def _defer_until_ready(self, message: ReceivedMessage, error: RecordingNotReadyError) -> None:
+        """Publishes the message again to be handled when the recording is likely ready, then acks this delivery."""
+        attempt = int(message.attributes.get(READINESS_ATTEMPT_ATTRIBUTE, 0)) + 1
+        if attempt > self.readiness_backoff.max_attempts:
+            log.error(f"Recording of message_id='{message.message_id}' still not ready after {attempt - 1} deferred attempts. Nacking.", exc_info=error)
+            self._source.modify_ack_deadline([message.ack_id], 0)
+            with self._lock:
+                self.failed += 1
+            return
+
+        delay = self.readiness_backoff.get_delay(attempt, error.duration_seconds)
+        attributes = {**message.attributes, READINESS_ATTEMPT_ATTRIBUTE: str(attempt), NOT_BEFORE_ATTRIBUTE: f"{self._clock() + delay:.3f}"}
+        log.info(f"Recording of message_id='{message.message_id}' not ready, deferring attempt={attempt} by {delay:.1f}s.")
+        self._source.republish(message.data, attributes)
+        self._source.ack([message.ack_id])
+        with self._lock:
+            self.deferred += 1
+
+    def _extend_leases(self) -> None:
+        while not self._finished.wait(self.lease_extension_interval_seconds):
+            now = self._clock()
+            with self._lock:
+                ack_ids = [ack_id for ack_id, started_at in self._in_flight.items() if now - started_at < self.max_lease_seconds]
+            if self._renew_leases:
+                try:
+                    self._renew_leases()
+                except Exception:
+                    log.exception("Problem occurred renewing leases. Retrying next interval.")
+            if not ack_ids:
+                continue
+            try:
+                self._source.modify_ack_deadline(ack_ids, self.ack_deadline_seconds)
+            except Exception:
+                log.exception(f"Problem occurred extending leases of {len(ack_ids)} messages. Retrying next interval.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscription", required=True, help="projects/<project>/subscriptions/<name>")
+    parser.add_argument("--topic", help="projects/<project>/topics/<name> to republish deferred messages to, defaults to the subscription's topic")
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--ack-deadline-seconds", type=int, default=60)
+    parser.add_argument("--stop-when-idle", action="store_true", help="Exit once the subscription is drained, e.g. at the end of a backfill")
+    args = parser.parse_args()
+
+    import main
+
+    main.event_deferral = None  # the worker defers with ack deadlines instead of scheduling tasks
+
+    worker = PullWorker(
+        PubSubMessageSource(args.subscription, topic_path=args.topic),
+        renew_leases=main.idempotency_ledger.renew_claims,
+        readiness_backoff=ReadinessBackoff.from_environment(),
+        max_concurrency=args.max_concurrency,
+        batch_size=args.batch_size,
+        ack_deadline_seconds=args.ack_deadline_seconds,
+    )
+    worker.install_signal_handlers()
+    worker.run(stop_when_idle=args.stop_when_idle)
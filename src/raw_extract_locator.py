@@ -0,0 +1,168 @@
+import json
+import logging
+import re
+import threading
+import time
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from google.cloud import storage
+
+from config import BUCKET_OUTPUT_RAW_EXTRACT
+from local_file_helpers import (
+    get_bucket,
+    storage_client,
+)
+
+
+log = logging.getLogger(__name__)
+
+# {call_id}-{partial_id}-{audio_partial_id}.json, or when Speech finds the name taken,
+# {call_id}-{partial_id}-{audio_partial_id}-2022-02-09T21-47-38_818394412+00-00.json
+RAW_EXTRACT_BLOB_NAME = re.compile(
+    r"^(?P<call_id>[^-/]+)-(?P<partial_id>[^-/]+)-(?P<audio_partial_id>[^-/]+)"
+    r"(?:-(?P<timestamp>\d{4}-\d{2}-\d{2}T\d{2}-\d{2}-\d{2}_\d+[+-]\d{2}-\d{2}))?\.json$"
+)
+
+
+class RawExtractKey(NamedTuple):
+    call_id: str
+    partial_id: str
+    audio_partial_id: str
+
+
+class RawExtractVersion(NamedTuple):
+    key: RawExtractKey
+    blob_name: str
+    timestamp: str  # empty for the first version
+
+    @property
+    def sort_key(self) -> Tuple[int, str]:
+        # the unsuffixed name is always the oldest, suffixes are fixed width UTC so they sort as strings
+        return (1, self.timestamp) if self.timestamp else (0, "")
+
+
+def parse_raw_extract_blob_name(blob_name: str) -> Optional[RawExtractVersion]:
+    match = RAW_EXTRACT_BLOB_NAME.match(blob_name)
+    if not match:
+        return None
+    key = RawExtractKey(match.group("call_id"), match.group("partial_id"), match.group("audio_partial_id"))
+    return RawExtractVersion(key=key, blob_name=blob_name, timestamp=match.group("timestamp") or "")
+
+
+class RawExtractLocator(object):
+    """
+    Finds the newest raw-extract transcript for a call, partial and audio partial without scanning the bucket.
+
+    The index holds only the newest blob name per key. It's filled by prefix listings, either of the whole bucket with
+    build_index() or of a single call the first time that call is looked up, and kept current with record_write()
+    whenever this process writes a raw extract. Other instances write too, e.g. when a call is reprocessed, so a miss
+    re-lists that call, and a hit older than max_age_seconds is revalidated by listing just that key's versions.
+    """
+
+    def __init__(
+        self,
+        bucket_name: str = BUCKET_OUTPUT_RAW_EXTRACT,
+        storage_client: storage.Client = storage_client,
+        max_age_seconds: float = 60.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.bucket_name = bucket_name
+        self._storage_client = storage_client
+        self.max_age_seconds = max_age_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._latest: Dict[RawExtractKey, RawExtractVersion] = {}
+        self._indexed_prefixes: Dict[str, float] = {}  # prefix -> when it was last listed
+
+        self.listings = 0
+
+    def __len__(self) -> int:
+        return len(self._latest)
+
+    def build_index(self, prefix: str = "") -> int:
+        """Lists blobs under the prefix into the index. Returns how many raw extracts were seen."""
+        blobs = self._storage_client.list_blobs(self.bucket_name, prefix=prefix or None, fields="items(name),nextPageToken")
+        versions = [version for version in (parse_raw_extract_blob_name(blob.name) for blob in blobs) if version is not None]  # pages are fetched here
+        with self._lock:
+            self.listings += 1
+            for version in versions:
+                self._record(version)
+            self._indexed_prefixes[prefix] = self._clock()
+
+        log.info(f"Indexed {len(versions)} raw extracts under prefix='{prefix}' in bucket='{self.bucket_name}'")
+        return len(versions)
+
+    def record_write(self, blob_name: str) -> None:
+        """Call after writing (or seeing a notification for) a raw extract so the index stays current without listing."""
+        version = parse_raw_extract_blob_name(blob_name.rpartition("/")[2] if blob_name.startswith("gs://") else blob_name)
+        if version is None:
+            log.warning(f"Not recording write of blob_name='{blob_name}', it doesn't look like a raw extract.")
+            return
+
+        with self._lock:
+            self._record(version)
+
+    def _record(self, version: RawExtractVersion) -> None:
+        current = self._latest.get(version.key)
+        if current is None or version.sort_key > current.sort_key:
+            self._latest[version.key] = version
+
+    @staticmethod
+    def get_key_prefix(key: RawExtractKey) -> str:
+        return f"{key.call_id}-{key.partial_id}-{key.audio_partial_id}"
+
+    def _get_listed_at(self, key: RawExtractKey) -> Optional[float]:
+        """When the newest listing that covers the key was made, None if none has."""
+        listed_at = [self._indexed_prefixes.get(prefix) for prefix in ("", f"{key.call_id}-", self.get_key_prefix(key))]
+        return max((value for value in listed_at if value is not None), default=None)
+
+    def latest(self, call_id: str, partial_id: str, audio_partial_id: str) -> Optional[str]:
+        """Blob name of the newest raw extract, or None if there isn't one."""
+        key = RawExtractKey(call_id, partial_id, audio_partial_id)
+        with self._lock:
+            version = self._latest.get(key)
+            listed_at = self._get_listed_at(key)
+
+        if version is None:
+            self.build_index(prefix=f"{call_id}-")
+        elif listed_at is None or self._clock() - listed_at > self.max_age_seconds:
+            # only known from record_write, or listed a while ago, and newer versions may have been written elsewhere
+            self.build_index(prefix=self.get_key_prefix(key))
+        else:
+            return version.blob_name
+
+        with self._lock:
+            version = self._latest.get(key)
+
+        return version.blob_name if version else None
+
+    def latest_uri(self, call_id: str, partial_id: str, audio_partial_id: str) -> Optional[str]:
+        blob_name = self.latest(call_id, partial_id, audio_partial_id)
+        return f"gs://{self.bucket_name}/{blob_name}" if blob_name else None
+
+    def open_latest(self, call_id: str, partial_id: str, audio_partial_id: str) -> Optional[IO[bytes]]:
+        """Streams the newest raw extract, reading it in chunks as it's consumed. Close it when done."""
+        blob_name = self.latest(call_id, partial_id, audio_partial_id)
+        if not blob_name:
+            return None
+        return get_bucket(self.bucket_name, self._storage_client).blob(blob_name).open("rb")
+
+    def load_latest(self, call_id: str, partial_id: str, audio_partial_id: str) -> Optional[Dict[str, Any]]:
+        stream = self.open_latest(call_id, partial_id, audio_partial_id)
+        if stream is None:
+            return None
+        with stream:
+            return json.load(stream)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._latest.clear()
+            self._indexed_prefixes.clear()
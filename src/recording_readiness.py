@@ -0,0 +1,49 @@
+import logging
+import os
+import random
+from typing import (
+    Callable,
+    Optional,
+)
+
+
+log = logging.getLogger(__name__)
+
+READINESS_ATTEMPT_ATTRIBUTE = "readiness_attempt"  # deferrals so far, delivery_attempt only counts with a dead letter policy
+
+
+class ReadinessBackoff(object):
+    """
+    How long to wait before checking on a recording again.
+
+    Netsapiens converts recordings after the call ends, and longer calls take longer, so the first wait is
+    base_delay_seconds plus seconds_per_recording_second for each second of audio. Later attempts double it.
+    Jitter keeps a burst of calls that ended together from coming back together.
+    """
+
+    def __init__(
+        self,
+        base_delay_seconds: float = 30.0,
+        seconds_per_recording_second: float = 0.25,
+        max_delay_seconds: float = 15 * 60,
+        max_attempts: int = 6,
+        random: Callable[[], float] = random.random,
+    ) -> None:
+        self.base_delay_seconds = base_delay_seconds
+        self.seconds_per_recording_second = seconds_per_recording_second
+        self.max_delay_seconds = max_delay_seconds
+        self.max_attempts = max_attempts
+        self.random = random
+
+    @classmethod
+    def from_environment(cls) -> "ReadinessBackoff":
+        return cls(
+            base_delay_seconds=float(os.getenv("RECORDING_READINESS_BASE_DELAY_SECONDS", "30")),
+            max_delay_seconds=float(os.getenv("RECORDING_READINESS_MAX_DELAY_SECONDS", "900")),
+            max_attempts=int(os.getenv("RECORDING_READINESS_MAX_ATTEMPTS", "6")),
+        )
+
+    def get_delay(self, attempt: int, duration_seconds: Optional[int] = None) -> float:
+        expected_conversion_seconds = self.base_delay_seconds + (duration_seconds or 0) * self.seconds_per_recording_second
+        ceiling = min(self.max_delay_seconds, expected_conversion_seconds * (2 ** (attempt - 1)))
+        return ceiling * (0.5 + self.random() / 2)  # never sooner than half the expected time
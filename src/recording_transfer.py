@@ -0,0 +1,239 @@
+import base64
+import hashlib
+import logging
+import queue
+import threading
+import time
+from typing import (
+    Iterator,
+    NamedTuple,
+    Optional,
+)
+
+from google.cloud import storage
+from google.cloud.storage.fileio import BlobWriter
+from google.cloud.storage.retry import DEFAULT_RETRY
+import requests
+import urllib3
+
+from audio_conversion import (
+    MAX_WAV_HEADER_BYTES,
+    WavHeaderInfo,
+    parse_wav_header,
+)
+from local_file_helpers import storage_client
+from netsapiens_api_client import NetsapiensAPIClient
+
+
+log = logging.getLogger(__name__)
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # resumable uploads require a multiple of 256KiB
+MAX_BUFFERED_DOWNLOAD_CHUNKS = 8  # bounds memory, and how far the download may run ahead of the upload
+
+TRANSIENT_DOWNLOAD_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout, urllib3.exceptions.HTTPError, ConnectionError)
+
+_END_OF_RECORDING = object()
+
+
+class RecordingTransferResult(NamedTuple):
+    uri: str
+    size: int
+    md5_hash: str  # base64, the same encoding GCS uses
+    wav_header: Optional[WavHeaderInfo]  # None if the recording isn't a WAV file
+    download_resumes: int
+
+
+class RecordingDownloadStream(object):
+    """
+    Iterates over a Netsapiens recording in chunks, resuming with a range request after transient failures.
+    The md5 and WAV header are computed from the chunks as they go by.
+    """
+
+    def __init__(self, netsapiens_api_client: NetsapiensAPIClient, url: str, chunk_size: int = DOWNLOAD_CHUNK_SIZE, max_resumes: int = 3) -> None:
+        self._client = netsapiens_api_client
+        self.url = url
+        self.chunk_size = chunk_size
+        self.max_resumes = max_resumes
+
+        self.position = 0
+        self.expected_size: Optional[int] = None
+        self.resumes = 0
+        self.wav_header: Optional[WavHeaderInfo] = None
+        self._md5 = hashlib.md5()
+        self._header = bytearray()
+        self._is_header_done = False
+
+    @property
+    def md5_hash(self) -> str:
+        return base64.b64encode(self._md5.digest()).decode("ascii")
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            raw = self._client.get_recording_file(self.url, start_byte=self.position)
+            skip = self._get_bytes_to_skip(raw)
+            try:
+                while True:
+                    chunk = raw.read(self.chunk_size)
+                    if not chunk:
+                        break
+
+                    if skip:  # the server ignored our range and started from the beginning
+                        skipped = min(skip, len(chunk))
+                        chunk = chunk[skipped:]
+                        skip -= skipped
+                        if not chunk:
+                            continue
+
+                    self._observe(chunk)
+                    yield chunk
+            except TRANSIENT_DOWNLOAD_ERRORS as e:
+                self._wait_to_resume(e)
+                continue
+            finally:
+                raw.release_conn()
+
+            if self.expected_size is not None and self.position < self.expected_size:
+                # urllib3 doesn't enforce Content-Length, a dropped connection can look like the end of the body
+                self._wait_to_resume(f"body ended at byte {self.position} of {self.expected_size}")
+                continue
+            return
+
+    def _wait_to_resume(self, reason) -> None:
+        if self.resumes >= self.max_resumes:
+            msg = f"Recording download from url='{self.url}' failed at byte {self.position} after {self.resumes} resumes."
+            if isinstance(reason, Exception):
+                raise Exception(msg) from reason
+            raise Exception(f"{msg} Last failure: {reason}")
+
+        self.resumes += 1
+        delay = self._client.retry_policy.get_delay(self.resumes) or 0
+        log.warning(f"Recording download from url='{self.url}' interrupted at byte {self.position}. Resuming in {delay:.2f}s. Reason: {reason}")
+        time.sleep(delay)
+
+    def _get_bytes_to_skip(self, raw) -> int:
+        content_length = raw.headers.get("Content-Length")
+        if raw.status == 206:
+            # Content-Range: bytes 1000-4999/5000
+            total = raw.headers.get("Content-Range", "").rpartition("/")[2]
+            if total.isdigit():
+                self.expected_size = int(total)
+            return 0
+
+        if content_length and content_length.isdigit():
+            self.expected_size = int(content_length)
+        return self.position
+
+    def _observe(self, chunk: bytes) -> None:
+        self._md5.update(chunk)
+        self.position += len(chunk)
+
+        if not self._is_header_done:
+            self._header += chunk[: MAX_WAV_HEADER_BYTES - len(self._header)]
+            try:
+                self.wav_header = parse_wav_header(bytes(self._header))
+                self._is_header_done = self.wav_header is not None or len(self._header) >= MAX_WAV_HEADER_BYTES
+            except ValueError as e:
+                log.warning(f"Recording from url='{self.url}' does not have a parsable WAV header: {e}")
+                self._is_header_done = True
+
+            if self._is_header_done:
+                self._header = bytearray()
+
+
+class AbortableBlobWriter(BlobWriter):
+    """
+    BlobWriter always finalizes the upload on close, even when leaving a with block because of an error, which would
+    publish a truncated blob. abort() ends the writer without finalizing and cancels the resumable session.
+    """
+
+    def abort(self) -> None:
+        if self.closed:
+            return
+
+        self._buffer.close()  # closed writers aren't finalized by close() or garbage collection
+        if self._upload_and_transport:
+            upload, transport = self._upload_and_transport
+            try:
+                transport.delete(upload.resumable_url)  # GCS cancels the session, answering 499
+            except Exception:
+                log.exception(f"Problem occurred cancelling resumable upload for blob='{self._blob.name}'. It will expire on its own.")
+
+
+def _produce_chunks(download: RecordingDownloadStream, chunks: queue.Queue, cancelled: threading.Event) -> None:
+    def put(item) -> bool:
+        while not cancelled.is_set():
+            try:
+                chunks.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        for chunk in download:
+            if not put(chunk):
+                return
+        put(_END_OF_RECORDING)
+    except Exception as e:
+        put(e)
+
+
+def stream_recording_to_bucket(
+    netsapiens_api_client: NetsapiensAPIClient,
+    url: str,
+    bucket_name: str,
+    blob_name: str,
+    content_type: str = "audio/wav",
+    download_chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+    upload_chunk_size: int = UPLOAD_CHUNK_SIZE,
+    max_buffered_chunks: int = MAX_BUFFERED_DOWNLOAD_CHUNKS,
+    max_download_resumes: int = 3,
+    storage_client: storage.Client = storage_client,
+) -> RecordingTransferResult:
+    """
+    Copies a Netsapiens recording into a GCS blob without it touching local disk.
+
+    The download runs on its own thread and feeds a bounded queue, so it overlaps with the resumable upload and
+    memory stays around (max_buffered_chunks * download_chunk_size + upload_chunk_size) whatever the recording's size.
+    Interrupted downloads resume with a range request, failed upload chunks are retried by the resumable upload.
+    The md5 computed on the way through is checked against the finished blob.
+    """
+    uri = f"gs://{bucket_name}/{blob_name}"
+    log.info(f"Streaming recording from url='{url}' to uri='{uri}'")
+
+    download = RecordingDownloadStream(netsapiens_api_client, url, chunk_size=download_chunk_size, max_resumes=max_download_resumes)
+    chunks: queue.Queue = queue.Queue(maxsize=max_buffered_chunks)
+    cancelled = threading.Event()
+    producer = threading.Thread(target=_produce_chunks, args=(download, chunks, cancelled), name="recording-download", daemon=True)
+
+    blob = storage_client.bucket(bucket_name).blob(blob_name)
+    writer = AbortableBlobWriter(blob, chunk_size=upload_chunk_size, retry=DEFAULT_RETRY, content_type=content_type)
+    producer.start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is _END_OF_RECORDING:
+                break
+            if isinstance(item, Exception):
+                raise Exception(f"Problem occurred downloading recording from url='{url}'.") from item
+            writer.write(item)
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        cancelled.set()  # unblocks the producer if the upload failed
+        producer.join()
+
+    blob.reload()
+    if blob.md5_hash != download.md5_hash or blob.size != download.position:
+        raise Exception(
+            f"Uploaded recording uri='{uri}' does not match what was downloaded. "
+            f"Expected md5='{download.md5_hash}' size={download.position}, got md5='{blob.md5_hash}' size={blob.size}."
+        )
+
+    log.info(f"Streamed recording to uri='{uri}' size={download.position} md5='{download.md5_hash}' download_resumes={download.resumes}")
+    return RecordingTransferResult(
+        uri=uri, size=download.position, md5_hash=download.md5_hash, wav_header=download.wav_header, download_resumes=download.resumes
+    )
@@ -0,0 +1,247 @@
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import threading
+from typing import (
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+)
+
+from tracing import Span, span_listeners
+
+
+log = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+PREFER_LOW_MEMORY_ALWAYS = "true"
+PREFER_LOW_MEMORY_NEVER = "false"
+PREFER_LOW_MEMORY_AUTO = "auto"  # once this instance has come close to its budget
+
+try:
+    PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    PAGE_SIZE = 4096
+
+
+def get_max_rss_bytes() -> int:
+    """High-water mark of the process' resident memory. ru_maxrss is kilobytes on Linux and bytes on macOS."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def get_rss_bytes() -> int:
+    """Current resident memory of the process, from /proc where there is one, the high-water mark otherwise."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return get_max_rss_bytes()
+
+
+def is_tmpfs(path: str) -> bool:
+    """Whether path is on an in-memory filesystem, like /tmp on Cloud Functions, where files count against the memory limit."""
+    try:
+        with open("/proc/mounts", "r") as f:
+            mounts = [line.split()[1:3] for line in f if len(line.split()) >= 3]
+    except OSError:
+        return False
+
+    path = os.path.realpath(path)
+    matches = [(mount_point, fs_type) for mount_point, fs_type in mounts if path == mount_point or path.startswith(mount_point.rstrip("/") + "/")]
+    if not matches:
+        return False
+    _, fs_type = max(matches, key=lambda match: len(match[0]))
+    return fs_type in ("tmpfs", "ramfs")
+
+
+def get_directory_usage_bytes(path: str) -> int:
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += get_directory_usage_bytes(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            pass  # removed while walking
+    return total
+
+
+class ResourceSample(NamedTuple):
+    rss_bytes: int
+    max_rss_bytes: int
+    tmp_bytes: int
+
+
+class StageUsage(object):
+    __slots__ = ("start", "rss_peak_bytes", "tmp_peak_bytes")
+
+    def __init__(self, start: ResourceSample) -> None:
+        self.start = start
+        self.rss_peak_bytes = start.rss_bytes
+        self.tmp_peak_bytes = start.tmp_bytes
+
+    def observe(self, sample: ResourceSample) -> None:
+        self.rss_peak_bytes = max(self.rss_peak_bytes, sample.rss_bytes)
+        self.tmp_peak_bytes = max(self.tmp_peak_bytes, sample.tmp_bytes)
+
+
+class ResourceAccountant(object):
+    """
+    Samples resident memory and temporary directory usage at every span boundary and records each stage's start, end
+    and peak as attributes of its span, so they're exported with the trace.
+
+    Peaks are sampled at boundaries, including those of nested stages. A stage that pushes the process to a new
+    high-water mark between boundaries is caught by ru_maxrss. When the temporary directory is in memory (tmpfs), as on
+    Cloud Functions, its usage counts against the budget. Stage usage reaching warning_fraction of the budget logs a
+    structured warning. Concurrent events in one process (the pull worker) share these numbers.
+    """
+
+    def __init__(self, budget_bytes: Optional[int] = None, warning_fraction: float = 0.8, tmp_directory: str = None) -> None:
+        self.budget_bytes = budget_bytes
+        self.warning_fraction = warning_fraction
+        self.tmp_directory = tmp_directory if tmp_directory else tempfile.gettempdir()
+        self.tmp_counts_toward_memory = is_tmpfs(self.tmp_directory)
+
+        self._lock = threading.Lock()
+        self._stages: Dict[Span, StageUsage] = {}
+
+        self.warnings = 0
+        self.peak_usage_bytes = 0
+
+    @classmethod
+    def from_environment(cls) -> Optional["ResourceAccountant"]:
+        """
+        Enabled by RESOURCE_ACCOUNTING_ENABLED. The budget is MEMORY_BUDGET_BYTES, or else FUNCTION_MEMORY_MB which
+        Cloud Functions sets to the instance's memory. Without either, peaks are still recorded but never warned about.
+        """
+        if os.getenv("RESOURCE_ACCOUNTING_ENABLED", "false").lower() not in ("1", "true", "yes"):
+            return None
+
+        budget_bytes = None
+        if os.getenv("MEMORY_BUDGET_BYTES"):
+            budget_bytes = int(os.environ["MEMORY_BUDGET_BYTES"])
+        elif os.getenv("FUNCTION_MEMORY_MB"):
+            budget_bytes = int(os.environ["FUNCTION_MEMORY_MB"]) * MB
+
+        return cls(
+            budget_bytes=budget_bytes,
+            warning_fraction=float(os.getenv("MEMORY_BUDGET_WARNING_FRACTION", "0.8")),
+            tmp_directory=os.getenv("RESOURCE_ACCOUNTING_TMP_DIRECTORY"),  # narrow it where the temporary directory is shared and large
+        )
+
+    def sample(self) -> ResourceSample:
+        tmp_bytes = get_directory_usage_bytes(self.tmp_directory)
+        return ResourceSample(rss_bytes=get_rss_bytes(), max_rss_bytes=get_max_rss_bytes(), tmp_bytes=tmp_bytes)
+
+    def get_usage_bytes(self, rss_bytes: int, tmp_bytes: int) -> int:
+        return rss_bytes + (tmp_bytes if self.tmp_counts_toward_memory else 0)
+
+    @property
+    def is_near_budget(self) -> bool:
+        return self.budget_bytes is not None and self.peak_usage_bytes >= self.warning_fraction * self.budget_bytes
+
+    def _open_ancestors(self, span: Span) -> List[StageUsage]:
+        usages = []
+        while span is not None:
+            usage = self._stages.get(span)
+            if usage is not None:
+                usages.append(usage)
+            span = span.parent
+        return usages
+
+    def on_start(self, span: Span) -> None:
+        sample = self.sample()
+        with self._lock:
+            for usage in self._open_ancestors(span.parent):
+                usage.observe(sample)
+            self._stages[span] = StageUsage(sample)
+
+    def on_end(self, span: Span) -> None:
+        sample = self.sample()
+        with self._lock:
+            for usage in self._open_ancestors(span):
+                usage.observe(sample)
+            usage = self._stages.pop(span, None)
+        if usage is None:
+            return
+
+        if sample.max_rss_bytes > usage.start.max_rss_bytes:
+            usage.rss_peak_bytes = max(usage.rss_peak_bytes, sample.max_rss_bytes)  # a new high-water mark was set during the stage
+
+        span.set_attributes(
+            rss_start_mb=round(usage.start.rss_bytes / MB, 1),
+            rss_end_mb=round(sample.rss_bytes / MB, 1),
+            rss_peak_mb=round(usage.rss_peak_bytes / MB, 1),
+            tmp_peak_mb=round(usage.tmp_peak_bytes / MB, 1),
+        )
+
+        usage_bytes = self.get_usage_bytes(usage.rss_peak_bytes, usage.tmp_peak_bytes)
+        with self._lock:
+            self.peak_usage_bytes = max(self.peak_usage_bytes, usage_bytes)
+        if self.budget_bytes is None:
+            return
+        span.set_attribute("memory_budget_fraction", round(usage_bytes / self.budget_bytes, 3))
+        if usage_bytes >= self.warning_fraction * self.budget_bytes:
+            self._warn(span, usage, usage_bytes)
+
+    def _warn(self, span: Span, usage: StageUsage, usage_bytes: int) -> None:
+        # stages that only carried usage from before they started don't warn, nor do ancestors of a stage that warned
+        grew = usage_bytes > self.get_usage_bytes(usage.start.rss_bytes, usage.start.tmp_bytes)
+        if (span.parent is not None and not grew) or any(child.attributes.get("memory_budget_warning") for child in span.children):
+            return
+
+        self.warnings += 1
+        span.set_attribute("memory_budget_warning", True)
+        log.warning(
+            json.dumps(
+                {
+                    "severity": "WARNING",
+                    "message": f"Stage '{span.path}' used {usage_bytes / MB:.1f}MB of the {self.budget_bytes / MB:.0f}MB memory budget.",
+                    "stage": span.path,
+                    "usage_bytes": usage_bytes,
+                    "budget_bytes": self.budget_bytes,
+                    "usage_fraction": round(usage_bytes / self.budget_bytes, 3),
+                    "rss_peak_bytes": usage.rss_peak_bytes,
+                    "tmp_peak_bytes": usage.tmp_peak_bytes,
+                    "tmp_counts_toward_memory": self.tmp_counts_toward_memory,
+                }
+            )
+        )
+
+
+accountant: Optional[ResourceAccountant] = None
+
+
+def install_from_environment() -> Optional[ResourceAccountant]:
+    """Starts accounting for every span if RESOURCE_ACCOUNTING_ENABLED is set. Safe to call more than once."""
+    global accountant
+
+    if accountant is None:
+        accountant = ResourceAccountant.from_environment()
+        if accountant is not None:
+            span_listeners.append(accountant)
+    return accountant
+
+
+def should_prefer_low_memory() -> bool:
+    """
+    Whether the pipeline should take its lowest-memory paths, e.g. streaming downloads to disk instead of holding them.
+    PREFER_LOW_MEMORY is true, false, or auto (default) to switch once this instance has come close to its budget.
+    """
+    setting = os.getenv("PREFER_LOW_MEMORY", PREFER_LOW_MEMORY_AUTO).lower()
+    if setting == PREFER_LOW_MEMORY_ALWAYS:
+        return True
+    if setting == PREFER_LOW_MEMORY_AUTO:
+        return accountant is not None and accountant.is_near_budget
+    return False
@@ -0,0 +1,107 @@
+import json
+import logging
+import os
+import random
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Type,
+    TypeVar,
+)
+
+from pydantic import (
+    BaseModel,
+    parse_obj_as,
+)
+import requests
+
+try:
+    import orjson
+except ImportError:  # optional, we fall back to the standard library decoder
+    orjson = None
+
+
+log = logging.getLogger(__name__)
+
+Model = TypeVar("Model", bound=BaseModel)
+
+# validate: full pydantic validation of every response, values are coerced to their declared types (e.g. datetimes)
+# construct: required keys are checked, then models are built with construct(), values keep their JSON types
+# sample: construct, but fully validate a random sample of responses so schema drift is still caught
+RESPONSE_DECODING_MODE_VALIDATE = "validate"
+RESPONSE_DECODING_MODE_CONSTRUCT = "construct"
+RESPONSE_DECODING_MODE_SAMPLE = "sample"
+RESPONSE_DECODING_MODES = (RESPONSE_DECODING_MODE_VALIDATE, RESPONSE_DECODING_MODE_CONSTRUCT, RESPONSE_DECODING_MODE_SAMPLE)
+
+response_decoding_mode = os.getenv("RESPONSE_DECODING_MODE", RESPONSE_DECODING_MODE_VALIDATE)
+response_decoding_sample_rate = float(os.getenv("RESPONSE_DECODING_SAMPLE_RATE", "0.01"))
+
+_required_fields_by_model: Dict[Type[BaseModel], FrozenSet[str]] = {}
+
+
+def set_response_decoding_mode(mode: str, sample_rate: float = None) -> None:
+    global response_decoding_mode, response_decoding_sample_rate
+
+    if mode not in RESPONSE_DECODING_MODES:
+        raise ValueError(f"Unknown response decoding mode='{mode}'. Expected one of {RESPONSE_DECODING_MODES}")
+
+    response_decoding_mode = mode
+    if sample_rate is not None:
+        response_decoding_sample_rate = sample_rate
+
+
+def decode_json(response: requests.Response) -> Any:
+    """Decodes a response body as JSON using orjson when available. Raises requests' JSONDecodeError like response.json() does."""
+    content = response.content
+    try:
+        if orjson is not None:
+            return orjson.loads(content)
+        return json.loads(content)
+    except json.JSONDecodeError as e:  # orjson.JSONDecodeError is a subclass
+        raise requests.exceptions.JSONDecodeError(e.msg, e.doc, e.pos)
+
+
+def get_required_fields(model: Type[BaseModel]) -> FrozenSet[str]:
+    required_fields = _required_fields_by_model.get(model)
+    if required_fields is None:
+        required_fields = frozenset(field.alias for field in model.__fields__.values() if field.required)
+        _required_fields_by_model[model] = required_fields
+    return required_fields
+
+
+def should_validate(mode: Optional[str] = None) -> bool:
+    mode = mode if mode else response_decoding_mode
+    if mode == RESPONSE_DECODING_MODE_CONSTRUCT:
+        return False
+    if mode == RESPONSE_DECODING_MODE_SAMPLE:
+        return random.random() < response_decoding_sample_rate
+    return True
+
+
+def construct_model(model: Type[Model], data: Any) -> Model:
+    """Builds a model without validating values. Falls back to full validation if the shape is off, so errors stay descriptive."""
+    if not isinstance(data, dict) or not get_required_fields(model).issubset(data.keys()):
+        log.info(f"Response does not have the expected shape for model='{model.__name__}'. Fully validating.")
+        return model.parse_obj(data)
+
+    return model.construct(**data)
+
+
+def parse_model(model: Type[Model], data: Any, mode: str = None) -> Model:
+    if should_validate(mode):
+        return model.parse_obj(data)
+
+    return construct_model(model, data)
+
+
+def parse_model_list(model: Type[Model], data: Any, mode: str = None) -> List[Model]:
+    if should_validate(mode):
+        return parse_obj_as(List[model], data)
+
+    if not isinstance(data, list):
+        return parse_obj_as(List[model], data)  # let pydantic explain what's wrong
+
+    return [construct_model(model, item) for item in data]
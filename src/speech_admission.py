@@ -0,0 +1,284 @@
+from collections import defaultdict
+import logging
+import os
+import random
+import threading
+import time
+from typing import (
+    Callable,
+    Dict,
+    Optional,
+    Protocol,
+    Tuple,
+)
+import uuid
+
+from google.api_core import exceptions as google_exceptions
+
+
+log = logging.getLogger(__name__)
+
+REQUESTS_PER_MINUTE_KEY = "speech:requests:{window}"
+CONCURRENT_OPERATIONS_KEY = "speech:operations"
+RETRY_AFTER_JITTER_SECONDS = 10.0
+MAX_LONG_AUDIO_RETRY_AFTER_FACTOR = 4.0
+
+
+class SpeechQuotaExhaustedError(Exception):
+    """Raised when a submission can't be admitted now. The event should be deferred by retry_after_seconds, not failed."""
+
+    def __init__(self, msg: str, retry_after_seconds: float) -> None:
+        super().__init__(msg)
+        self.retry_after_seconds = retry_after_seconds
+
+
+class QuotaCounter(Protocol):
+    def try_add(self, key: str, amount: int, limit: int, ttl_seconds: Optional[float] = None) -> bool:
+        """Atomically adds amount to the key's count unless that would take it over limit. Returns whether it was added."""
+        ...
+
+    def try_acquire_lease(self, key: str, limit: int, ttl_seconds: float) -> Optional[str]:
+        """
+        Atomically takes one of limit slots under the key for ttl_seconds, reclaiming expired slots first. Returns the
+        lease id, or None if every slot is held.
+        """
+        ...
+
+    def release_lease(self, key: str, lease_id: str) -> None:
+        ...
+
+    def get_next_lease_expiry(self, key: str) -> Optional[float]:
+        """When the soonest held slot expires, if any are held."""
+        ...
+
+    def get_lease_count(self, key: str) -> int:
+        ...
+
+
+class InMemoryQuotaCounter(object):
+    """
+    Counts within one process. It stands in for a counter shared by all instances (e.g. Redis INCR with EXPIRE for
+    counts and a sorted set scored by expiry for leases, or a Firestore transaction), which is what keeps scale-out within
+    quota. With it, each instance only sees its own usage, so budgets should be divided by the expected number of instances.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.time) -> None:
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._counts: Dict[str, int] = defaultdict(int)
+        self._expires_at: Dict[str, float] = {}
+        self._leases: Dict[str, Dict[str, float]] = defaultdict(dict)  # key -> lease id -> expires at
+
+    def _expire(self, now: float) -> None:
+        for key in [k for k, expires_at in self._expires_at.items() if expires_at <= now]:
+            del self._expires_at[key]
+            self._counts.pop(key, None)
+
+    def _expire_leases(self, key: str, now: float) -> None:
+        leases = self._leases[key]
+        for lease_id in [lease_id for lease_id, expires_at in leases.items() if expires_at <= now]:
+            log.warning(f"Lease lease_id='{lease_id}' on key='{key}' expired without being released, reclaiming it.")
+            del leases[lease_id]
+
+    def try_add(self, key: str, amount: int, limit: int, ttl_seconds: Optional[float] = None) -> bool:
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            if self._counts[key] + amount > limit:
+                return False
+            self._counts[key] += amount
+            if ttl_seconds is not None and key not in self._expires_at:
+                self._expires_at[key] = now + ttl_seconds
+            return True
+
+    def try_acquire_lease(self, key: str, limit: int, ttl_seconds: float) -> Optional[str]:
+        with self._lock:
+            now = self._clock()
+            self._expire_leases(key, now)
+            if len(self._leases[key]) >= limit:
+                return None
+            lease_id = uuid.uuid4().hex
+            self._leases[key][lease_id] = now + ttl_seconds
+            return lease_id
+
+    def release_lease(self, key: str, lease_id: str) -> None:
+        with self._lock:
+            self._leases[key].pop(lease_id, None)
+
+    def get_next_lease_expiry(self, key: str) -> Optional[float]:
+        with self._lock:
+            self._expire_leases(key, self._clock())
+            return min(self._leases[key].values(), default=None)
+
+    def get_lease_count(self, key: str) -> int:
+        with self._lock:
+            self._expire_leases(key, self._clock())
+            return len(self._leases[key])
+
+
+class AdmissionTicket(object):
+    """
+    Holds a concurrent-operation slot until released, normally when the long-running operation finishes. The slot is a
+    lease, so one that's never released (the instance was recycled before the operation finished) is reclaimed when it expires.
+    """
+
+    def __init__(self, controller: "SpeechAdmissionController", lease_id: str) -> None:
+        self._controller = controller
+        self.lease_id = lease_id
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self) -> None:
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._controller._release_operation(self.lease_id)
+
+
+class SpeechAdmissionController(object):
+    """
+    Admits Speech-to-Text long_running_recognize submissions within a requests-per-minute and a concurrent-operations budget.
+
+    Admission never waits. A submission that doesn't fit gets a SpeechQuotaExhaustedError telling the caller when to try
+    again, so the event is deferred (see EventDeferral) instead of failing and retrying straight away, and nothing is
+    billed while it waits. When Speech itself rejects a submission for quota, admission pauses until the next minute.
+
+    Requests are counted in fixed one minute windows, which is how the quota is enforced, so bursts are admitted at the
+    full rate until the window is used up. Concurrent operations are leases of operation_lease_seconds, or the audio's
+    duration if longer, since a function instance may not live to see its operation finish and release the slot.
+
+    Shorter audio goes first, which lowers average latency for the same throughput: audio longer than
+    short_audio_seconds may only use long_audio_share of either budget, the rest is kept for short audio. Long audio
+    turned away also backs off longer, in proportion to its duration.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: int,
+        max_concurrent_operations: int,
+        counter: QuotaCounter = None,
+        operation_lease_seconds: float = 15 * 60,
+        busy_retry_after_seconds: float = 60.0,
+        short_audio_seconds: float = 5 * 60,
+        long_audio_share: float = 0.75,
+        clock: Callable[[], float] = time.time,
+        random: Callable[[], float] = random.random,
+    ) -> None:
+        if requests_per_minute <= 0 or max_concurrent_operations <= 0:
+            raise ValueError(f"Budgets must be positive. requests_per_minute='{requests_per_minute}' max_concurrent_operations='{max_concurrent_operations}'")
+
+        self.requests_per_minute = requests_per_minute
+        self.max_concurrent_operations = max_concurrent_operations
+        self._counter = counter if counter is not None else InMemoryQuotaCounter(clock=clock)
+        self.operation_lease_seconds = operation_lease_seconds
+        self.busy_retry_after_seconds = busy_retry_after_seconds  # operations usually finish well before their lease expires
+        self.short_audio_seconds = short_audio_seconds
+        self.long_audio_share = long_audio_share
+        self._clock = clock
+        self._random = random
+
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+
+        self.admitted = 0
+        self.rejected = 0
+
+    @classmethod
+    def from_environment(cls) -> Optional["SpeechAdmissionController"]:
+        """Enabled by SPEECH_REQUESTS_PER_MINUTE."""
+        requests_per_minute = int(os.getenv("SPEECH_REQUESTS_PER_MINUTE", "0"))
+        if requests_per_minute <= 0:
+            return None
+
+        return cls(
+            requests_per_minute=requests_per_minute,
+            max_concurrent_operations=int(os.getenv("SPEECH_MAX_CONCURRENT_OPERATIONS", "100")),
+            operation_lease_seconds=float(os.getenv("SPEECH_OPERATION_LEASE_SECONDS", "900")),
+            short_audio_seconds=float(os.getenv("SPEECH_SHORT_AUDIO_SECONDS", "300")),
+            long_audio_share=float(os.getenv("SPEECH_LONG_AUDIO_SHARE", "0.75")),
+        )
+
+    def _seconds_until_next_window(self, now: float) -> float:
+        return 60.0 - now % 60.0
+
+    def is_long_audio(self, audio_seconds: float) -> bool:
+        return audio_seconds > self.short_audio_seconds
+
+    def get_limits(self, audio_seconds: float) -> Tuple[int, int]:
+        """(requests per minute, concurrent operations) the audio may use, less for long audio."""
+        if not self.is_long_audio(audio_seconds):
+            return self.requests_per_minute, self.max_concurrent_operations
+        return max(1, int(self.requests_per_minute * self.long_audio_share)), max(1, int(self.max_concurrent_operations * self.long_audio_share))
+
+    def admit(self, audio_seconds: float = 0.0) -> AdmissionTicket:
+        """
+        Takes a concurrent-operation slot and a request from this minute's budget, or raises SpeechQuotaExhaustedError
+        straight away. Release the ticket when the operation finishes.
+        """
+        requests_per_minute, max_concurrent_operations = self.get_limits(audio_seconds)
+        now = self._clock()
+        with self._lock:
+            paused_until = self._paused_until
+        if now < paused_until:
+            raise self._get_exhausted_error(audio_seconds, "paused after Speech-to-Text rejected a submission for quota", paused_until - now)
+
+        lease_seconds = max(self.operation_lease_seconds, audio_seconds)
+        lease_id = self._counter.try_acquire_lease(CONCURRENT_OPERATIONS_KEY, max_concurrent_operations, lease_seconds)
+        if lease_id is None:
+            next_lease_expiry = self._counter.get_next_lease_expiry(CONCURRENT_OPERATIONS_KEY)
+            retry_after = self.busy_retry_after_seconds if next_lease_expiry is None else min(self.busy_retry_after_seconds, next_lease_expiry - now)
+            raise self._get_exhausted_error(audio_seconds, f"{max_concurrent_operations} concurrent operations are running", retry_after)
+
+        window = int(now // 60)
+        if not self._counter.try_add(REQUESTS_PER_MINUTE_KEY.format(window=window), 1, requests_per_minute, ttl_seconds=120):
+            self._counter.release_lease(CONCURRENT_OPERATIONS_KEY, lease_id)
+            raise self._get_exhausted_error(audio_seconds, f"{requests_per_minute} requests of this minute are used", self._seconds_until_next_window(now))
+
+        with self._lock:
+            self.admitted += 1
+        return AdmissionTicket(self, lease_id)
+
+    def _get_exhausted_error(self, audio_seconds: float, reason: str, retry_after_seconds: float) -> SpeechQuotaExhaustedError:
+        with self._lock:
+            self.rejected += 1
+        # jittered, so events deferred together don't all come back together, and longer for long audio so short audio comes back first
+        retry_after_seconds = max(0.0, retry_after_seconds) + self._random() * RETRY_AFTER_JITTER_SECONDS
+        if self.is_long_audio(audio_seconds):
+            retry_after_seconds *= min(audio_seconds / self.short_audio_seconds, MAX_LONG_AUDIO_RETRY_AFTER_FACTOR)
+        return SpeechQuotaExhaustedError(
+            f"Speech-to-Text quota not available, {reason}. audio_seconds='{audio_seconds}'", retry_after_seconds=retry_after_seconds
+        )
+
+    def _release_operation(self, lease_id: str) -> None:
+        self._counter.release_lease(CONCURRENT_OPERATIONS_KEY, lease_id)
+
+    def pause_until_next_window(self) -> None:
+        with self._lock:
+            now = self._clock()
+            self._paused_until = max(self._paused_until, now + self._seconds_until_next_window(now))
+
+    def submit(self, submit: Callable[[], object], audio_seconds: float = 0.0):
+        """
+        Admits, then calls submit, which should start a long-running operation and return it. The concurrent-operation slot
+        is held until the operation is done. Returns the operation.
+        """
+        ticket = self.admit(audio_seconds)
+        try:
+            operation = submit()
+        except google_exceptions.ResourceExhausted as e:
+            ticket.release()
+            self.pause_until_next_window()
+            raise SpeechQuotaExhaustedError(
+                f"Speech-to-Text rejected the submission for quota. Error: {e}", self._seconds_until_next_window(self._clock())
+            ) from e
+        except Exception:
+            ticket.release()
+            raise
+
+        operation.add_done_callback(lambda _: ticket.release())
+        return operation
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"admitted": self.admitted, "rejected": self.rejected, "operations": self._counter.get_lease_count(CONCURRENT_OPERATIONS_KEY)}
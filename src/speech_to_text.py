@@ -1,11 +1,19 @@
 import logging
-from typing import Dict, List, Tuple
+from typing import Dict, List, NamedTuple
+from google.api_core import operation
 from google.cloud import speech_v1p1beta1 as speech
 import google.cloud.speech_v1p1beta1.types as types
 
 log = logging.getLogger(__name__)
 
 
+class TranscriptWord(NamedTuple):
+    word: str
+    start_time: float  # seconds from the start of the audio
+    end_time: float
+    channel_tag: int
+
+
 def transcribe_model_selection(
     source_uri: str,
     destination_uri: str,
@@ -20,9 +28,10 @@ def transcribe_model_selection(
     diarization_speaker_count: int = 2,
     use_enhanced: bool = True,
     enable_separate_recognition_per_channel: bool = True,
-) -> Tuple[List[str], Dict]:
+) -> operation.Operation:
     """
     Should asynchronously convert Speech to Text using speech_v1p1beta1.
+    Returns the long-running operation, which is done once the transcript has been written to destination_uri.
     IMPORTANT: Even if destination_uri is
     gs://peerlogic-goog-speech-to-text-raw-extract-ana/bo6FTU5HbpsUmYn8TFofNq.json
     If processed a second time (with or without Object Versioning turned on),
@@ -47,8 +56,8 @@ def transcribe_model_selection(
 
     request_config = types.LongRunningRecognizeRequest(config=config, audio=audio, output_config=output_config)
 
-    # TODO: Wrap in Future? seems to be still blocking when I test, for whatever reason
-    client.long_running_recognize(request=request_config)
+    # Submitting doesn't wait for the transcription, the operation does if asked for its result()
+    return client.long_running_recognize(request=request_config)
 
 
 def get_channel_segregated_transcripts(transcript_raw_response):
@@ -96,3 +105,31 @@ def order_transcript_words_by_start_time(speech_to_text_response: Dict) -> List[
         ordered_word_list.insert(index + 1, v)
 
     return ordered_word_list
+
+
+def parse_duration_seconds(duration: str) -> float:
+    """Durations in the raw extract look like "1.500s"."""
+    return float(duration[:-1]) if duration.endswith("s") else float(duration)
+
+
+def get_transcript_words(speech_to_text_response: Dict) -> List[TranscriptWord]:
+    """Input: Transcript JSON. Output: Words of every channel with their times, ordered by start time"""
+    transcript_words = []
+    for item in speech_to_text_response["results"]:
+        alternative = item["alternatives"][0]
+        if not alternative.get("transcript"):
+            continue
+        channel_tag = item.get("channel_tag", 1)
+        for info in alternative.get("words", []):
+            transcript_words.append(
+                TranscriptWord(
+                    word=info["word"],
+                    start_time=parse_duration_seconds(info["start_time"]),
+                    end_time=parse_duration_seconds(info["end_time"]),
+                    channel_tag=channel_tag,
+                )
+            )
+
+    # stable, so words starting at the same time keep the order they were transcribed in
+    transcript_words.sort(key=lambda transcript_word: transcript_word.start_time)
+    return transcript_words
@@ -0,0 +1,137 @@
+from concurrent.futures import Future
+import logging
+import re
+import threading
+import time
+from typing import (
+    Callable,
+    Dict,
+    Optional,
+)
+
+import requests
+
+from peerlogic_api_client import PeerlogicAPIClient
+from peerlogic_api_models import TelecomCallerNameInfo
+from ttl_lru_cache import TTLLRUCache
+
+
+log = logging.getLogger(__name__)
+
+NON_DIGITS = re.compile(r"[^0-9]")
+
+# stored in the cache for numbers the API doesn't know about, so we don't keep asking
+UNKNOWN_CALLER_NAME_INFO = object()
+
+
+def normalize_phone_number_to_e164(phone_number: str, default_country_code: str = "1") -> Optional[str]:
+    """
+    Normalizes the formats we see from telephony, e.g. "1 (800) 554-1907", "+18005541907" and "8005541907" are all "+18005541907".
+    Returns None if the number can't be confidently normalized.
+    """
+    if not phone_number:
+        return None
+
+    stripped = phone_number.strip()
+    digits = NON_DIGITS.sub("", stripped)
+    if not digits:
+        return None
+
+    if stripped.startswith("+"):
+        e164 = f"+{digits}"
+    elif digits.startswith("011"):  # international dialing prefix from North America
+        e164 = f"+{digits[3:]}"
+    elif default_country_code == "1" and len(digits) == 10:
+        e164 = f"+1{digits}"
+    elif default_country_code == "1" and len(digits) == 11 and digits.startswith("1"):
+        e164 = f"+{digits}"
+    else:
+        return None
+
+    # E.164 allows at most 15 digits, and there are no valid numbers shorter than 8 including country code
+    if not 8 <= len(e164) - 1 <= 15:
+        return None
+
+    return e164
+
+
+class TelecomCallerNameInfoLookup(object):
+    """
+    Caching layer in front of PeerlogicAPIClient.get_telecom_caller_name_info.
+
+    Numbers are normalized to E.164 so every format of the same number shares one cache entry. Unknown numbers (404s)
+    are cached for negative_ttl_seconds. Concurrent lookups of the same number share a single request.
+    """
+
+    def __init__(
+        self,
+        peerlogic_api_client: PeerlogicAPIClient,
+        max_entries: int = 10000,
+        ttl_seconds: float = 24 * 60 * 60,
+        negative_ttl_seconds: float = 60 * 60,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._client = peerlogic_api_client
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+
+        self._cache = TTLLRUCache(max_entries=max_entries, clock=clock)
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, Future] = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, phone_number: str) -> Optional[TelecomCallerNameInfo]:
+        """Returns caller name info for the number, or None if the API doesn't know the number."""
+        e164 = normalize_phone_number_to_e164(phone_number)
+        if not e164:
+            log.info(f"Could not normalize phone_number='{phone_number}' to E.164. Looking it up without caching.")
+            return self._fetch(phone_number)
+
+        with self._lock:
+            cached = self._cache.get(e164)
+            if cached is not None:
+                self.hits += 1
+                return None if cached is UNKNOWN_CALLER_NAME_INFO else cached
+
+            in_flight = self._in_flight.get(e164)
+            if in_flight is None:
+                self.misses += 1
+                in_flight = self._in_flight[e164] = Future()
+                is_owner = True
+            else:
+                self.hits += 1  # coalesced onto someone else's request
+                is_owner = False
+
+        if not is_owner:
+            return in_flight.result()
+
+        try:
+            caller_name_info = self._fetch(e164)
+            with self._lock:
+                if caller_name_info is None:
+                    self._cache.set(e164, UNKNOWN_CALLER_NAME_INFO, self.negative_ttl_seconds)
+                else:
+                    self._cache.set(e164, caller_name_info, self.ttl_seconds)
+            in_flight.set_result(caller_name_info)
+            return caller_name_info
+        except Exception as e:
+            in_flight.set_exception(e)  # errors aren't cached, the next lookup tries again
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[e164]
+
+    def _fetch(self, phone_number: str) -> Optional[TelecomCallerNameInfo]:
+        try:
+            return self._client.get_telecom_caller_name_info(phone_number)
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                log.info(f"No telecom caller name info found for phone_number='{phone_number}'")
+                return None
+            raise
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
@@ -0,0 +1,220 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import json
+import logging
+import os
+import time
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+)
+
+
+log = logging.getLogger(__name__)
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Span(object):
+    """
+    A timed stage of work. Spans nest, the parent is whichever span is active when a span is started.
+
+    Timing uses a monotonic clock. Wall clock time is only captured once per trace, for exporters that need it.
+    """
+
+    __slots__ = ("name", "attributes", "parent", "children", "start_ns", "end_ns", "error", "wall_start_ns", "_token")
+
+    def __init__(self, name: str, parent: Optional["Span"] = None, attributes: Dict[str, Any] = None) -> None:
+        self.name = name
+        self.attributes: Dict[str, Any] = attributes if attributes else {}
+        self.parent = parent
+        self.children: List["Span"] = []
+        self.start_ns = 0
+        self.end_ns = 0
+        self.error: Optional[str] = None
+        self.wall_start_ns = parent.wall_start_ns if parent else 0
+        self._token = None
+
+        if parent is not None:
+            parent.children.append(self)
+
+    def __enter__(self) -> "Span":
+        if self.parent is None:
+            self.wall_start_ns = time.time_ns() - time.perf_counter_ns()  # offset to turn monotonic times into wall clock times
+        self._token = _current_span.set(self)
+        for listener in span_listeners:
+            listener.on_start(self)
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.end_ns = time.perf_counter_ns()
+        if exc_type is not None:
+            self.error = f"{exc_type.__name__}: {exc_value}"
+        for listener in span_listeners:
+            listener.on_end(self)
+        _current_span.reset(self._token)
+
+    @property
+    def duration_seconds(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e9
+
+    @property
+    def path(self) -> str:
+        return f"{self.parent.path}/{self.name}" if self.parent else self.name
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def walk(self) -> Iterator["Span"]:
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def to_summary(self) -> Dict[str, Any]:
+        """One structured record for the whole trace, with a flat list of stages for easy aggregation."""
+        return {
+            "trace": self.name,
+            "duration_seconds": round(self.duration_seconds, 6),
+            "error": self.error,
+            "attributes": self.attributes,
+            "stages": [
+                {
+                    "stage": span.path,
+                    "offset_seconds": round((span.start_ns - self.start_ns) / 1e9, 6),
+                    "duration_seconds": round(span.duration_seconds, 6),
+                    "error": span.error,
+                    "attributes": span.attributes,
+                }
+                for span in self.walk()
+                if span is not self
+            ],
+        }
+
+
+#
+# Exporters, called once per finished trace
+#
+
+
+class LoggingSpanExporter(object):
+    """Emits one structured log line per trace."""
+
+    def __init__(self, logger: logging.Logger = log) -> None:
+        self.logger = logger
+
+    def export(self, root: Span) -> None:
+        self.logger.info(json.dumps(root.to_summary(), default=str))
+
+
+class InMemorySpanExporter(object):
+    """Keeps finished traces in memory. Stands in for a collector locally, in benchmarks and in tests."""
+
+    def __init__(self) -> None:
+        self.traces: List[Span] = []
+
+    def export(self, root: Span) -> None:
+        self.traces.append(root)
+
+    def get_stage_durations(self) -> Dict[str, List[float]]:
+        durations: Dict[str, List[float]] = {}
+        for root in self.traces:
+            for span in root.walk():
+                durations.setdefault(span.path, []).append(span.duration_seconds)
+        return durations
+
+    def clear(self) -> None:
+        self.traces.clear()
+
+
+class OpenTelemetrySpanExporter(object):
+    """
+    Replays finished traces into OpenTelemetry and flushes them to an OTLP endpoint, e.g. a local collector.
+    Requires opentelemetry-sdk and opentelemetry-exporter-otlp-proto-grpc, which are optional.
+    """
+
+    def __init__(self, endpoint: str, service_name: str = "cf-transcribe-audio-peerlogic") -> None:
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.trace import set_span_in_context
+
+        self._set_span_in_context = set_span_in_context
+        self._provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+        self._provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint, insecure=endpoint.startswith("http://"))))
+        self._tracer = self._provider.get_tracer(__name__)
+
+    def export(self, root: Span) -> None:
+        self._export_span(root, context=None)
+        self._provider.force_flush()  # instances may be frozen as soon as the event is handled
+
+    def _export_span(self, span: Span, context) -> None:
+        attributes = {key: value if isinstance(value, (str, bool, int, float)) else str(value) for key, value in span.attributes.items()}
+        otel_span = self._tracer.start_span(span.name, context=context, attributes=attributes, start_time=span.wall_start_ns + span.start_ns)
+        if span.error:
+            otel_span.set_attribute("error", span.error)
+        child_context = self._set_span_in_context(otel_span)
+        for child in span.children:
+            self._export_span(child, child_context)
+        otel_span.end(end_time=span.wall_start_ns + span.end_ns)
+
+
+def get_exporters_from_environment() -> List[Any]:
+    """TRACING_EXPORTERS is a comma separated list of log and otlp. The otlp exporter sends to TRACING_OTLP_ENDPOINT."""
+    exporters = []
+    for name in os.getenv("TRACING_EXPORTERS", "log").split(","):
+        name = name.strip()
+        if name == "log":
+            exporters.append(LoggingSpanExporter())
+        elif name == "otlp":
+            endpoint = os.getenv("TRACING_OTLP_ENDPOINT", "http://localhost:4317")
+            try:
+                exporters.append(OpenTelemetrySpanExporter(endpoint=endpoint))
+            except ImportError:
+                log.warning("TRACING_EXPORTERS includes otlp but opentelemetry is not installed. Skipping.")
+        elif name:
+            log.warning(f"Ignoring unknown tracing exporter='{name}'")
+    return exporters
+
+
+exporters: List[Any] = get_exporters_from_environment()
+
+# Called as each span starts and ends, outside the span's own timing, e.g. to sample resource usage at stage boundaries.
+# Listeners implement on_start(span) and on_end(span), and must be cheap and not raise.
+span_listeners: List[Any] = []
+
+
+#
+# Entry points
+#
+
+
+@contextmanager
+def start_trace(name: str, **attributes: Any) -> Iterator[Span]:
+    """Starts a root span. It's exported when the block exits, whether or not it raised."""
+    root = Span(name, parent=None, attributes=attributes)
+    try:
+        with root:
+            yield root
+    finally:
+        for exporter in exporters:
+            try:
+                exporter.export(root)
+            except Exception:
+                log.exception(f"Problem occurred exporting trace with exporter='{type(exporter).__name__}'. Ignoring.")
+
+
+def span(name: str, **attributes: Any) -> Span:
+    """Starts a span nested under the active span. Use as a context manager."""
+    return Span(name, parent=_current_span.get(), attributes=attributes)
+
+
+def get_current_span() -> Optional[Span]:
+    return _current_span.get()
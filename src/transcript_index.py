@@ -0,0 +1,203 @@
+from array import array
+from bisect import bisect_left, bisect_right
+import json
+import logging
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
+from speech_to_text import TranscriptWord, get_transcript_words
+
+
+log = logging.getLogger(__name__)
+
+TRANSCRIPT_INDEX_VERSION = 1
+TRANSCRIPT_INDEX_SUFFIX = ".index.json"
+
+
+def parse_clock_time(value: str) -> float:
+    """Seconds from "250", "250.5s", "04:10" or "1:04:10"."""
+    value = value.strip().rstrip("s")
+    seconds = 0.0
+    for part in value.split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def get_transcript_index_blob_name(transcript_blob_name: str) -> str:
+    """Where an index is stored next to its raw extract, e.g. bo6FTU5HbpsUmYn8TFofNq.json -> bo6FTU5HbpsUmYn8TFofNq.index.json"""
+    base_name = transcript_blob_name[: -len(".json")] if transcript_blob_name.endswith(".json") else transcript_blob_name
+    return f"{base_name}{TRANSCRIPT_INDEX_SUFFIX}"
+
+
+def normalize_word(word: str) -> str:
+    return "".join(character for character in word.lower() if character.isalnum())
+
+
+class TimeColumn(object):
+    """
+    Positions of words ordered by start time, with their start times and the running maximum of their end times.
+    Start times bound a range query from above. End times aren't sorted, since a long word can outlast the next one,
+    but their running maximum is, and bounds it from below.
+    """
+
+    __slots__ = ("positions", "start_times", "max_end_times")
+
+    def __init__(self, positions: Iterable[int], start_times: array, end_times: array) -> None:
+        self.positions = array("l", positions)
+        self.start_times = array("d", (start_times[position] for position in self.positions))
+        self.max_end_times = array("d")
+        max_end_time = float("-inf")
+        for position in self.positions:
+            max_end_time = max(max_end_time, end_times[position])
+            self.max_end_times.append(max_end_time)
+
+    def get_slice(self, start_time: float, end_time: float) -> Tuple[int, int]:
+        """Bounds of the words that may overlap [start_time, end_time]: every word before ends before start_time, every word after starts after end_time."""
+        return bisect_left(self.max_end_times, start_time), bisect_right(self.start_times, end_time)
+
+
+class TranscriptIndex(object):
+    """
+    Words of a transcript in flat arrays ordered by start time, for range, nearest word and keyword lookups in
+    O(log n) (plus the size of the result) instead of rescanning the raw extract.
+
+    Build one from a raw extract, or from words already on a call's timeline (e.g. a MergedCallTranscript):
+
+        index = TranscriptIndex.from_speech_to_text_response(raw_extract)
+        index.get_words_between(parse_clock_time("04:10"), parse_clock_time("04:40"), channel_tag=2)
+        index.get_clip_range(index.find("root canal")[0], padding_seconds=10)
+
+    to_json() serializes it to store next to the transcript, see get_transcript_index_blob_name.
+    """
+
+    def __init__(self, transcript_words: Iterable[TranscriptWord]) -> None:
+        transcript_words = sorted(transcript_words, key=lambda transcript_word: transcript_word.start_time)  # stable, and cheap when already sorted
+
+        self.words: List[str] = [transcript_word.word for transcript_word in transcript_words]
+        self.start_times = array("d", (transcript_word.start_time for transcript_word in transcript_words))
+        self.end_times = array("d", (transcript_word.end_time for transcript_word in transcript_words))
+        self.channel_tags = array("l", (transcript_word.channel_tag for transcript_word in transcript_words))
+
+        self._all = TimeColumn(range(len(self.words)), self.start_times, self.end_times)
+        channel_positions: Dict[int, List[int]] = {}
+        self._word_positions: Dict[str, List[int]] = {}
+        for position, (word, channel_tag) in enumerate(zip(self.words, self.channel_tags)):
+            channel_positions.setdefault(channel_tag, []).append(position)
+            self._word_positions.setdefault(normalize_word(word), []).append(position)
+        self._channels = {channel_tag: TimeColumn(positions, self.start_times, self.end_times) for channel_tag, positions in channel_positions.items()}
+        # where each word falls in its channel, to follow phrases past the other channel's words
+        self._channel_offsets = array("l", [0] * len(self.words))
+        for channel in self._channels.values():
+            for offset, position in enumerate(channel.positions):
+                self._channel_offsets[position] = offset
+
+    @classmethod
+    def from_speech_to_text_response(cls, speech_to_text_response: Dict) -> "TranscriptIndex":
+        return cls(get_transcript_words(speech_to_text_response))
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    @property
+    def channel_tags_present(self) -> List[int]:
+        return sorted(self._channels)
+
+    def get_word(self, position: int) -> TranscriptWord:
+        return TranscriptWord(
+            word=self.words[position], start_time=self.start_times[position], end_time=self.end_times[position], channel_tag=self.channel_tags[position]
+        )
+
+    def _get_column(self, channel_tag: Optional[int]) -> Optional[TimeColumn]:
+        return self._all if channel_tag is None else self._channels.get(channel_tag)
+
+    #
+    # Lookups
+    #
+
+    def get_words_between(self, start_time: float, end_time: float, channel_tag: int = None) -> List[TranscriptWord]:
+        """Words overlapping [start_time, end_time] at all, ordered by start time, of one channel or all of them."""
+        column = self._get_column(channel_tag)
+        if column is None:
+            return []
+        low, high = column.get_slice(start_time, end_time)
+        positions = (column.positions[i] for i in range(low, high))
+        return [self.get_word(position) for position in positions if self.end_times[position] >= start_time]
+
+    def get_nearest_word(self, time: float, channel_tag: int = None) -> Optional[TranscriptWord]:
+        """The word spoken at time, or the closest to it if there's a gap. Ties go to the earlier word."""
+        column = self._get_column(channel_tag)
+        if column is None or not column.positions:
+            return None
+
+        # of the words that started by time, the closest is the one ending last, which the running maximum of end
+        # times finds. Of those starting after, it's the first
+        i = bisect_right(column.start_times, time)
+        candidates = []
+        if i > 0:
+            candidates.append(column.positions[bisect_left(column.max_end_times, column.max_end_times[i - 1])])
+        if i < len(column.positions):
+            candidates.append(column.positions[i])
+
+        def get_distance(position: int) -> float:
+            return max(self.start_times[position] - time, time - self.end_times[position], 0.0)
+
+        return self.get_word(min(candidates, key=lambda position: (get_distance(position), self.start_times[position])))
+
+    def find(self, phrase: str, channel_tag: int = None) -> List[Tuple[float, float, int]]:
+        """(start, end, channel) of each time phrase was said, ignoring case and punctuation. Phrases may span words."""
+        tokens = [token for token in (normalize_word(word) for word in phrase.split()) if token]
+        if not tokens:
+            return []
+
+        occurrences = []
+        for position in self._word_positions.get(tokens[0], []):
+            word_channel_tag = self.channel_tags[position]
+            if channel_tag is not None and word_channel_tag != channel_tag:
+                continue
+            channel = self._channels[word_channel_tag]
+            offset = self._channel_offsets[position]
+            following = channel.positions[offset : offset + len(tokens)]
+            if len(following) == len(tokens) and all(normalize_word(self.words[p]) == token for p, token in zip(following, tokens)):
+                occurrences.append((self.start_times[position], self.end_times[following[-1]], word_channel_tag))
+        return occurrences
+
+    def get_clip_range(self, occurrence: Tuple[float, float, int], padding_seconds: float = 5.0) -> Tuple[float, float]:
+        """(start, end) of the audio around an occurrence from find(), padded on both sides and clamped to the transcript."""
+        start_time, end_time, _ = occurrence
+        transcript_end_time = self._all.max_end_times[-1] if self.words else end_time
+        return max(0.0, start_time - padding_seconds), min(transcript_end_time, end_time + padding_seconds)
+
+    #
+    # Serialization
+    #
+
+    def to_dict(self) -> Dict:
+        # columns rather than objects per word, and the lookup structures are rebuilt on load
+        return {
+            "version": TRANSCRIPT_INDEX_VERSION,
+            "words": self.words,
+            "start_times": self.start_times.tolist(),
+            "end_times": self.end_times.tolist(),
+            "channel_tags": self.channel_tags.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "TranscriptIndex":
+        if data.get("version") != TRANSCRIPT_INDEX_VERSION:
+            raise Exception(f"Unsupported transcript index version {data.get('version')}, expected {TRANSCRIPT_INDEX_VERSION}.")
+        return cls(
+            TranscriptWord(word=word, start_time=start_time, end_time=end_time, channel_tag=channel_tag)
+            for word, start_time, end_time, channel_tag in zip(data["words"], data["start_times"], data["end_times"], data["channel_tags"])
+        )
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, content: str) -> "TranscriptIndex":
+        return cls.from_dict(json.loads(content))
@@ -0,0 +1,189 @@
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+import heapq
+from itertools import chain
+import json
+import logging
+from typing import (
+    Dict,
+    Iterator,
+    List,
+    Set,
+    Tuple,
+)
+
+from speech_to_text import TranscriptWord, get_transcript_words
+
+
+log = logging.getLogger(__name__)
+
+MERGED_CALL_TRANSCRIPT_VERSION = 1
+
+
+def get_start_time(transcript_word: TranscriptWord) -> float:
+    return transcript_word.start_time
+
+
+def get_partial_offset_seconds(call_start_time: datetime, time_interaction_started: datetime) -> float:
+    """Where a call partial starts on the call's timeline. Both datetimes must be timezone aware, or both naive."""
+    return (time_interaction_started - call_start_time).total_seconds()
+
+
+class TranscriptRun(object):
+    """Words of one or more call partials whose times overlap, ordered by start time."""
+
+    __slots__ = ("start_time", "end_time", "words", "partial_ids")
+
+    def __init__(self, words: List[TranscriptWord], partial_ids: List[str]) -> None:
+        self.words = words
+        self.partial_ids = partial_ids
+        self.start_time = words[0].start_time
+        self.end_time = max(transcript_word.end_time for transcript_word in words)
+
+
+class MergedCallTranscript(object):
+    """
+    Call-level transcript on one timeline, built from the transcripts of its call partials, which may arrive in any
+    order. Each partial's word times are offset by its time_interaction_started relative to the call's start.
+
+    The transcript is kept as runs that don't overlap in time, ordered by start. Adding a partial only merges it with
+    the runs it overlaps (heapq.merge of sorted word streams), and otherwise inserts it between its neighbours, so a
+    late partial costs about its own size however much of the call was merged before it. Partials of one call rarely
+    overlap, so most calls end up as one run per partial.
+
+    The runs serialize with to_json(), so the merged transcript can be stored and a later invocation can load it and
+    add its partial without the others' raw extracts.
+
+    e.g.
+        merged = MergedCallTranscript(call.call_start_time)
+        merged.add_partial(partial_id, time_interaction_started, raw_extract)
+        format_transcript(merged.get_word_list())
+
+        merged = MergedCallTranscript.from_json(stored)
+        merged.add_partial(late_partial_id, late_time_interaction_started, late_raw_extract)
+        stored = merged.to_json()
+    """
+
+    def __init__(self, call_start_time: datetime) -> None:
+        self.call_start_time = call_start_time
+
+        self._runs: List[TranscriptRun] = []
+        # parallel to _runs for bisecting. Runs don't overlap, so both are sorted
+        self._run_start_times: List[float] = []
+        self._run_end_times: List[float] = []
+        self._partial_ids: Set[str] = set()
+        self.word_count = 0
+
+    @property
+    def partial_ids(self) -> Set[str]:
+        return set(self._partial_ids)
+
+    @property
+    def run_count(self) -> int:
+        return len(self._runs)
+
+    def __len__(self) -> int:
+        return self.word_count
+
+    def __iter__(self) -> Iterator[TranscriptWord]:
+        return chain.from_iterable(run.words for run in self._runs)
+
+    def get_words(self) -> List[TranscriptWord]:
+        """Every word of the call, ordered by start time on the call's timeline."""
+        return list(self)
+
+    def get_word_list(self) -> List[str]:
+        """Like order_transcript_words_by_start_time, for format_transcript."""
+        return [transcript_word.word for transcript_word in self]
+
+    def get_time_ranges(self) -> List[Tuple[float, float, List[str]]]:
+        """(start, end, partial ids) of each run, in seconds on the call's timeline."""
+        return [(run.start_time, run.end_time, list(run.partial_ids)) for run in self._runs]
+
+    def add_partial(self, partial_id: str, time_interaction_started: datetime, speech_to_text_response: Dict) -> int:
+        """Merges a call partial's raw extract in. Returns the number of words added."""
+        offset_seconds = get_partial_offset_seconds(self.call_start_time, time_interaction_started)
+        transcript_words = [
+            transcript_word._replace(start_time=transcript_word.start_time + offset_seconds, end_time=transcript_word.end_time + offset_seconds)
+            for transcript_word in get_transcript_words(speech_to_text_response)
+        ]
+        return self.add_words(partial_id, transcript_words)
+
+    def add_words(self, partial_id: str, transcript_words: List[TranscriptWord]) -> int:
+        """Merges words already on the call's timeline and ordered by start time. Returns the number of words added."""
+        if partial_id in self._partial_ids:
+            log.info(f"Call partial partial_id='{partial_id}' was already merged. Ignoring.")
+            return 0
+        self._partial_ids.add(partial_id)
+        if not transcript_words:
+            return 0
+
+        run = TranscriptRun(transcript_words, [partial_id])
+        # runs from first up to last overlap the new one, those before end by its start and those after start from its end
+        first = bisect_right(self._run_end_times, run.start_time)
+        last = max(first, bisect_left(self._run_start_times, run.end_time))
+        overlapping = self._runs[first:last]
+        if overlapping:
+            run = TranscriptRun(
+                list(heapq.merge(*(overlapping_run.words for overlapping_run in overlapping), transcript_words, key=get_start_time)),
+                [overlapping_partial_id for overlapping_run in overlapping for overlapping_partial_id in overlapping_run.partial_ids] + [partial_id],
+            )
+            log.info(f"Call partial partial_id='{partial_id}' overlaps {len(overlapping)} merged run(s), merging {len(run.words)} words.")
+
+        self._runs[first:last] = [run]
+        self._run_start_times[first:last] = [run.start_time]
+        self._run_end_times[first:last] = [run.end_time]
+        self.word_count += len(transcript_words)
+        return len(transcript_words)
+
+    #
+    # Serialization
+    #
+
+    def to_dict(self) -> Dict:
+        # columns per run rather than objects per word. Runs are stored as they are, so loading doesn't merge anything
+        return {
+            "version": MERGED_CALL_TRANSCRIPT_VERSION,
+            "call_start_time": self.call_start_time.isoformat(),
+            "partial_ids": sorted(self._partial_ids),  # including partials without words, which have no run
+            "runs": [
+                {
+                    "partial_ids": run.partial_ids,
+                    "words": [transcript_word.word for transcript_word in run.words],
+                    "start_times": [transcript_word.start_time for transcript_word in run.words],
+                    "end_times": [transcript_word.end_time for transcript_word in run.words],
+                    "channel_tags": [transcript_word.channel_tag for transcript_word in run.words],
+                }
+                for run in self._runs
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "MergedCallTranscript":
+        if data.get("version") != MERGED_CALL_TRANSCRIPT_VERSION:
+            raise Exception(f"Unsupported merged call transcript version {data.get('version')}, expected {MERGED_CALL_TRANSCRIPT_VERSION}.")
+
+        merged = cls(datetime.fromisoformat(data["call_start_time"]))
+        for run_data in data["runs"]:
+            run = TranscriptRun(
+                [
+                    TranscriptWord(word=word, start_time=start_time, end_time=end_time, channel_tag=channel_tag)
+                    for word, start_time, end_time, channel_tag in zip(
+                        run_data["words"], run_data["start_times"], run_data["end_times"], run_data["channel_tags"]
+                    )
+                ],
+                list(run_data["partial_ids"]),
+            )
+            merged._runs.append(run)
+            merged._run_start_times.append(run.start_time)
+            merged._run_end_times.append(run.end_time)
+            merged.word_count += len(run.words)
+        merged._partial_ids = set(data["partial_ids"])
+        return merged
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, content: str) -> "MergedCallTranscript":
+        return cls.from_dict(json.loads(content))
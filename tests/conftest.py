@@ -0,0 +1,21 @@
+"""
+Unit test setup. Run with python -m pytest tests
+"""
+import os
+import sys
+from unittest import mock
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "src"))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "benchmarks"))
+
+# must be set before the function's modules are imported
+os.environ.setdefault("PROJECT_ID", "test")
+os.environ.setdefault("BUCKET_OUTPUT_AUDIO_PCM_ENCODED", "test-audio-pcm-encoded")
+os.environ.setdefault("BUCKET_OUTPUT_RAW_EXTRACT", "test-raw-extract")
+os.environ.setdefault("TRACING_EXPORTERS", "")
+
+from fakes import FakeStorageClient  # noqa: E402
+
+# local_file_helpers creates a storage client at import, which needs credentials
+mock.patch("google.cloud.storage.Client", FakeStorageClient).start()
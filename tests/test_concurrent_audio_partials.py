@@ -0,0 +1,76 @@
+import json
+import os
+import threading
+from unittest import mock
+
+import pytest
+
+from fakes import FakeDlpServiceClient, FakeSpeechClient
+from pull_worker import InMemoryMessageSource, PullWorker
+from synthetic import make_pcm_wav_bytes
+
+with mock.patch("google.cloud.dlp_v2.DlpServiceClient", FakeDlpServiceClient), mock.patch("google.cloud.speech_v1p1beta1.SpeechClient", FakeSpeechClient):
+    import main
+
+SAMPLE_RATES = {"audio-partial-1": 8000, "audio-partial-2": 16000}
+
+
+class FakeResponse(object):
+    def raise_for_status(self) -> None:
+        pass
+
+
+class FakePeerlogicAPIClient(object):
+    """Serves a WAV with a different sample rate per audio partial. Both downloads finish writing before either is read."""
+
+    def __init__(self) -> None:
+        self._written = threading.Barrier(len(SAMPLE_RATES), timeout=10)
+        self.paths = []
+
+    def get_call_audio_partial_signed_url(self, call_id: str, partial_id: str, audio_partial_id: str) -> str:
+        return f"https://storage.test/{audio_partial_id}.wav"
+
+    def _get_wav_bytes(self, signed_url: str) -> bytes:
+        audio_partial_id = signed_url.rsplit("/", 1)[-1][: -len(".wav")]
+        return make_pcm_wav_bytes(0.1, sample_rate=SAMPLE_RATES[audio_partial_id], channels=2, seed=0)
+
+    def download_signed_url_file(self, signed_url: str, path: str) -> FakeResponse:
+        with open(path, "wb") as f:
+            f.write(self._get_wav_bytes(signed_url))
+        self.paths.append(path)
+        self._written.wait()
+        return FakeResponse()
+
+    def get_signed_url_file(self, signed_url: str) -> bytes:
+        wav_bytes = self._get_wav_bytes(signed_url)
+        self._written.wait()
+        return wav_bytes
+
+
+@pytest.mark.parametrize("prefer_low_memory", [True, False])
+def test_audio_partials_of_one_partial_are_handled_at_once(prefer_low_memory):
+    client = FakePeerlogicAPIClient()
+    sample_rates = {}
+    get_sample_rate = main.get_sample_rate
+
+    def record_sample_rate(path: str) -> int:
+        sample_rates[path] = get_sample_rate(path)
+        return sample_rates[path]
+
+    source = InMemoryMessageSource()
+    for audio_partial_id in SAMPLE_RATES:
+        data = {"call_id": "call-1", "partial_id": "partial-1", "audio_partial_id": audio_partial_id}
+        source.publish(json.dumps(data).encode("utf-8"), call_id="call-1")
+
+    with mock.patch.object(main, "peerlogic_api_client", client), mock.patch.object(main, "get_sample_rate", record_sample_rate), mock.patch.object(
+        main.resource_accounting, "should_prefer_low_memory", return_value=prefer_low_memory
+    ):
+        worker = PullWorker(source, max_concurrency=2, pull_timeout_seconds=0.1)
+        worker.run(stop_when_idle=True)
+
+    assert (worker.processed, worker.failed) == (2, 0)
+    assert sorted(sample_rates.values()) == sorted(SAMPLE_RATES.values())
+    assert len(set(sample_rates)) == 2
+    assert not any(os.path.exists(path) for path in sample_rates)
+    if prefer_low_memory:
+        assert set(client.paths) == set(sample_rates)
@@ -0,0 +1,98 @@
+import base64
+import json
+import types
+from unittest import mock
+
+import pytest
+
+from fakes import FakeDlpServiceClient, FakeSpeechClient
+from idempotency import (
+    CLAIM_ACQUIRED,
+    CLAIM_DUPLICATE_COMPLETED,
+    CLAIM_DUPLICATE_IN_FLIGHT,
+    DuplicateInFlightError,
+    FileIdempotencyBackend,
+    IdempotencyLedger,
+    SQLiteIdempotencyBackend,
+    get_audio_partial_idempotency_key,
+)
+
+with mock.patch("google.cloud.dlp_v2.DlpServiceClient", FakeDlpServiceClient), mock.patch("google.cloud.speech_v1p1beta1.SpeechClient", FakeSpeechClient):
+    import main
+
+KEY = "audio_partial/call-1/partial-1/audio-partial-1"
+
+
+class Clock(object):
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture(params=["sqlite", "file"])
+def clock_and_ledger(request, tmp_path):
+    clock = Clock()
+    if request.param == "sqlite":
+        backend = SQLiteIdempotencyBackend(str(tmp_path / "idempotency.sqlite3"), clock=clock)
+    else:
+        backend = FileIdempotencyBackend(str(tmp_path / "idempotency"), clock=clock)
+    return clock, IdempotencyLedger(backend, lease_seconds=120, clock=clock)
+
+
+def test_crashed_holder_is_taken_over_once_its_lease_expires(clock_and_ledger):
+    clock, ledger = clock_and_ledger
+    assert ledger.claim(KEY).state == CLAIM_ACQUIRED  # never settled, as if the instance died
+
+    clock.now += 60
+    assert ledger.claim(KEY).state == CLAIM_DUPLICATE_IN_FLIGHT
+    clock.now += 61
+    assert ledger.claim(KEY).state == CLAIM_ACQUIRED
+
+
+def test_renewed_lease_outlasts_its_first_expiry(clock_and_ledger):
+    clock, ledger = clock_and_ledger
+    claim = ledger.claim(KEY)
+
+    for _ in range(5):
+        clock.now += 100
+        ledger.renew_claims()
+        assert ledger.claim(KEY).state == CLAIM_DUPLICATE_IN_FLIGHT
+
+    with claim:
+        pass
+    assert ledger.claim(KEY).state == CLAIM_DUPLICATE_COMPLETED
+
+
+def test_lost_lease_is_not_renewed(clock_and_ledger):
+    clock, ledger = clock_and_ledger
+    claim = ledger.claim(KEY)
+    clock.now += 121
+    assert ledger.claim(KEY).state == CLAIM_ACQUIRED  # taken over
+
+    assert not claim.renew(clock.now + 120)
+    ledger.renew_claims()  # logs the loss and stops renewing it
+
+
+def make_event(event_id: str):
+    data = {"call_id": "call-1", "partial_id": "partial-1", "audio_partial_id": "audio-partial-1"}
+    event = {"data": base64.b64encode(json.dumps(data).encode("utf-8")).decode("ascii"), "attributes": {"call_id": "call-1"}}
+    return event, types.SimpleNamespace(event_id=event_id, timestamp=None)
+
+
+def test_duplicate_in_flight_is_retried_and_completed_is_acknowledged(tmp_path):
+    ledger = IdempotencyLedger(SQLiteIdempotencyBackend(str(tmp_path / "idempotency.sqlite3")), lease_seconds=120)
+    claim = ledger.claim(get_audio_partial_idempotency_key("call-1", "partial-1", "audio-partial-1"), event_id="first")
+
+    with mock.patch.object(main, "idempotency_ledger", ledger), mock.patch.object(main, "event_deferral", None), mock.patch.object(
+        main, "process_audio_ready_event"
+    ) as process_audio_ready_event:
+        with pytest.raises(DuplicateInFlightError) as error:
+            main.handle_audio_ready_event(*make_event("second"), main.log)
+        assert 0 < error.value.retry_after_seconds <= 121
+
+        claim.complete()
+        main.handle_audio_ready_event(*make_event("third"), main.log)
+
+    process_audio_ready_event.assert_not_called()
@@ -0,0 +1,27 @@
+import mimetypes
+
+import pytest
+
+from fakes import FakeStorageClient
+from local_file_helpers import parallel_composite_upload
+
+
+@pytest.mark.parametrize(
+    "file_name, content_type, expected_content_type",
+    [
+        ("audio.wav", None, mimetypes.guess_type("audio.wav")[0]),  # audio/x-wav or audio/wav, depending on the platform
+        ("raw-extract.json", None, "application/json"),
+        ("unknown", None, "application/octet-stream"),
+        ("audio.wav", "audio/wav", "audio/wav"),
+    ],
+)
+def test_composed_blob_keeps_its_content_type(tmp_path, file_name, content_type, expected_content_type):
+    path = tmp_path / file_name
+    path.write_bytes(b"\x00\x01" * 1024)
+    storage_client = FakeStorageClient()
+
+    uri = parallel_composite_upload(file_name, str(path), "bucket", content_type=content_type, storage_client=storage_client)
+
+    assert uri == f"gs://bucket/{file_name}"
+    assert storage_client.buckets["bucket"] == {file_name: path.read_bytes()}  # parts are deleted
+    assert storage_client.content_types[("bucket", file_name)] == expected_content_type
@@ -0,0 +1,108 @@
+import threading
+from typing import List
+
+import pytest
+
+from peerlogic_api_models import CallOutcome, CallPurpose
+from peerlogic_api_write_batcher import PeerlogicAPIWriteBatcher
+
+
+class FakePeerlogicAPIClient(object):
+    """Records writes in the order they're sent. Keywords in fail_keywords, and purposes when fail_purposes is set, fail to write."""
+
+    def __init__(self, fail_keywords: List[str] = (), fail_purposes: bool = False) -> None:
+        self.fail_keywords = fail_keywords
+        self.fail_purposes = fail_purposes
+        self.writes: List[tuple] = []
+        self._lock = threading.Lock()
+
+    def _record(self, *write) -> None:
+        with self._lock:
+            self.writes.append(write)
+
+    def create_procedure_discussed(self, call_id: str, keyword: str) -> dict:
+        if keyword in self.fail_keywords:
+            raise Exception(f"Failed to write keyword='{keyword}'")
+        self._record("procedure_discussed", call_id, keyword)
+        return {"call": call_id, "keyword": keyword}
+
+    def create_call_purpose(self, call_purpose: CallPurpose) -> CallPurpose:
+        if self.fail_purposes:
+            raise Exception("Failed to write call purpose")
+        self._record("call_purpose", call_purpose.call)
+        return call_purpose.copy(update={"id": f"purpose-of-{call_purpose.call}"})
+
+    def create_call_outcome(self, call_id: str, call_outcome: CallOutcome) -> CallOutcome:
+        self._record("call_outcome", call_id, call_outcome.call_purpose)
+        return call_outcome.copy(update={"id": f"outcome-of-{call_id}"})
+
+
+def make_call_purpose(call_id: str) -> CallPurpose:
+    return CallPurpose(call=call_id, call_purpose_type="new_appointment", raw_call_purpose_model_run_id="run-1")
+
+
+def make_call_outcome() -> CallOutcome:
+    return CallOutcome(call_purpose="", call_outcome_type="success", raw_call_outcome_model_run_id="run-1")
+
+
+@pytest.fixture
+def client() -> FakePeerlogicAPIClient:
+    return FakePeerlogicAPIClient(fail_keywords=["crown"])
+
+
+def make_batcher(client: FakePeerlogicAPIClient, max_batch_size: int = 50) -> PeerlogicAPIWriteBatcher:
+    return PeerlogicAPIWriteBatcher(client, max_batch_size=max_batch_size, max_delay_seconds=60)  # never flushed by the timer here
+
+
+def test_flushes_when_batch_is_full(client):
+    with make_batcher(client, max_batch_size=3) as batcher:
+        futures = [batcher.create_procedure_discussed("call-1", keyword) for keyword in ["exam", "cleaning"]]
+        assert client.writes == []
+        assert not any(future.done() for future in futures)
+
+        futures.append(batcher.create_procedure_discussed("call-1", "x-ray"))  # fills the batch, flushed before returning
+        assert all(future.done() for future in futures)
+        assert sorted(write[2] for write in client.writes) == ["cleaning", "exam", "x-ray"]
+
+        batcher.create_procedure_discussed("call-1", "filling")
+        assert len(client.writes) == 3
+
+
+def test_flushes_on_close(client):
+    batcher = make_batcher(client)
+    future = batcher.create_procedure_discussed("call-1", "exam")
+    assert not future.done()
+
+    batcher.close()
+    assert future.result(timeout=0) == {"call": "call-1", "keyword": "exam"}
+    with pytest.raises(Exception, match="closed"):
+        batcher.create_procedure_discussed("call-1", "cleaning")
+    batcher.close()
+
+
+def test_failures_are_propagated_to_their_futures(client):
+    with make_batcher(client) as batcher:
+        failing = batcher.create_procedure_discussed("call-1", "crown")
+        succeeding = batcher.create_procedure_discussed("call-1", "exam")
+
+    with pytest.raises(Exception, match="keyword='crown'"):
+        failing.result(timeout=0)
+    assert succeeding.result(timeout=0) == {"call": "call-1", "keyword": "exam"}
+
+
+def test_children_get_their_parents_id_and_fail_with_them():
+    client = FakePeerlogicAPIClient()
+    with make_batcher(client) as batcher:
+        outcome = batcher.create_call_outcome("call-1", make_call_outcome(), call_purpose=batcher.create_call_purpose(make_call_purpose("call-1")))
+    assert outcome.result(timeout=0).id == "outcome-of-call-1"
+    assert client.writes == [("call_purpose", "call-1"), ("call_outcome", "call-1", "purpose-of-call-1")]
+
+    failing_client = FakePeerlogicAPIClient(fail_purposes=True)
+    with make_batcher(failing_client) as batcher:
+        purpose = batcher.create_call_purpose(make_call_purpose("call-2"))
+        outcome = batcher.create_call_outcome("call-2", make_call_outcome(), call_purpose=purpose)
+
+    with pytest.raises(Exception, match="parent failed") as error:
+        outcome.result(timeout=0)
+    assert error.value.__cause__ is purpose.exception()
+    assert failing_client.writes == []
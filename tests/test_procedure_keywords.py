@@ -0,0 +1,72 @@
+from typing import List
+
+import pytest
+
+from procedure_keywords import ProcedureKeywordMatcher, get_discussed_keywords
+from speech_to_text import TranscriptWord
+
+
+def make_words(text: str, channel_tag: int = 1) -> List[TranscriptWord]:
+    return [TranscriptWord(word=word, start_time=i * 0.5, end_time=i * 0.5 + 0.4, channel_tag=channel_tag) for i, word in enumerate(text.split())]
+
+
+@pytest.fixture(scope="module")
+def matcher() -> ProcedureKeywordMatcher:
+    return ProcedureKeywordMatcher()
+
+
+@pytest.mark.parametrize(
+    "text, keywords",
+    [
+        ("I'd like to schedule a cleaning for next week", ["cleaning"]),
+        ("she needs a deep cleaning and X-rays", ["deep cleaning", "x-ray"]),
+        ("we'll do scaling and root planing on the lower left", ["deep cleaning"]),
+        ("the doctor found two cavities and a cracked crown", ["filling", "crown"]),
+        ("he wants to get a tooth pulled, maybe the wisdom teeth", ["extraction"]),
+        ("she's coming in for a root canal therapy", ["root canal"]),
+        ("Invisalign or braces for my son", ["orthodontics"]),
+        ("she wants partial dentures on the upper", ["dentures"]),
+        ("it's time for her six month check up", ["exam"]),
+    ],
+)
+def test_finds_procedures(matcher, text, keywords):
+    assert get_discussed_keywords(matcher.find_matches(make_words(text))) == keywords
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "let me pull up your chart",
+        "I filled out the forms already",
+        "you can start filling out the forms in the waiting room",
+        "we're scaling back our hours on fridays",
+        "please consult your calendar and call us back",
+        "can I get a cap on the copay",
+        "sorry the swelling of the line made me miss it",
+        "we're cleaning up the schedule for next week",
+        "is the evaluation of my insurance done",
+        "I pulled into the parking lot",
+        "we got a partial payment from your insurance",
+        "let me check up on your claim",
+        "I'll check up with the billing office",
+    ],
+)
+def test_ignores_ordinary_speech(matcher, text):
+    assert matcher.find_matches(make_words(text)) == []
+
+
+def test_phrases_do_not_span_channels(matcher):
+    words = [
+        TranscriptWord("root", 0.0, 0.4, 1),
+        TranscriptWord("okay", 0.5, 0.9, 2),
+        TranscriptWord("beer", 1.0, 1.4, 1),
+        TranscriptWord("canal", 1.5, 1.9, 2),
+    ]
+
+    assert matcher.find_matches(words) == []
+
+
+def test_longer_phrase_replaces_the_one_it_contains(matcher):
+    matches = matcher.find_matches(make_words("scaling and root planing"))
+
+    assert [(match.keyword, match.phrase, match.start_time) for match in matches] == [("deep cleaning", "scaling and root planing", 0.0)]
@@ -0,0 +1,62 @@
+import pytest
+
+from speech_admission import SpeechAdmissionController, SpeechQuotaExhaustedError
+
+SHORT_AUDIO_SECONDS = 60.0
+LONG_AUDIO_SECONDS = 30 * 60.0
+
+
+def make_controller(requests_per_minute: int = 100, max_concurrent_operations: int = 100) -> SpeechAdmissionController:
+    return SpeechAdmissionController(
+        requests_per_minute=requests_per_minute,
+        max_concurrent_operations=max_concurrent_operations,
+        short_audio_seconds=5 * 60,
+        long_audio_share=0.5,
+        clock=lambda: 600.0,
+        random=lambda: 0.0,
+    )
+
+
+def admit_all(controller: SpeechAdmissionController, audio_seconds: float, count: int) -> int:
+    admitted = 0
+    for _ in range(count):
+        try:
+            controller.admit(audio_seconds)
+            admitted += 1
+        except SpeechQuotaExhaustedError:
+            pass
+    return admitted
+
+
+def test_short_audio_is_admitted_ahead_of_long_audio_when_requests_are_scarce():
+    controller = make_controller(requests_per_minute=4)
+
+    assert admit_all(controller, LONG_AUDIO_SECONDS, 4) == 2
+    assert admit_all(controller, SHORT_AUDIO_SECONDS, 4) == 2
+    with pytest.raises(SpeechQuotaExhaustedError):
+        controller.admit(SHORT_AUDIO_SECONDS)
+
+
+def test_short_audio_is_admitted_ahead_of_long_audio_when_operations_are_scarce():
+    controller = make_controller(max_concurrent_operations=4)
+
+    assert admit_all(controller, LONG_AUDIO_SECONDS, 4) == 2
+    short_tickets = [controller.admit(SHORT_AUDIO_SECONDS) for _ in range(2)]
+    with pytest.raises(SpeechQuotaExhaustedError):
+        controller.admit(LONG_AUDIO_SECONDS)
+
+    short_tickets[0].release()
+    with pytest.raises(SpeechQuotaExhaustedError):
+        controller.admit(LONG_AUDIO_SECONDS)  # the freed slot is kept for short audio
+    controller.admit(SHORT_AUDIO_SECONDS)
+
+
+def test_long_audio_backs_off_longer():
+    controller = make_controller(requests_per_minute=1)
+    controller.admit(SHORT_AUDIO_SECONDS)
+
+    with pytest.raises(SpeechQuotaExhaustedError) as short_error:
+        controller.admit(SHORT_AUDIO_SECONDS)
+    with pytest.raises(SpeechQuotaExhaustedError) as long_error:
+        controller.admit(LONG_AUDIO_SECONDS)
+    assert long_error.value.retry_after_seconds > short_error.value.retry_after_seconds
@@ -0,0 +1,33 @@
+from datetime import datetime, timedelta, timezone
+
+from synthetic import make_speech_raw_extract
+from transcript_merge import MergedCallTranscript
+
+CALL_START_TIME = datetime(2022, 1, 1, tzinfo=timezone.utc)
+
+
+def make_partials():
+    partials = [(f"partial{i}", CALL_START_TIME + timedelta(seconds=i * 100), make_speech_raw_extract(100, seed=i)) for i in range(4)]
+    partials.append(("overlapping", CALL_START_TIME + timedelta(seconds=150), make_speech_raw_extract(150, seed=9)))
+    partials.append(("silent", CALL_START_TIME, {"results": []}))
+    return partials
+
+
+def test_stored_transcript_extends_like_one_merged_in_memory():
+    partials = make_partials()
+    in_memory = MergedCallTranscript(CALL_START_TIME)
+    for partial in partials:
+        in_memory.add_partial(*partial)
+
+    # each partial merged by a different invocation, which only has the stored transcript and its own raw extract
+    stored = MergedCallTranscript(CALL_START_TIME).to_json()
+    for partial in reversed(partials):
+        merged = MergedCallTranscript.from_json(stored)
+        merged.add_partial(*partial)
+        stored = merged.to_json()
+    merged = MergedCallTranscript.from_json(stored)
+
+    assert merged.get_words() == in_memory.get_words()
+    assert merged.partial_ids == in_memory.partial_ids
+    assert merged.call_start_time == CALL_START_TIME
+    assert merged.add_partial(*partials[0]) == 0  # already merged